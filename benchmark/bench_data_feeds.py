@@ -0,0 +1,84 @@
+import tempfile
+import time
+import pandas as pd
+import typer
+from pathlib import Path
+from prepare.synthetic import make_synthetic_inputs
+from simulator.data_feeds import DataFeeds, FeedOnce
+
+
+class IlocDataFeeds:
+    """改造前的实现：每个bar对每个exchange x market做一次DataFrame.iloc，仅作为benchmark的对照"""
+
+    def __init__(self, data_dir: Path, exchanges: list[str], markets: list[str]) -> None:
+        self._datas = {}
+        self._exchanges = exchanges
+        self._markets = markets
+        self._index = 0
+        self._total_rows = None
+        for ex in exchanges:
+            for market in markets:
+                df = pd.read_csv(data_dir / f"{ex}_{market}.csv", index_col="timestamp", parse_dates=True)
+                self._total_rows = df.shape[0]
+                self._datas[f"{ex}/{market}"] = df
+
+    def __iter__(self):
+        return self
+
+    def __read_current(self):
+        feed = FeedOnce()
+        for market in self._markets:
+            for ex in self._exchanges:
+                row = self._datas[f"{ex}/{market}"].iloc[self._index, :]
+                if row.isna().any():
+                    return None
+                if feed.timestamp is None:
+                    feed.timestamp = row.name.to_pydatetime()
+                for col in ["open_price", "close_price", "mark_price", "fund_rate"]:
+                    feed.add(column=col, market=market, exchange=ex, value=row[col])
+        return feed
+
+    def __next__(self):
+        while self._index < self._total_rows:
+            feed = self.__read_current()
+            self._index += 1
+            if feed is not None:
+                return feed
+        raise StopIteration
+
+
+def bars_per_second(feeds) -> tuple[int, float]:
+    start = time.perf_counter()
+    n_bars = sum(1 for _ in feeds)
+    return n_bars, n_bars / (time.perf_counter() - start)
+
+
+def load_seconds(data_dir: Path, exchanges: list[str], markets: list[str], cache_dir: Path | None) -> float:
+    start = time.perf_counter()
+    DataFeeds(data_dir, exchanges, markets, cache_dir=cache_dir)
+    return time.perf_counter() - start
+
+
+def main(n_exchanges: int = 2, n_markets: int = 3, hours: int = 24 * 90):
+    exchanges = [f"ex{i}" for i in range(n_exchanges)]
+    markets = [f"M{i}-USD" for i in range(n_markets)]
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dir = Path(data_dir)
+        make_synthetic_inputs(data_dir, exchanges=exchanges, markets=markets, hours=hours)
+
+        n_bars, before = bars_per_second(IlocDataFeeds(data_dir, exchanges, markets))
+        _, after = bars_per_second(DataFeeds(data_dir, exchanges, markets))
+
+        csv_load = load_seconds(data_dir, exchanges, markets, cache_dir=None)
+        load_seconds(data_dir, exchanges, markets, cache_dir=data_dir / "cache")  # 第一次加载时生成缓存
+        cached_load = load_seconds(data_dir, exchanges, markets, cache_dir=data_dir / "cache")
+
+    print(f"{n_exchanges} exchanges x {n_markets} markets, {n_bars} bars")
+    print(f"before (DataFrame.iloc): {before:12,.0f} bars/s")
+    print(f"after  (numpy block)   : {after:12,.0f} bars/s  ({after / before:.1f}x)")
+    print(f"load from csv: {csv_load * 1000:8.1f} ms, load from cache: {cached_load * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,48 @@
+import time
+import typer
+from prepare.synthetic import synthetic_block
+from simulator.data_feeds import DataFeeds
+from simulator.event_engine import EventSkippingStrategy
+from simulator.strategy import FundingArbStrategy
+from simulator.utils import Config, afr2h
+
+
+def run_seconds(cls, n_exchanges: int, n_markets: int, hours: int, change_pct: float):
+    exchanges = [f"ex{i}" for i in range(n_exchanges)]
+    markets = [f"M{i}-USD" for i in range(n_markets)]
+    timestamps, values = synthetic_block(n_exchanges, n_markets, hours=hours)
+    config = Config(
+        init_cash=1000000,
+        margin_rate=0.5,
+        commission=1 / 1000,
+        slippage=0,
+        ordersize_usd=1000,
+        fundrate_diff_open=afr2h(0.3),
+        fundrate_diff_close=0,
+        fundrate_diff_change_pct=change_pct,
+        data_dir=None,
+        exchanges=exchanges,
+        markets=markets,
+    )
+    strategy = cls(config, data_feeds=DataFeeds.from_arrays(timestamps, values, exchanges, markets))
+
+    start = time.perf_counter()
+    strategy.run()
+    return strategy, time.perf_counter() - start
+
+
+def main(n_exchanges: int = 2, n_markets: int = 3, hours: int = 24 * 365, change_pct: float = 1.0):
+    bar_by_bar, before = run_seconds(FundingArbStrategy, n_exchanges, n_markets, hours, change_pct)
+    event_skipping, after = run_seconds(EventSkippingStrategy, n_exchanges, n_markets, hours, change_pct)
+
+    n_bars = len(event_skipping._rows)
+    print(f"{n_exchanges} exchanges x {n_markets} markets, {n_bars} bars, {len(bar_by_bar.closed_trades)} trades")
+    print(f"bar by bar    : {n_bars / before:12,.0f} bars/s")
+    print(
+        f"event skipping: {n_bars / after:12,.0f} bars/s  ({before / after:.1f}x)"
+        f", {event_skipping.n_stepped_bars} bars processed one by one"
+    )
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import tempfile
+import time
+import httpx
+import typer
+from datetime import datetime, time as dtime, timezone
+from pathlib import Path
+from prepare import prepare
+from prepare.common import SHARD_DAYS, TokenBucket
+from prepare.prepare import DOWNLOADERS, PrepareJob
+from prepare.raw_store import RawStore
+from prepare.synthetic import SyntheticExchangeApi
+from prepare.transport import RecordingTransport, ReplayTransport
+from simulator.dataset import PartitionedDataset
+
+NO_LIMIT = 1e9
+
+
+def make_job(exchanges: str, coins: str, start_day: datetime, end_day: datetime, transport, workdir: Path):
+    return PrepareJob(
+        exchanges,
+        coins,
+        start_dt=start_day,
+        end_dt=end_day,
+        transport=transport,
+        store=RawStore(workdir / "data/raw"),
+        rate_limits={ex: NO_LIMIT for ex in DOWNLOADERS},
+    )
+
+
+def record(cassette: Path, exchanges: str, coins: str, start_day: datetime, end_day: datetime, live: bool):
+    """录制一次完整的PrepareJob下载；live=False时录制SyntheticExchangeApi，不访问网络"""
+    inner = (
+        None if live else httpx.MockTransport(SyntheticExchangeApi(first="2000-01-01", last="2100-01-01"))
+    )
+    with tempfile.TemporaryDirectory() as workdir:
+        job = make_job(
+            exchanges, coins, start_day, end_day, RecordingTransport(cassette, inner), Path(workdir)
+        )
+        assert job.download(), "recording failed"
+
+
+async def fetch_once(downloader, transport, start_time: datetime, end_time: datetime):
+    async with httpx.AsyncClient(transport=transport) as client:
+        return await downloader.fetch(client, start_time, end_time, TokenBucket(rate=NO_LIMIT), SHARD_DAYS)
+
+
+def bench_downloaders(cassette: Path, exchanges: str, coins: str, start_day, end_day, latency: float):
+    # 与PrepareJob相同的时间段和切分方式，才能命中录制的请求
+    start_time = datetime.combine(start_day.date(), dtime()).replace(tzinfo=timezone.utc)
+    end_time = datetime.combine(end_day.date(), dtime(23, 59, 59)).replace(tzinfo=timezone.utc)
+
+    for exchange in exchanges.split(","):
+        for downloader_cls in DOWNLOADERS[exchange]:
+            rows = 0
+            transport = ReplayTransport(cassette, latency=latency)
+            start = time.perf_counter()
+            for coin in coins.split(","):
+                downloader = downloader_cls(coin.upper() + "-USD")
+                rows += len(asyncio.run(fetch_once(downloader, transport, start_time, end_time)))
+            elapsed = time.perf_counter() - start
+            name = f"{exchange}.{downloader.data_type}"
+            print(
+                f"{name:18s}: {rows / elapsed:12,.0f} rows/s {transport.requests / elapsed:10,.1f} requests/s"
+            )
+
+
+def bench_pipeline(cassette: Path, exchanges: str, coins: str, start_day, end_day, latency, error_rate):
+    transport = ReplayTransport(cassette, latency=latency, error_rate=error_rate)
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)  # postprocess写到当前目录下的data/input
+        try:
+            start = time.perf_counter()
+            job = make_job(exchanges, coins, start_day, end_day, transport, Path(workdir))
+            assert job.download(), "replay failed"
+            job.postprocess()
+            elapsed = time.perf_counter() - start
+            dataset = PartitionedDataset("data/input")
+            rows = sum(
+                len(dataset.read(exchange, coin.upper() + "-USD"))
+                for exchange in exchanges.split(",")
+                for coin in coins.split(",")
+            )
+        finally:
+            os.chdir(cwd)
+    print(
+        f"{'PrepareJob':18s}: {rows / elapsed:12,.0f} rows/s {transport.requests / elapsed:10,.1f} requests/s"
+        f" ({transport.errors} injected errors)"
+    )
+
+
+def main(
+    exchanges: str = "dydx,rabbitx",
+    coins: str = "btc,eth",
+    start_day: datetime = datetime(2023, 1, 1),
+    end_day: datetime = datetime(2023, 12, 31),
+    cassette: Path = None,
+    record_live: bool = False,
+    latency: float = 0.0,
+    error_rate: float = 0.0,
+):
+    """
+    - cassette: 录制的响应所在的目录，不存在时先录制；不指定时录制到临时目录
+    - record_live: 录制时访问真实的API，否则录制SyntheticExchangeApi
+    """
+    prepare.BACKOFF_SECONDS = 0.001
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cassette = cassette or Path(tmpdir) / "cassette"
+        if not cassette.exists():
+            record(cassette, exchanges, coins, start_day, end_day, live=record_live)
+
+        print(
+            f"{len(ReplayTransport(cassette))} recorded responses, latency={latency}s, error_rate={error_rate}"
+        )
+        bench_downloaders(cassette, exchanges, coins, start_day, end_day, latency)
+        bench_pipeline(cassette, exchanges, coins, start_day, end_day, latency, error_rate)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,268 @@
+import json
+import platform
+import subprocess
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import typer
+from dataclasses import replace
+from datetime import datetime, timezone
+from pathlib import Path
+from prepare.synthetic import make_synthetic_inputs, synthetic_block
+from simulator.arbitrage_trade import FundingArbTrade
+from simulator.batched import BatchedStrategy
+from simulator.data_feeds import DataFeeds
+from simulator.exchange import Exchange
+from simulator.isolated import IsolatedMarginStrategy
+from simulator.strategy import FundingArbStrategy
+from simulator.sweep import random_configs
+from simulator.utils import Config, afr2h
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def make_config(n_exchanges: int, n_markets: int, data_dir: Path = None) -> Config:
+    return Config(
+        init_cash=1e7,
+        margin_rate=0.5,
+        commission=1 / 1000,
+        slippage=0,
+        ordersize_usd=1000,
+        fundrate_diff_open=afr2h(0.1),
+        fundrate_diff_close=afr2h(0.01),
+        fundrate_diff_change_pct=0.1,
+        data_dir=data_dir,
+        exchanges=[f"ex{i}" for i in range(n_exchanges)],
+        markets=[f"M{i}-USD" for i in range(n_markets)],
+        silent=True,
+    )
+
+
+def make_feeds(config: Config, hours: int) -> DataFeeds:
+    timestamps, values = synthetic_block(
+        len(config.exchanges), len(config.markets), hours=hours, regimes=True
+    )
+    return DataFeeds.from_arrays(timestamps, values, exchanges=config.exchanges, markets=config.markets)
+
+
+def bench_data_feeds(n_exchanges: int, n_markets: int, hours: int) -> tuple[int, float]:
+    """从合成的数据集加载，逐bar迭代"""
+    config = make_config(n_exchanges, n_markets)
+    with tempfile.TemporaryDirectory() as data_dir:
+        make_synthetic_inputs(
+            data_dir, config.exchanges, config.markets, hours=hours, dataset=True, regimes=True
+        )
+        start = time.perf_counter()
+        n_bars = sum(1 for _ in DataFeeds(data_dir, exchanges=config.exchanges, markets=config.markets))
+        return n_bars, time.perf_counter() - start
+
+
+def bench_exchange_trade(n_markets: int, n_trades: int) -> tuple[int, float]:
+    """在n_markets个market上轮流加仓、减仓，不翻转方向"""
+    markets = [f"M{i}-USD" for i in range(n_markets)]
+    exchange = Exchange("ex0", init_cash=1e9, markets={m: 0.5 for m in markets}, commission=0.001)
+    prices = 100 + np.random.default_rng(0).normal(0, 1, size=n_trades)
+
+    start = time.perf_counter()
+    for idx, price in enumerate(prices.tolist()):
+        market = markets[idx % n_markets]
+        # 每个market上先连续两次buy，再一次sell，持仓一直为正
+        is_long = -1 if (idx // n_markets) % 3 == 2 else 1
+        exchange.trade(market, is_long=is_long, price=price, shares=1.0)
+    return n_trades, time.perf_counter() - start
+
+
+def bench_settle(n_trades: int, hours: int) -> tuple[int, float]:
+    """n_trades个同时持仓的FundingArbTrade，每个bar都结算"""
+    config = make_config(n_exchanges=2, n_markets=n_trades)
+    long_ex, short_ex = [
+        Exchange(ex, init_cash=config.init_cash, markets={m: 0.5 for m in config.markets}, commission=0.001)
+        for ex in config.exchanges
+    ]
+    feeds = list(make_feeds(config, hours))
+    trades = []
+    for market in config.markets:
+        trade = FundingArbTrade(market, long_ex, short_ex, config)
+        prices = {ex: feeds[0].close_prices[market][ex] for ex in config.exchanges}
+        assert trade.safe_open(feeds[0].timestamp, config.ordersize_usd, prices, fundrate_diff=1.0)
+        trade.latest_fundrate_diff = 1.0
+        trades.append(trade)
+    funding_hours = {ex: 1.0 for ex in config.exchanges}
+
+    start = time.perf_counter()
+    for feed in feeds:
+        for trade in trades:
+            market = trade.market
+            trade.settle(
+                feed.close_prices[market],
+                feed.mark_prices[market],
+                feed.funding_rates[market],
+                funding_hours,
+            )
+    return len(feeds) * n_trades, time.perf_counter() - start
+
+
+def bench_best_arb_pair(n_exchanges: int, hours: int) -> tuple[int, float]:
+    config = make_config(n_exchanges, n_markets=1)
+    strategy = FundingArbStrategy(config, data_feeds=make_feeds(config, hours))
+    funding_rates = [feed.funding_rates for feed in strategy._data_feeds]
+
+    start = time.perf_counter()
+    for rates in funding_rates:
+        strategy._best_arb_pair("M0-USD", rates)
+    return len(funding_rates), time.perf_counter() - start
+
+
+def bench_strategy_run(n_exchanges: int, n_markets: int, hours: int) -> tuple[int, float]:
+    config = make_config(n_exchanges, n_markets)
+    strategy = FundingArbStrategy(config, data_feeds=make_feeds(config, hours))
+    start = time.perf_counter()
+    strategy.run()
+    return hours, time.perf_counter() - start
+
+
+def bench_isolated_run(n_exchanges: int, n_markets: int, hours: int, workers: int) -> tuple[int, float]:
+    """逐仓模式，各market在workers个进程中并行回测，计数是所有market的bar数"""
+    config = replace(make_config(n_exchanges, n_markets), isolated_margin=True)
+    strategy = IsolatedMarginStrategy(config, data_feeds=make_feeds(config, hours), max_workers=workers)
+    start = time.perf_counter()
+    strategy.run()
+    return hours * n_markets, time.perf_counter() - start
+
+
+def bench_batched_run(n_configs: int, hours: int) -> tuple[int, float]:
+    """n_configs组随机的开仓门槛和下单金额一起回测，计数是所有config的bar数"""
+    base = make_config(n_exchanges=3, n_markets=3)
+    configs = random_configs(
+        base, {"fundrate_diff_open": (afr2h(0.02), afr2h(0.3)), "ordersize_usd": (200, 2000)}, n=n_configs
+    )
+    strategy = BatchedStrategy(configs, data_feeds=make_feeds(base, hours))
+    start = time.perf_counter()
+    strategy.run()
+    return hours * n_configs, time.perf_counter() - start
+
+
+# case -> (函数, 规模的sweep, 计数的单位)
+CASES = {
+    "data_feeds_iter": (
+        bench_data_feeds,
+        [dict(n_exchanges=2, n_markets=3, hours=24 * 90), dict(n_exchanges=5, n_markets=10, hours=24 * 90)],
+        "bars",
+    ),
+    "exchange_trade": (
+        bench_exchange_trade,
+        [dict(n_markets=3, n_trades=30000), dict(n_markets=30, n_trades=30000)],
+        "trades",
+    ),
+    "arb_trade_settle": (
+        bench_settle,
+        [dict(n_trades=1, hours=24 * 90), dict(n_trades=20, hours=24 * 30)],
+        "settles",
+    ),
+    "best_arb_pair": (
+        bench_best_arb_pair,
+        [dict(n_exchanges=n, hours=24 * 30) for n in [2, 5, 10, 20]],
+        "calls",
+    ),
+    "strategy_run": (
+        bench_strategy_run,
+        [dict(n_exchanges=2, n_markets=3, hours=24 * 90), dict(n_exchanges=5, n_markets=10, hours=24 * 90)],
+        "bars",
+    ),
+    "isolated_run": (
+        bench_isolated_run,
+        [dict(n_exchanges=5, n_markets=8, hours=24 * 90, workers=w) for w in [1, 4]],
+        "market_bars",
+    ),
+    "batched_run": (
+        bench_batched_run,
+        [dict(n_configs=n, hours=24 * 30) for n in [1, 100, 10000]],
+        "config_bars",
+    ),
+}
+
+
+def case_key(case: str, params: dict) -> str:
+    return case + "[" + ",".join(f"{k}={v}" for k, v in params.items()) + "]"
+
+
+def run_suite(cases: list[str], repeat: int) -> list[dict]:
+    """每个case的每个规模跑repeat次，取最快的一次"""
+    results = []
+    for case in cases:
+        func, sweep, unit = CASES[case]
+        for params in sweep:
+            count, seconds = min((func(**params) for _ in range(repeat)), key=lambda r: r[1])
+            results.append(
+                {
+                    "key": case_key(case, params),
+                    "case": case,
+                    "params": params,
+                    "unit": unit,
+                    "count": count,
+                    "seconds": seconds,
+                    "per_second": count / seconds,
+                }
+            )
+            print(f"{results[-1]['key']:60s}: {count / seconds:14,.0f} {unit}/s")
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: list[dict], baseline_file: Path):
+    """与之前保存的结果逐项比较，speedup>1表示变快"""
+    with open(baseline_file) as fin:
+        baseline = {r["key"]: r for r in json.load(fin)["results"]}
+
+    print(f"\ncompare with {baseline_file}")
+    for result in results:
+        if result["key"] in baseline:
+            speedup = result["per_second"] / baseline[result["key"]]["per_second"]
+            print(f"{result['key']:60s}: {speedup:6.2f}x")
+
+
+def main(
+    cases: str = ",".join(CASES),
+    repeat: int = 3,
+    output: Path = None,
+    baseline: Path = None,
+):
+    """
+    - output: 结果保存的json文件，默认是benchmark/results/{git commit}.json
+    - baseline: 之前某次保存的json，给出时逐项打印speedup
+    """
+    commit = git_commit()
+    results = run_suite([c.strip() for c in cases.split(",")], repeat=repeat)
+
+    output = output or RESULTS_DIR / f"{commit}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as fout:
+        json.dump(
+            {
+                "commit": commit,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "pandas": pd.__version__,
+                "results": results,
+            },
+            fout,
+            indent=1,
+        )
+    print(f"results saved to {output}")
+
+    if baseline is not None:
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -1,10 +1,15 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
 from enum import Enum
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import httpx
+import pandas as pd
 import typer
 from pathlib import Path
 
 UTC_TM_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+SHARD_DAYS = 30
 
 
 def check_http_error(response: httpx.Response) -> None:
@@ -26,3 +31,100 @@ def safe_output_path(outfname: str | Path):
 
 def raw_data_file(exchange: str, market: str):
     return f"data/raw/{exchange}_{market}.csv"
+
+
+def save_raw_data(exchange: str, market: str, df_fundrates: pd.DataFrame, df_candles: pd.DataFrame):
+    df = df_fundrates.join(df_candles, how="outer")
+    df.sort_index(inplace=True)
+
+    outfname = safe_output_path(raw_data_file(exchange, market))
+    df.to_csv(outfname, index_label="timestamp", date_format="%Y-%m-%d %H:%M:%S")
+
+
+class TokenBucket:
+    """令牌桶限速，同一个exchange上所有并发的请求共享一个桶
+    - rate: 每秒补充的令牌数，即长期平均的请求频率上限
+    - capacity: 桶的容量，允许的最大突发请求数
+    """
+
+    def __init__(self, rate: float, capacity: int = 1) -> None:
+        self.__rate = rate
+        self.__capacity = capacity
+        self.__tokens = float(capacity)
+        self.__last = time.monotonic()
+        self.__lock = asyncio.Lock()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.__capacity, self.__tokens + (now - self.__last) * self.__rate)
+        self.__last = now
+
+    async def acquire(self):
+        # 加锁保证等待的请求按先来后到取得令牌
+        async with self.__lock:
+            self.__refill()
+            if self.__tokens < 1:
+                await asyncio.sleep((1 - self.__tokens) / self.__rate)
+                self.__refill()
+            self.__tokens -= 1
+
+
+class ColumnarRows:
+    """按列累积_parse解析出的数据，最后一次性构造DataFrame，避免逐行的list of dict"""
+
+    def __init__(self) -> None:
+        self.__columns: dict[str, list] = {}
+
+    def __len__(self):
+        return len(self.__columns.get("timestamp", []))
+
+    def extend(self, columns: dict[str, list], stop: int = None):
+        """只追加每一列的前stop行，stop=None时追加全部"""
+        for name, values in columns.items():
+            self.__columns.setdefault(name, []).extend(values[:stop])
+
+    @staticmethod
+    def to_frame(rows: list["ColumnarRows"]) -> pd.DataFrame:
+        names = list(dict.fromkeys(name for r in rows for name in r.__columns))
+        df = pd.DataFrame({name: [v for r in rows for v in r.__columns.get(name, [])] for name in names})
+        if len(df.columns) == 0:
+            df["timestamp"] = []
+        df.set_index("timestamp", inplace=True)
+        return df
+
+
+@dataclass
+class TimeShard:
+    """下载时间段[start, end)中的一段，各段独立分页，可以并发下载；cursor是下一页的位置，失败重试时从这里继续"""
+
+    start: datetime
+    end: datetime
+    is_first: bool
+    is_last: bool
+    cursor: object = None
+    done: bool = False
+    rows: ColumnarRows = field(default_factory=ColumnarRows)
+
+
+def time_shards(start_time: datetime, end_time: datetime, shard_days: int = SHARD_DAYS) -> list[TimeShard]:
+    """把[start_time, end_time]按shard_days天切分；最后一段的end就是end_time"""
+    step = timedelta(days=shard_days)
+    bounds = [start_time]
+    while bounds[-1] + step < end_time:
+        bounds.append(bounds[-1] + step)
+    bounds.append(end_time)
+
+    n_shards = len(bounds) - 1
+    return [
+        TimeShard(start=bounds[idx], end=bounds[idx + 1], is_first=idx == 0, is_last=idx == n_shards - 1)
+        for idx in range(n_shards)
+    ]
+
+
+async def fetch_shards(shards: list[TimeShard], fetch_shard) -> pd.DataFrame:
+    """并发下载所有未完成的shard，任何一个shard失败都等其他shard结束后再抛出，已下载的页保留在shard中"""
+    results = await asyncio.gather(*(fetch_shard(s) for s in shards if not s.done), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return ColumnarRows.to_frame([s.rows for s in shards])
@@ -3,7 +3,16 @@ import httpx
 import pandas as pd
 from datetime import timezone, datetime, timedelta, time
 import typer
-from prepare.common import UTC_TM_FORMAT, check_http_error, safe_output_path, raw_data_file
+from prepare.common import (
+    SHARD_DAYS,
+    UTC_TM_FORMAT,
+    TimeShard,
+    TokenBucket,
+    check_http_error,
+    fetch_shards,
+    save_raw_data,
+    time_shards,
+)
 
 SLEEP_SECONDS = 0.3
 
@@ -21,6 +30,8 @@ class DownloaderBase:
     def __init__(self, market: str, data_type: str) -> None:
         self.market = market
         self.data_type = data_type
+        # 各个时间段的下载进度，下载中途失败时保留，再次fetch只从断点继续未完成的时间段
+        self._shards: list[TimeShard] = None
 
     def _url(self) -> str:
         raise NotImplementedError()
@@ -28,36 +39,55 @@ class DownloaderBase:
     def _params(self, end_time: datetime) -> dict:
         raise NotImplementedError()
 
-    def _parse(self, json: dict):
+    def _parse(self, json: dict) -> dict[str, list]:
+        """返回按列存放的数据，按时间倒序"""
         raise NotImplementedError()
 
-    async def download(self, start_time: datetime, end_time: datetime):
+    async def __fetch_shard(self, client: httpx.AsyncClient, shard: TimeShard, limiter: TokenBucket):
         url = self._url()
+        if shard.cursor is None:
+            # shard的end不包含在内，最后一个shard的end就是用户指定的end_time，包含在内
+            shard.cursor = shard.end if shard.is_last else shard.end - timedelta(seconds=1)
+
+        while shard.cursor >= shard.start:
+            await limiter.acquire()
+            response = await client.get(url, params=self._params(shard.cursor))
+            check_http_error(response)
+
+            columns = self._parse(response.json())
+            timestamps = columns["timestamp"]
+            if len(timestamps) == 0:
+                break
+
+            # 按时间倒序存放每小时的funding rate，最后一行才是最老的
+            first_time = timestamps[-1]
+            print(
+                f"downloaded DYDX[{self.market}] {len(timestamps)} {self.data_type} {first_time} ~ {shard.cursor}"
+            )
+
+            # 最后一页会越过shard的start，越过的部分属于前一个shard，丢弃；第一个shard保留越过的部分，与不分段时相同
+            stop = None if shard.is_first else sum(t >= shard.start for t in timestamps)
+            shard.rows.extend(columns, stop)
+            shard.cursor = first_time - timedelta(seconds=1)
+
+        shard.done = True
+
+    async def fetch(
+        self,
+        client: httpx.AsyncClient,
+        start_time: datetime,
+        end_time: datetime,
+        limiter: TokenBucket,
+        shard_days: int = SHARD_DAYS,
+    ) -> pd.DataFrame:
+        """把[start_time, end_time]按shard_days天切分成相互独立的时间段，并发分页下载，总的请求频率由limiter限制"""
+        if self._shards is None:
+            self._shards = time_shards(start_time, end_time, shard_days)
+        return await fetch_shards(self._shards, lambda shard: self.__fetch_shard(client, shard, limiter))
 
-        all_results = []
+    async def download(self, start_time: datetime, end_time: datetime):
         async with httpx.AsyncClient() as client:
-            while end_time >= start_time:
-                response = await client.get(url, params=self._params(end_time))
-                check_http_error(response)
-
-                results = self._parse(response.json())
-                if len(results) == 0:
-                    break
-
-                all_results.extend(results)
-
-                # 按时间倒序存放每小时的funding rate，最后一行才是最老的
-                first_time = results[-1]["timestamp"]
-                print(
-                    f"downloaded DYDX[{self.market}] {len(results)} {self.data_type} {first_time} ~ {end_time}"
-                )
-
-                await asyncio.sleep(SLEEP_SECONDS)
-                end_time = first_time - timedelta(seconds=1)
-
-        df = pd.DataFrame(all_results)
-        df.set_index("timestamp", inplace=True)
-        return df
+            return await self.fetch(client, start_time, end_time, TokenBucket(rate=1 / SLEEP_SECONDS))
 
 
 class FundRateDownloader(DownloaderBase):
@@ -73,21 +103,19 @@ class FundRateDownloader(DownloaderBase):
         return {"effectiveBeforeOrAt": end_time.strftime(UTC_TM_FORMAT)}
 
     def _parse(self, json: dict):
-        return [
-            {
-                "timestamp": truncate_to_hour(r["effectiveAt"]),
-                "fund_rate": r["rate"],
-                # https://dydxprotocol.github.io/v3-teacher/#funding-payment-calculation
-                # 所谓的price，即oracle price，参与计算funding payment
-                "mark_price": r["price"],
-            }
-            for r in json["historicalFunding"]
-        ]
+        records = json["historicalFunding"]
+        return {
+            "timestamp": [truncate_to_hour(r["effectiveAt"]) for r in records],
+            "fund_rate": [r["rate"] for r in records],
+            # https://dydxprotocol.github.io/v3-teacher/#funding-payment-calculation
+            # 所谓的price，即oracle price，参与计算funding payment
+            "mark_price": [r["price"] for r in records],
+        }
 
 
 class CandleDownloader(DownloaderBase):
-    """ https://dydxprotocol.github.io/v3-teacher/#get-candles-for-market
-    """
+    """https://dydxprotocol.github.io/v3-teacher/#get-candles-for-market"""
+
     def __init__(self, market: str) -> None:
         super().__init__(market, "Candle")
 
@@ -98,30 +126,24 @@ class CandleDownloader(DownloaderBase):
         return {"toISO": end_time.strftime(UTC_TM_FORMAT), "resolution": "1HOUR"}
 
     def _parse(self, json: dict):
-        return [
-            {
-                "timestamp": truncate_to_hour(r["startedAt"]),
-                "open_price": r["open"],
-                "close_price": r["close"],
-            }
-            for r in json["candles"]
-        ]
+        records = json["candles"]
+        return {
+            "timestamp": [truncate_to_hour(r["startedAt"]) for r in records],
+            "open_price": [r["open"] for r in records],
+            "close_price": [r["close"] for r in records],
+        }
 
 
 async def __main__(market: str, start_time: datetime, end_time: datetime):
-    fundrate_downloader = FundRateDownloader(market)
-    df_fundrates = await fundrate_downloader.download(start_time=start_time, end_time=end_time)
-
-    await asyncio.sleep(SLEEP_SECONDS)
-
-    candle_downloader = CandleDownloader(market)
-    df_candles = await candle_downloader.download(start_time=start_time, end_time=end_time)
-
-    df = df_fundrates.join(df_candles, how="outer")
-    df.sort_index(inplace=True)
-
-    outfname = safe_output_path(raw_data_file('dydx',market))
-    df.to_csv(outfname, index_label="timestamp", date_format="%Y-%m-%d %H:%M:%S")
+    # FundRate和Candle同时下载，共享一个client和限速器
+    limiter = TokenBucket(rate=1 / SLEEP_SECONDS)
+    async with httpx.AsyncClient() as client:
+        df_fundrates, df_candles = await asyncio.gather(
+            FundRateDownloader(market).fetch(client, start_time, end_time, limiter),
+            CandleDownloader(market).fetch(client, start_time, end_time, limiter),
+        )
+
+    save_raw_data("dydx", market, df_fundrates, df_candles)
 
 
 def main(market: str, start_day: datetime, end_day: datetime):
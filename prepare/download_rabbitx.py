@@ -3,7 +3,15 @@ import httpx
 import pandas as pd
 from datetime import timezone, datetime, time
 import typer
-from prepare.common import safe_output_path, check_http_error, raw_data_file
+from prepare.common import (
+    SHARD_DAYS,
+    TimeShard,
+    TokenBucket,
+    check_http_error,
+    fetch_shards,
+    save_raw_data,
+    time_shards,
+)
 from pprint import pprint
 
 MICRO_PER_SECOND = 1000000
@@ -23,6 +31,8 @@ class DownloaderBase:
     def __init__(self, market: str, data_type: str) -> None:
         self.market = market
         self.data_type = data_type
+        # 各个时间段的下载进度（cursor是下一页的起始时间，单位microsecond），下载中途失败时保留，再次fetch只从断点继续
+        self._shards: list[TimeShard] = None
 
     def _url(self) -> str:
         raise NotImplementedError()
@@ -30,38 +40,54 @@ class DownloaderBase:
     def _params(self, start_micro_sec: int, end_micro_sec: int) -> dict:
         raise NotImplementedError()
 
-    def _parse(self, json: dict):
+    def _parse(self, json: dict) -> dict[str, list]:
+        """返回按列存放的数据，按时间正序"""
         raise NotImplementedError()
 
-    async def download(self, start_time: datetime, end_time: datetime):
-        start_micro_sec = datetime_to_microsec(start_time)
-        end_micro_sec = datetime_to_microsec(end_time)
+    async def __fetch_shard(self, client: httpx.AsyncClient, shard: TimeShard, limiter: TokenBucket):
+        end_micro_sec = datetime_to_microsec(shard.end)
+        if shard.cursor is None:
+            shard.cursor = datetime_to_microsec(shard.start)
+
+        while shard.cursor < end_micro_sec:
+            await limiter.acquire()
+            params = self._params(start_micro_sec=shard.cursor, end_micro_sec=end_micro_sec)
+            response = await client.get(self._url(), params=params)
+            check_http_error(response)
+
+            columns = self._parse(response.json())
+            timestamps = columns["timestamp"]
+            if len(timestamps) == 0:
+                break
+
+            print(
+                f"downloaded Rabbitx[{self.market}] {len(timestamps)} "
+                f"{self.data_type} {timestamps[0]} ~ {timestamps[-1]}"
+            )
+
+            # 最后一页会越过shard的end，越过的部分属于后一个shard，丢弃；最后一个shard保留越过的部分，与不分段时相同
+            stop = None if shard.is_last else sum(t < shard.end for t in timestamps)
+            shard.rows.extend(columns, stop)
+            shard.cursor = datetime_to_microsec(timestamps[-1]) + MICRO_PER_SECOND * 3600
+
+        shard.done = True
+
+    async def fetch(
+        self,
+        client: httpx.AsyncClient,
+        start_time: datetime,
+        end_time: datetime,
+        limiter: TokenBucket,
+        shard_days: int = SHARD_DAYS,
+    ) -> pd.DataFrame:
+        """把[start_time, end_time]按shard_days天切分成相互独立的时间段，并发分页下载，总的请求频率由limiter限制"""
+        if self._shards is None:
+            self._shards = time_shards(start_time, end_time, shard_days)
+        return await fetch_shards(self._shards, lambda shard: self.__fetch_shard(client, shard, limiter))
 
-        all_results = []
+    async def download(self, start_time: datetime, end_time: datetime):
         async with httpx.AsyncClient() as client:
-            while start_micro_sec < end_micro_sec:
-                params = self._params(start_micro_sec=start_micro_sec, end_micro_sec=end_micro_sec)
-                response = await client.get(self._url(), params=params)
-                check_http_error(response)
-
-                batch_results = self._parse(response.json())
-                if len(batch_results) == 0:
-                    break
-
-                print(
-                    f"downloaded Rabbitx[{self.market}] {len(batch_results)} "
-                    f"{self.data_type} {batch_results[0]['timestamp']} ~ {batch_results[-1]['timestamp']}"
-                )
-
-                all_results.extend(batch_results)
-                await asyncio.sleep(SLEEP_SECONDS)
-                start_micro_sec = (
-                    datetime_to_microsec(batch_results[-1]["timestamp"]) + MICRO_PER_SECOND * 3600
-                )
-
-        df = pd.DataFrame(all_results)
-        df.set_index("timestamp", inplace=True)
-        return df
+            return await self.fetch(client, start_time, end_time, TokenBucket(rate=1 / SLEEP_SECONDS))
 
 
 class FundRateDownloader(DownloaderBase):
@@ -75,16 +101,17 @@ class FundRateDownloader(DownloaderBase):
         return {"market_id": self.market, "p_limit": 1000, "start_time": start_micro_sec, "p_order": "ASC"}
 
     def _parse(self, json: dict):
-        batch_results = []
-
-        for r in json["result"]:
-            rate = float(r["funding_rate"])
-            dt = microsec_to_datetime(r["timestamp"])
+        records = json["result"]
+        return {
             # 防止有误差导致小时之外还有数字
-            effectiveAt = dt.replace(minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
-            batch_results.append({"timestamp": effectiveAt, "fund_rate": rate})
-
-        return batch_results
+            "timestamp": [
+                microsec_to_datetime(r["timestamp"]).replace(
+                    minute=0, second=0, microsecond=0, tzinfo=timezone.utc
+                )
+                for r in records
+            ],
+            "fund_rate": [float(r["funding_rate"]) for r in records],
+        }
 
 
 class CandleDownloader(DownloaderBase):
@@ -104,35 +131,27 @@ class CandleDownloader(DownloaderBase):
         }
 
     def _parse(self, json: dict):
-        batch_results = [
-            {
-                "timestamp": datetime.fromtimestamp(r["time"], tz=timezone.utc),
-                "open_price": float(r["open"]),
-                "close_price": float(r["close"]),
-            }
-            for r in json["result"]
-        ]
         # !!! rabbitx的API极其混乱，
         # 第一：Candle数据又是逆序的了，为了与框架兼容，这里要重新sort
         # 第二：这个API居然自作主张地替我fill missing了，如果我要求了未来数据，它自动将它们填充成last valid数据
-        batch_results.sort(key=lambda t: t["timestamp"])
-        return batch_results
+        records = sorted(json["result"], key=lambda r: r["time"])
+        return {
+            "timestamp": [datetime.fromtimestamp(r["time"], tz=timezone.utc) for r in records],
+            "open_price": [float(r["open"]) for r in records],
+            "close_price": [float(r["close"]) for r in records],
+        }
 
 
 async def __main__(market: str, start_time: datetime, end_time: datetime):
-    fundrate_downloader = FundRateDownloader(market)
-    df_fundrates = await fundrate_downloader.download(start_time=start_time, end_time=end_time)
-
-    await asyncio.sleep(SLEEP_SECONDS)
-
-    candle_downloader = CandleDownloader(market)
-    df_candles = await candle_downloader.download(start_time=start_time, end_time=end_time)
-
-    df = df_fundrates.join(df_candles, how="outer")
-    df.sort_index(inplace=True)
-
-    outfname = safe_output_path(raw_data_file("rabbitx", market))
-    df.to_csv(outfname, index_label="timestamp", date_format="%Y-%m-%d %H:%M:%S")
+    # FundRate和Candle同时下载，共享一个client和限速器
+    limiter = TokenBucket(rate=1 / SLEEP_SECONDS)
+    async with httpx.AsyncClient() as client:
+        df_fundrates, df_candles = await asyncio.gather(
+            FundRateDownloader(market).fetch(client, start_time, end_time, limiter),
+            CandleDownloader(market).fetch(client, start_time, end_time, limiter),
+        )
+
+    save_raw_data("rabbitx", market, df_fundrates, df_candles)
 
 
 def main(market: str, start_day: datetime, end_day: datetime):
@@ -1,88 +1,211 @@
-import subprocess
-from datetime import datetime, time, timezone
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time
+from pathlib import Path
+import httpx
 import pandas as pd
 import typer
-from prepare.common import raw_data_file, safe_output_path
-from time import sleep
+from prepare import download_dydx, download_rabbitx
+from prepare.common import SHARD_DAYS, TokenBucket
+from prepare.raw_store import RawStore
+from simulator.dataset import PartitionedDataset
+
+# exchange -> (FundRateDownloader, CandleDownloader)
+DOWNLOADERS = {
+    "dydx": (download_dydx.FundRateDownloader, download_dydx.CandleDownloader),
+    "rabbitx": (download_rabbitx.FundRateDownloader, download_rabbitx.CandleDownloader),
+}
+# exchange -> 每秒最多的请求数，该exchange上所有并发的下载共享
+RATE_LIMITS = {"dydx": 1 / download_dydx.SLEEP_SECONDS, "rabbitx": 1 / download_rabbitx.SLEEP_SECONDS}
+# 回测输入的列
+INPUT_COLUMNS = ["fund_rate", "mark_price", "open_price", "close_price"]
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 0.5
 
-SLEEP_SECONDS = 0.5
 
 class PrepareJob:
-    def __init__(self, exchanges: str, coins: str, start_dt: datetime, end_dt: datetime) -> None:
+    def __init__(
+        self,
+        exchanges: str,
+        coins: str,
+        start_dt: datetime,
+        end_dt: datetime,
+        max_concurrency: int = 4,
+        shard_days: int = SHARD_DAYS,
+        transport: httpx.AsyncBaseTransport = None,
+        store: RawStore = None,
+        rate_limits: dict[str, float] = None,
+    ) -> None:
+        """
+        - max_concurrency: 同时进行的exchange×market下载任务数
+        - shard_days: 每个下载任务内部按shard_days天切分，各段并发分页
+        - transport: 所有httpx client使用的transport，默认直接访问网络
+        - store: 原始数据的存储，只下载其中还没有的时间段，默认是data/raw
+        - rate_limits: exchange -> 每秒最多的请求数，默认是RATE_LIMITS
+        """
         self.__exchanges = [s.strip() for s in exchanges.split(",")]
         self.__markets = [s.strip().upper() + "-USD" for s in coins.split(",")]
         self.__start_dt = start_dt
         self.__end_dt = end_dt
         self.__datetime_index = None
-        self.__failed_commands = []
+        self.__failed_jobs = []
+        self.__max_concurrency = max_concurrency
+        self.__shard_days = shard_days
+        self.__transport = transport
+        self.__store = store or RawStore()
+        self.__rate_limits = rate_limits or RATE_LIMITS
+
+    def __time_range(self) -> tuple[pd.Timestamp, pd.Timestamp]:
+        """[start_dt当天0点, end_dt次日0点)"""
+        start = pd.Timestamp(datetime.combine(self.__start_dt.date(), time()), tz="UTC")
+        return start, pd.Timestamp(datetime.combine(self.__end_dt.date(), time()), tz="UTC") + pd.Timedelta(
+            days=1
+        )
 
-    def __download(self, exchange: str, market: str, start_dt: str, end_dt: str):
-        command = ["python", "-m", f"prepare.download_{exchange}", market, start_dt, end_dt]
-        cmd_line = " ".join(command)
+    async def __fetch(
+        self,
+        downloader,
+        client: httpx.AsyncClient,
+        limiter: TokenBucket,
+        start: pd.Timestamp,
+        end: pd.Timestamp,
+    ) -> pd.DataFrame:
+        """下载[start, end)"""
+        start_time = start.to_pydatetime()
+        end_time = (end - pd.Timedelta(seconds=1)).to_pydatetime()
 
         try_counter = 1
-        while try_counter <= 5:  # 有时会发生connetion issue，重试一次
-            print(f"\n------ [{try_counter}] {cmd_line}")
-
-            proc = subprocess.run(command)
-            if proc.returncode == 0:
-                typer.echo(
-                    typer.style(f"++++++ [SUCCESS] {cmd_line}", fg=typer.colors.BRIGHT_GREEN, bold=True)
+        while True:
+            try:
+                # 同一个downloader重试时从上次下载到的页继续，不会从头下载
+                return await downloader.fetch(client, start_time, end_time, limiter, self.__shard_days)
+            except Exception as error:  # 有时会发生connection issue
+                if try_counter >= MAX_RETRIES:
+                    raise
+                delay = BACKOFF_SECONDS * 2 ** (try_counter - 1)
+                print(
+                    f"------ [{try_counter}] {downloader.data_type}@{downloader.market} failed: {error!r}"
                 )
-                return
-
-            try_counter += 1
-            sleep(SLEEP_SECONDS)
+                try_counter += 1
+                await asyncio.sleep(delay)
+
+    async def __fetch_gap(
+        self,
+        exchange: str,
+        downloader_cls,
+        market: str,
+        client: httpx.AsyncClient,
+        limiter: TokenBucket,
+        gap: tuple[pd.Timestamp, pd.Timestamp],
+    ):
+        downloader = downloader_cls(market)
+        df = await self.__fetch(downloader, client, limiter, *gap)
+        # 每个区间下载成功后立即存盘，其他区间失败时已下载的部分也不会丢
+        self.__store.append(exchange, market, downloader.data_type, df, *gap)
+
+    async def __download(
+        self, exchange: str, market: str, client: httpx.AsyncClient, limiter: TokenBucket, semaphore
+    ):
+        job_name = f"{market}@{exchange}"
+        start, end = self.__time_range()
+        gaps = [
+            (downloader_cls, gap)
+            for downloader_cls in DOWNLOADERS[exchange]
+            for gap in self.__store.missing(exchange, market, downloader_cls(market).data_type, start, end)
+        ]
+        if len(gaps) == 0:
+            typer.echo(typer.style(f"++++++ [CACHED] {job_name}", fg=typer.colors.BRIGHT_GREEN, bold=True))
+            return
+
+        async with semaphore:
+            # FundRate和Candle的所有缺失区间同时下载
+            results = await asyncio.gather(
+                *(self.__fetch_gap(exchange, cls, market, client, limiter, gap) for cls, gap in gaps),
+                return_exceptions=True,
+            )
+        if any(isinstance(result, BaseException) for result in results):
+            typer.echo(typer.style(f"!!!!!! [FAIL] {job_name}", fg=typer.colors.BRIGHT_RED, bold=True))
+            self.__failed_jobs.append(job_name)
+            return
+
+        typer.echo(
+            typer.style(
+                f"++++++ [SUCCESS] {job_name} {len(gaps)} gaps", fg=typer.colors.BRIGHT_GREEN, bold=True
+            )
+        )
 
-        typer.echo(typer.style(f"!!!!!! [FAIL] {cmd_line}", fg=typer.colors.BRIGHT_RED, bold=True))
-        self.__failed_commands.append(cmd_line)
+    async def __download_all(self):
+        semaphore = asyncio.Semaphore(self.__max_concurrency)
+        # 每个exchange一个连接池复用的client和一个限速器
+        clients = {ex: httpx.AsyncClient(transport=self.__transport) for ex in self.__exchanges}
+        limiters = {ex: TokenBucket(rate=self.__rate_limits[ex]) for ex in self.__exchanges}
+        try:
+            await asyncio.gather(
+                *(
+                    self.__download(exchange, market, clients[exchange], limiters[exchange], semaphore)
+                    for market in self.__markets
+                    for exchange in self.__exchanges
+                )
+            )
+        finally:
+            for client in clients.values():
+                await client.aclose()
 
     def download(self):
+        asyncio.run(self.__download_all())
 
-        for market in self.__markets:
-            for exchange in self.__exchanges:
-                self.__download(
-                    exchange=exchange,
-                    market=market,
-                    start_dt=self.__start_dt.strftime("%Y-%m-%d"),
-                    end_dt=self.__end_dt.strftime("%Y-%m-%d"),
-                )
-                sleep(SLEEP_SECONDS)
+        if len(self.__failed_jobs) > 0:
+            print(f"there are {len(self.__failed_jobs)} failed jobs")
+            for idx, job_name in enumerate(self.__failed_jobs, start=1):
+                print(f"[{idx:02d}] {job_name}")
 
-        if len(self.__failed_commands) > 0:
-            print(f"there are {len(self.__failed_commands)} failed commands")
-            for idx, cmdline in enumerate(self.__failed_commands, start=1):
-                print(f"[{idx:02d}] {cmdline}")
+        return len(self.__failed_jobs) == 0
 
-        return len(self.__failed_commands) == 0
+    def __write_partition(self, dataset: PartitionedDataset, raws: dict, exchange: str, market: str, month):
+        month_index = self.__datetime_index[self.__datetime_index.to_period("M") == month]
+        data = raws[exchange].reindex(index=month_index)
+        if "mark_price" not in data.columns:
+            # 有的exchange不提供mark prices，就用dydx的mark price来代替
+            data = data.join(raws["dydx"]["mark_price"])
 
-    def postprocess(self):
+        # 保证行列都有序
+        dataset.write_partition(exchange, market, month, data.loc[:, INPUT_COLUMNS])
+
+    def postprocess(self, output_dir: str | Path = "data/input", max_workers: int = 4):
+        """把原始数据整理成按exchange/market/month分区的PartitionedDataset
+        每次只载入一个market的原始数据，这个market的各个分区并行写入
+        """
         self.__datetime_index = pd.date_range(
             start=datetime.combine(self.__start_dt.date(), time()),
             end=datetime.combine(self.__end_dt.date(), time(23, 59, 59)),
             freq="h",
         )
+        months = self.__datetime_index.to_period("M").unique()
+
+        dataset = PartitionedDataset(output_dir)
+        dataset.create(columns=INPUT_COLUMNS)
 
-        datas = {}
-        for exchange in self.__exchanges:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
             for market in self.__markets:
-                df = pd.read_csv(raw_data_file(exchange, market), index_col="timestamp", parse_dates=True)
-                datas[(exchange, market)] = df.reindex(index=self.__datetime_index)
-
-        # 最后一部分的文件名xxx.csv是占位符，整个操作就是保证data/input能够被正确创建
-        safe_output_path("data/input/xxx.csv")
-
-        for (exchange, market), data in datas.items():
-            if "mark_price" not in data.columns:
-                # 有的exchange不提供mark prices，就用dydx的mark price来代替
-                mark_price = datas[("dydx", market)]["mark_price"]
-                data = data.join(mark_price)
-
-            # 保证行列都有序
-            data = data.loc[:, ["fund_rate", "mark_price", "open_price", "close_price"]]
-            data.sort_index(inplace=True)
-            data.to_csv(f"data/input/{exchange}_{market}.csv", index_label="timestamp")
-            print(f"backtest input {market}@{exchange} saved")
+                raws = {
+                    exchange: self.__store.load(
+                        exchange,
+                        market,
+                        [downloader_cls(market).data_type for downloader_cls in DOWNLOADERS[exchange]],
+                    )
+                    for exchange in self.__exchanges
+                }
+                if "dydx" not in raws:
+                    raws["dydx"] = self.__store.load("dydx", market, ["FundRate"])
+
+                futures = [
+                    executor.submit(self.__write_partition, dataset, raws, exchange, market, month)
+                    for exchange in self.__exchanges
+                    for month in months
+                ]
+                for future in futures:
+                    future.result()
+                print(f"backtest input {market} saved")
 
 
 def main(exchanges: str, coins: str, start_dt: datetime, end_dt: datetime):
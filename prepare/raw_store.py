@@ -0,0 +1,136 @@
+import json
+import os
+import pandas as pd
+from pathlib import Path
+from prepare.common import safe_output_path
+
+
+def merge_ranges(
+    ranges: list[tuple[pd.Timestamp, pd.Timestamp]],
+) -> list[tuple[pd.Timestamp, pd.Timestamp]]:
+    """合并重叠或相邻的[start, end)区间，返回按时间排序的不相交区间"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def missing_ranges(
+    covered: list[tuple[pd.Timestamp, pd.Timestamp]], start: pd.Timestamp, end: pd.Timestamp
+) -> list[tuple[pd.Timestamp, pd.Timestamp]]:
+    """[start, end)中没有被covered覆盖的部分"""
+    gaps = []
+    cursor = start
+    for covered_start, covered_end in merge_ranges(covered):
+        if covered_end <= cursor:
+            continue
+        if covered_start >= end:
+            break
+        if covered_start > cursor:
+            gaps.append((cursor, covered_start))
+        cursor = max(cursor, covered_end)
+    if cursor < end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+class RawStore:
+    """增量的原始数据存储
+    - 每个exchange/market/data type一个csv文件，新下载的数据只追加到文件末尾，不重写整个文件
+    - coverage.json记录每个文件已经覆盖的小时区间[start, end)，请求新的时间段时只下载没有覆盖的部分
+    - 区间内交易所本来就没有数据的小时也算已覆盖，不会重复请求；但尚未结束的小时不算覆盖
+    """
+
+    def __init__(self, root: str | Path = "data/raw") -> None:
+        self.__root = Path(root)
+        self.__manifest_file = self.__root / "coverage.json"
+        if self.__manifest_file.exists():
+            with open(self.__manifest_file) as fin:
+                manifest = json.load(fin)
+        else:
+            manifest = {}
+        # key -> 已覆盖的区间
+        self.__coverage: dict[str, list[tuple[pd.Timestamp, pd.Timestamp]]] = {
+            key: [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in ranges]
+            for key, ranges in manifest.items()
+        }
+
+    @staticmethod
+    def __key(exchange: str, market: str, data_type: str) -> str:
+        return f"{exchange}_{market}_{data_type}"
+
+    def data_file(self, exchange: str, market: str, data_type: str) -> Path:
+        return self.__root / f"{self.__key(exchange, market, data_type)}.csv"
+
+    def coverage(
+        self, exchange: str, market: str, data_type: str
+    ) -> list[tuple[pd.Timestamp, pd.Timestamp]]:
+        return list(self.__coverage.get(self.__key(exchange, market, data_type), []))
+
+    def missing(
+        self, exchange: str, market: str, data_type: str, start: pd.Timestamp, end: pd.Timestamp
+    ) -> list[tuple[pd.Timestamp, pd.Timestamp]]:
+        """[start, end)中需要下载的小时区间"""
+        return missing_ranges(self.coverage(exchange, market, data_type), start, end)
+
+    def append(
+        self,
+        exchange: str,
+        market: str,
+        data_type: str,
+        df: pd.DataFrame,
+        start: pd.Timestamp,
+        end: pd.Timestamp,
+    ):
+        """追加[start, end)的下载结果，并记录这个区间已覆盖
+        下载的最后一页可能越过区间的边界，越过的部分已经在存储中（或者属于别的区间），丢弃
+        """
+        df = df.loc[(df.index >= start) & (df.index < end)]
+        if len(df) > 0:
+            outfname = safe_output_path(self.data_file(exchange, market, data_type))
+            df.to_csv(
+                outfname,
+                mode="a",
+                header=not outfname.exists(),
+                index_label="timestamp",
+                date_format="%Y-%m-%d %H:%M:%S",
+            )
+
+        # 尚未结束的小时以后还可能有数据
+        end = min(end, pd.Timestamp.now(tz="UTC").floor("h"))
+        if start < end:
+            key = self.__key(exchange, market, data_type)
+            self.__coverage[key] = merge_ranges(self.__coverage.get(key, []) + [(start, end)])
+            self.__save_manifest()
+
+    def __save_manifest(self):
+        manifest = {
+            key: [[start.isoformat(), end.isoformat()] for start, end in ranges]
+            for key, ranges in self.__coverage.items()
+        }
+        # 先写临时文件再替换，中途退出不会损坏manifest
+        tmp_file = safe_output_path(self.__manifest_file.with_suffix(".tmp"))
+        with open(tmp_file, "w") as fout:
+            json.dump(manifest, fout, indent=1)
+        os.replace(tmp_file, self.__manifest_file)
+
+    def load(self, exchange: str, market: str, data_types: list[str]) -> pd.DataFrame:
+        """合并各个data type的数据，按时间排序；同一个小时被追加过多次时以最后一次为准"""
+        frames = []
+        for data_type in data_types:
+            data_file = self.data_file(exchange, market, data_type)
+            if not data_file.exists():
+                continue
+            df = pd.read_csv(data_file, index_col="timestamp", parse_dates=True)
+            frames.append(df.loc[~df.index.duplicated(keep="last")])
+
+        if len(frames) == 0:
+            raise FileNotFoundError(f"no raw data for {market}@{exchange}")
+        df = frames[0]
+        for other in frames[1:]:
+            df = df.join(other, how="outer")
+        df.sort_index(inplace=True)
+        return df
@@ -0,0 +1,198 @@
+import httpx
+import numpy as np
+import pandas as pd
+import typer
+from datetime import datetime
+from pathlib import Path
+from prepare.common import UTC_TM_FORMAT, safe_output_path
+from simulator.data_feeds import FIELDS
+from simulator.dataset import PartitionedDataset
+
+
+def ar1(rng: np.random.Generator, size: int, phi: float, sigma: float) -> np.ndarray:
+    """平稳分布的标准差为sigma的AR(1)序列"""
+    shocks = rng.normal(0, sigma * np.sqrt(1 - phi**2), size=size)
+    values = np.empty(size)
+    last = rng.normal(0, sigma)
+    for idx in range(size):
+        last = phi * last + shocks[idx]
+        values[idx] = last
+    return values
+
+
+def regime_levels(rng: np.random.Generator, size: int, levels: list[float], stay_prob: float) -> np.ndarray:
+    """马尔可夫链决定的水平：每个bar以1-stay_prob的概率重新随机选择一个regime，平均持续1/(1-stay_prob)个bar"""
+    switches = rng.random(size) > stay_prob
+    switches[0] = True
+    draws = rng.integers(0, len(levels), size=size)
+    # 每个bar所在regime的起点，向前填充
+    last_switch = np.maximum.accumulate(np.where(switches, np.arange(size), 0))
+    return np.asarray(levels)[draws[last_switch]]
+
+
+# funding rate的regime：平静、多头拥挤（正费率）、空头拥挤（负费率），小时费率
+FUNDING_REGIMES = [0.0, 6e-5, -4e-5]
+
+
+def synthetic_block(
+    n_exchanges: int,
+    n_markets: int,
+    hours: int,
+    start: str = "2024-01-01",
+    seed: int = 0,
+    regimes: bool = False,
+) -> tuple[np.ndarray, np.ndarray]:
+    """生成与DataFeeds相同布局的数据块
+    价格是random walk，各exchange在同一个market上围绕同一个价格小幅波动；
+    funding rate围绕各exchange自己的均值做AR(1)波动，与真实数据一样有持续性；
+    regimes=True时再叠加各exchange独立切换的regime（见FUNDING_REGIMES），制造持续一段时间的大费率差
+    Returns:
+        - timestamps: datetime64[ns], shape=(time,)
+        - values: shape=(time, market, exchange, field)，field的顺序见FIELDS
+    """
+    rng = np.random.default_rng(seed)
+    timestamps = pd.date_range(start=start, periods=hours, freq="h").to_numpy(dtype="datetime64[ns]")
+
+    values = np.empty((hours, n_markets, n_exchanges, len(FIELDS)))
+    for midx in range(n_markets):
+        base_price = 100 * np.exp(np.cumsum(rng.normal(0, 0.005, size=hours)))
+
+        for eidx in range(n_exchanges):
+            close_price = base_price * (1 + rng.normal(0, 0.0005, size=hours))
+            columns = {
+                "open_price": np.concatenate([[base_price[0]], close_price[:-1]]),
+                "close_price": close_price,
+                "mark_price": base_price * (1 + rng.normal(0, 0.0002, size=hours)),
+                "fund_rate": rng.normal(0, 1e-5) + ar1(rng, hours, phi=0.95, sigma=2e-5),
+            }
+            if regimes:
+                columns["fund_rate"] += regime_levels(rng, hours, FUNDING_REGIMES, stay_prob=0.995)
+            for fidx, col in enumerate(FIELDS):
+                values[:, midx, eidx, fidx] = columns[col]
+
+    return timestamps, values
+
+
+def make_synthetic_inputs(
+    data_dir: Path | str,
+    exchanges: list[str],
+    markets: list[str],
+    hours: int,
+    start: str = "2024-01-01",
+    seed: int = 0,
+    dataset: bool = False,
+    regimes: bool = False,
+):
+    """生成回测输入，dataset=True时与PrepareJob.postprocess相同，是按月分区的PartitionedDataset；
+    否则每个exchange x market一个{data_dir}/{exchange}_{market}.csv
+    """
+    data_dir = Path(data_dir)
+    timestamps, values = synthetic_block(
+        len(exchanges), len(markets), hours=hours, start=start, seed=seed, regimes=regimes
+    )
+    index = pd.DatetimeIndex(timestamps, name="timestamp")
+    columns = ["fund_rate", "mark_price", "open_price", "close_price"]
+    if dataset:
+        partitioned = PartitionedDataset(data_dir)
+        partitioned.create(columns=columns)
+
+    for midx, market in enumerate(markets):
+        for eidx, ex in enumerate(exchanges):
+            df = pd.DataFrame(values[:, midx, eidx, :], index=index, columns=FIELDS)
+            df = df.loc[:, columns]
+            if dataset:
+                partitioned.write(ex, market, df)
+            else:
+                outfname = safe_output_path(data_dir / f"{ex}_{market}.csv")
+                df.to_csv(outfname, index_label="timestamp")
+
+
+class SyntheticExchangeApi:
+    """模拟dydx和rabbitx的分页API，[first, last)之间每小时一条数据，可以作为httpx.MockTransport的handler
+    - page_size: 每页最多返回的条数
+    - fail_every: 每fail_every个请求返回一次500，用于测试重试
+    """
+
+    def __init__(
+        self, first: str = "2024-01-01", last: str = "2024-01-11", page_size: int = 100, fail_every: int = 0
+    ) -> None:
+        self.first = pd.Timestamp(first, tz="UTC")
+        self.last = pd.Timestamp(last, tz="UTC")
+        self.page_size = page_size
+        self.fail_every = fail_every
+        self.requests = 0
+        self.failures = 0
+
+    def __hours(self, start: pd.Timestamp, end: pd.Timestamp) -> pd.DatetimeIndex:
+        hours = pd.date_range(start.ceil("h"), end.floor("h"), freq="h")
+        return hours[(hours >= self.first) & (hours < self.last)]
+
+    @staticmethod
+    def __rate(t: pd.Timestamp) -> str:
+        return f"{(t.value // 3600_000_000_000 % 7 - 3) * 1e-5:.8f}"
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        status, payload = self.respond(request.url.path, request.url.params)
+        return httpx.Response(status, json=payload)
+
+    def respond(self, path: str, params) -> tuple[int, dict]:
+        self.requests += 1
+        if self.fail_every and self.requests % self.fail_every == 0:
+            self.failures += 1
+            return 500, {"error": "injected"}
+
+        page = pd.Timedelta(hours=self.page_size - 1)
+        if path.startswith("/v3/historical-funding/"):
+            end = pd.Timestamp(datetime.strptime(params["effectiveBeforeOrAt"], UTC_TM_FORMAT), tz="UTC")
+            items = [
+                {"effectiveAt": t.strftime(UTC_TM_FORMAT), "rate": self.__rate(t), "price": "100"}
+                for t in self.__hours(end - page, end)[::-1]
+            ]
+            return 200, {"historicalFunding": items}
+        if path.startswith("/v3/candles/"):
+            end = pd.Timestamp(datetime.strptime(params["toISO"], UTC_TM_FORMAT), tz="UTC")
+            items = [
+                {"startedAt": t.strftime(UTC_TM_FORMAT), "open": "100", "close": "101"}
+                for t in self.__hours(end - page, end)[::-1]
+            ]
+            return 200, {"candles": items}
+        if path == "/markets/fundingrate":
+            start = pd.Timestamp(int(params["start_time"]), unit="us", tz="UTC")
+            items = [
+                {"timestamp": t.value // 1000, "funding_rate": self.__rate(t)}
+                for t in self.__hours(start, start + page)
+            ]
+            return 200, {"result": items}
+        if path == "/candles":
+            start = pd.Timestamp(int(params["timestamp_from"]), unit="s", tz="UTC")
+            end = pd.Timestamp(int(params["timestamp_to"]), unit="s", tz="UTC")
+            items = [
+                {"time": t.value // 10**9, "open": "100", "close": "101"}
+                for t in self.__hours(start, end)[: self.page_size][::-1]
+            ]
+            return 200, {"result": items}
+        return 404, {"error": path}
+
+
+def main(
+    exchanges: str,
+    coins: str,
+    hours: int,
+    data_dir: str = "data/synthetic",
+    seed: int = 0,
+    dataset: bool = False,
+    regimes: bool = False,
+):
+    make_synthetic_inputs(
+        data_dir=data_dir,
+        exchanges=[s.strip() for s in exchanges.split(",")],
+        markets=[s.strip().upper() + "-USD" for s in coins.split(",")],
+        hours=hours,
+        seed=seed,
+        dataset=dataset,
+        regimes=regimes,
+    )
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,88 @@
+import asyncio
+import hashlib
+import json
+import random
+import httpx
+from pathlib import Path
+from prepare.common import safe_output_path
+
+
+def request_key(request: httpx.Request) -> str:
+    """同一个请求（参数顺序无关）得到同一个key"""
+    url = request.url.copy_with(params=sorted(request.url.params.multi_items()))
+    return hashlib.sha1(f"{request.method} {url}".encode()).hexdigest()
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """把经过的每个请求的响应存到cassette目录中，每个请求一个json文件，同一个请求重复时以最后一次为准"""
+
+    def __init__(self, cassette_dir: str | Path, inner: httpx.AsyncBaseTransport = None) -> None:
+        self.__cassette_dir = Path(cassette_dir)
+        self.__inner = inner or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self.__inner.handle_async_request(request)
+        # 读出解压之后的内容，返回新的response，不再带content-encoding
+        body = await response.aread()
+        await response.aclose()
+        content_type = response.headers.get("content-type", "application/json")
+
+        record = {
+            "method": request.method,
+            "url": str(request.url),
+            "status_code": response.status_code,
+            "content_type": content_type,
+            "body": body.decode(),
+        }
+        outfname = safe_output_path(self.__cassette_dir / f"{request_key(request)}.json")
+        with open(outfname, "w") as fout:
+            json.dump(record, fout)
+
+        return httpx.Response(response.status_code, headers={"content-type": content_type}, content=body)
+
+    async def aclose(self) -> None:
+        await self.__inner.aclose()
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """从cassette目录回放录制的响应，不访问网络
+    - latency: 每个请求固定的延迟（秒），模拟网络往返
+    - error_rate: 按这个概率返回503而不是录制的响应，用于测试重试；seed固定时注入的错误序列可重复
+    没有录制过的请求抛出KeyError
+    """
+
+    def __init__(
+        self, cassette_dir: str | Path, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0
+    ):
+        self.__latency = latency
+        self.__error_rate = error_rate
+        self.__rng = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+
+        self.__records: dict[str, dict] = {}
+        for fname in Path(cassette_dir).glob("*.json"):
+            with open(fname) as fin:
+                self.__records[fname.stem] = json.load(fin)
+
+    def __len__(self):
+        return len(self.__records)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        if self.__latency > 0:
+            await asyncio.sleep(self.__latency)
+
+        if self.__error_rate > 0 and self.__rng.random() < self.__error_rate:
+            self.errors += 1
+            return httpx.Response(503, json={"error": "injected by ReplayTransport"})
+
+        key = request_key(request)
+        if key not in self.__records:
+            raise KeyError(f"no recorded response for {request.method} {request.url}")
+        record = self.__records[key]
+        return httpx.Response(
+            record["status_code"],
+            headers={"content-type": record["content_type"]},
+            content=record["body"].encode(),
+        )
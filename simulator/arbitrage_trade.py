@@ -1,18 +1,10 @@
-from simulator.exchange import Exchange, MarginCall, PerpsAccount
-from simulator.utils import Config, hfr2a
-from dataclasses import dataclass
+from simulator.exchange import Exchange, MarginCall, transaction
+from simulator.utils import Config
 from datetime import datetime
 from copy import copy
 import logging
 
 
-@dataclass
-class BackupOrder:
-    account: PerpsAccount
-    has_init_account: bool
-    cash: float
-
-
 class Order:
     def __init__(self, market: str, exchange: Exchange, is_long: int, slippage: float) -> None:
         self._market = market
@@ -26,18 +18,20 @@ class Order:
         return self._exchange.name
 
     @property
-    def backup(self) -> BackupOrder:
-        return BackupOrder(
-            account=copy(self._exchange.get_account(self._market)),
-            has_init_account=self._init_account is not None,
-            cash=self._exchange.cash,
-        )
+    def is_long(self) -> int:
+        return self._is_long
+
+    @property
+    def exchange(self) -> Exchange:
+        return self._exchange
 
-    def restore(self, backup: BackupOrder) -> None:
-        self._exchange.set_account(self._market, backup.account)
-        self._exchange.cash = backup.cash
-        if not backup.has_init_account:
-            self._init_account = None
+    @property
+    def market(self) -> str:
+        return self._market
+
+    def reset(self) -> None:
+        """首次开仓被回滚时调用，丢弃开仓前的快照"""
+        self._init_account = None
 
     def slip_price(self, price: float):
         # is_long >0，滑点使买得更昂贵
@@ -60,20 +54,24 @@ class Order:
         # 换仓也会先把原来的仓位关掉，所以可以放心clear所有仓位
         self._exchange.clear(market=self._market, price=self.slip_price(price))
 
-    def settle(self, contract_price: float, mark_price: float, funding_rate: float):
+    def settle(self, contract_price: float, mark_price: float, funding_rate: float | None):
+        """funding_rate是本次结算整个周期的费率，显式传None表示这个bar只mark to market"""
         trade_pnl, margin_diff = self._exchange.settle_trading(market=self._market, price=contract_price)
-        fund_pnl = self._exchange.settle_funding(
-            market=self._market, mark_price=mark_price, funding_rate=funding_rate
-        )
+        fund_pnl = 0.0
+        if funding_rate is not None:
+            fund_pnl = self._exchange.settle_funding(
+                market=self._market, mark_price=mark_price, funding_rate=funding_rate
+            )
 
-        logging.info(
-            f"Settle [{self._exchange.name:>8}] {'Long' if self._is_long > 0 else 'SELL'} {self._market}, "
-            f"TradePnl={trade_pnl:.4f}, MarginDiff={margin_diff:.4f}, FundPnl={fund_pnl:.4f}"
+        self._exchange.journal.settle(
+            self._exchange.journal_id,
+            self._exchange.market_id(self._market),
+            self._is_long,
+            trade_pnl,
+            margin_diff,
+            fund_pnl,
         )
 
-    def record_metrics(self, timestamp: datetime):
-        self._exchange.record_metrics(timestamp)
-
     @property
     def trade_pnl(self):
         current_account = self._exchange.get_account(self._market)
@@ -109,6 +107,11 @@ class FundingArbTrade:
     def is_active(self):
         return self.open_tm is not None and self.close_tm is None
 
+    @property
+    def orders(self) -> dict[str, Order]:
+        """direction("long" or "short") -> Order"""
+        return self._orders
+
     @property
     def name(self):
         return f"L[{self._orders['long'].ex_name}].S[{self._orders['short'].ex_name}].{self.market}"
@@ -117,14 +120,16 @@ class FundingArbTrade:
         """如果本次开仓导致margin call，回滚对账户的修改，相当于放弃本次操作
         无论long ex or short ex哪个发生margin call，两个ex都要回滚，因为只单边建仓是没有对冲的，极其危险的
         """
-        backups = {direction: order.backup for direction, order in self._orders.items()}
         try:
-            self._open(tm=tm, usd_amount=usd_amount, ex2prices=ex2prices, fundrate_diff=fundrate_diff)
+            with transaction(*(order.exchange for order in self._orders.values())):
+                self._open(tm=tm, usd_amount=usd_amount, ex2prices=ex2prices, fundrate_diff=fundrate_diff)
             return True
         except MarginCall:
-            logging.error(f"!!! Margin Call on {self.name}, Drop Open Actions")
-            for direction, order in self._orders.items():
-                order.restore(backups[direction])
+            if not self._config.silent:
+                logging.error(f"!!! Margin Call on {self.name}, Drop Open Actions")
+            if self.open_tm is None:  # 首次开仓失败，两条腿的快照都作废；加仓失败则保留原来的快照
+                for order in self._orders.values():
+                    order.reset()
             return False
 
     def _open(self, tm: datetime, usd_amount: float, ex2prices: dict[str, float], fundrate_diff: float):
@@ -175,28 +180,36 @@ class FundingArbTrade:
         short_fr = current_fundrates["short"]
         long_fr = current_fundrates["long"]
         self.latest_fundrate_diff = short_fr - long_fr
-        logging.info(
-            f"Trade[{self.name}] ASFR={hfr2a(short_fr):.2%}"
-            f", ALFR={hfr2a(long_fr):.2%}"
-            f", AFRdiff={hfr2a(self.latest_fundrate_diff):.2%}"
+
+        long_ex = self._orders["long"].exchange
+        short_ex = self._orders["short"].exchange
+        long_ex.journal.fundrate_diff(
+            long_ex.market_id(self.market), long_ex.journal_id, short_ex.journal_id, long_fr, short_fr
         )
         return self.latest_fundrate_diff
 
     def settle(
-        self, ex2prices: dict[str, float], ex2markprices: dict[str, float], ex2fundrates: dict[str, float]
+        self,
+        ex2prices: dict[str, float],
+        ex2markprices: dict[str, float],
+        ex2fundrates: dict[str, float],
+        funding_hours: dict[str, float] = None,
     ):
+        """
+        Args:
+            ex2fundrates:  exchange->小时funding rate
+            funding_hours: 本bar结算funding的exchange->结算的小时数，不在其中的exchange只mark to market
+                           None（默认）表示每个exchange都按小时结算，与原来逐bar结算相同；空dict表示只mark to market
+        """
         assert self.is_active
 
         for order in self._orders.values():
+            hours = 1.0 if funding_hours is None else funding_hours.get(order.ex_name)
             order.settle(
                 contract_price=ex2prices[order.ex_name],
                 mark_price=ex2markprices[order.ex_name],
-                funding_rate=ex2fundrates[order.ex_name],
+                funding_rate=None if hours is None else ex2fundrates[order.ex_name] * hours,
             )
 
         # latest_fundrate_diff<=0的，在settle之前就已经关闭了
         assert self.latest_fundrate_diff > 0
-
-    def record_metrics(self, timestamp: datetime):
-        for order in self._orders.values():
-            order.record_metrics(timestamp)
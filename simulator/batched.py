@@ -0,0 +1,496 @@
+import json
+import numpy as np
+import pandas as pd
+import typer
+from dataclasses import asdict
+from pathlib import Path
+from simulator.data_feeds import DataFeeds
+from simulator.exchange import Ledger
+from simulator.funding import FundingCalendar
+from simulator.metrics import metrics_period, record_mask
+from simulator.risk import RiskStatsArray, span_years
+from simulator.signals import compute_arb_signals
+from simulator.sweep import RISK_KEYS, grid_configs, random_configs
+from simulator.utils import Config
+
+# 批量回测的账户字段，与Ledger.ACCOUNT_FIELDS相同，margin_rate是每个config的参数
+ACCOUNT_FIELDS = ("long_short_shares", "hold_price", "used_margin", "trade_pnl", "fund_pnl")
+# closed_trades的列，行号和序号在closed_trades中换成时间和名字
+CLOSED_COLUMNS = ["config", "market", "long_ex", "short_ex", "open_tm", "close_tm", "trade_pnl", "fund_pnl"]
+# trade的两条腿，及开仓时的交易方向，顺序与FundingArbTrade._orders一致
+LEG_SIGNS = (1, -1)
+
+
+def _shared_key(config: Config) -> tuple:
+    """同一批的config必须相同的字段，其余字段（资金、费率、开平仓门槛等）每个config可以不同"""
+    intervals = sorted((config.funding_intervals or {}).items())
+    return (
+        config.data_dir,
+        config.exchanges,
+        config.markets,
+        config.start,
+        config.end,
+        intervals,
+        config.metrics_freq,
+    )
+
+
+class BatchedStrategy:
+    """K组Config在同一段历史上一起回测，每组的结果与单独用FundingArbStrategy回测逐位相同
+    - 账户状态是带config维的数组：cash (K, exchange)，账户字段 (K, exchange, market)，active trade (K, market)
+    - 历史只遍历一次，每个bar上的平仓、开仓、加仓、换仓和结算，都是对所有config的masked numpy运算
+    - 每一步的公式和运算顺序与Exchange/Order相同；同一exchange上不同market的现金变化，
+      按trade加入_active_arb_trades的顺序（每个config各自的dict顺序）发生
+    - 开仓时的margin call只回滚发生margin call的config；平仓和结算时的margin call，
+      与FundingArbStrategy.run抛出MarginCall一样，该config的回测失败，之后不再更新
+    """
+
+    def __init__(self, configs: list[Config], data_feeds: DataFeeds = None) -> None:
+        """data_feeds不为None时直接使用，exchanges和markets的顺序必须与config一致"""
+        base = configs[0]
+        assert all(
+            _shared_key(config) == _shared_key(base) for config in configs
+        ), "configs should share feeds"
+        assert not any(config.isolated_margin for config in configs), "isolated margin is not batched"
+        self._configs = configs
+
+        if data_feeds is None:
+            data_feeds = DataFeeds(
+                data_dir=base.data_dir,
+                exchanges=base.exchanges,
+                markets=base.markets,
+                cache_dir=base.cache_dir,
+                start=base.start,
+                end=base.end,
+            )
+        assert data_feeds.exchanges == base.exchanges and data_feeds.markets == base.markets
+        self._data_feeds = data_feeds
+
+        # 最好的套利对与门槛无关，门槛在每个bar上按config比较
+        self._long_ex, self._short_ex, self._signal_diff, self._has_pair = compute_arb_signals(
+            data_feeds.field("fund_rate"), fundrate_diff_open=0
+        )
+        calendar = FundingCalendar(base.exchanges, intervals=base.funding_intervals)
+        calendar.index(data_feeds.timestamps, data_feeds.valid)
+        # shape=(time, exchange)，结算funding的行上是结算的小时数，其余是0
+        self._funding_hours = np.stack(
+            [calendar.hours_array(ex, len(data_feeds)) for ex in base.exchanges], 1
+        )
+        self._record_mask = record_mask(data_feeds.timestamps, metrics_period(base.metrics_freq))
+
+        def param(name: str) -> np.ndarray:
+            return np.array([getattr(config, name) for config in configs], dtype=np.float64)
+
+        n_configs, n_exchanges, n_markets = len(configs), len(base.exchanges), len(base.markets)
+        self._margin_rate = param("margin_rate")
+        self._commission = param("commission")
+        self._slippage = param("slippage")
+        self._ordersize_usd = param("ordersize_usd")
+        self._diff_open = param("fundrate_diff_open")
+        self._diff_close = param("fundrate_diff_close")
+        self._diff_change = 1 + param("fundrate_diff_change_pct")
+
+        # ---------- 账户，与Ledger中的数组一一对应，多了config维
+        init_cash = np.repeat((param("init_cash") / n_exchanges)[:, np.newaxis], n_exchanges, axis=1)
+        self.cash = init_cash.copy()
+        self.accounts = {field: np.zeros((n_configs, n_exchanges, n_markets)) for field in ACCOUNT_FIELDS}
+        self.totals = {field: np.zeros((n_configs, n_exchanges)) for field in Ledger.TOTAL_FIELDS}
+
+        # ---------- active trades，每个(config, market)最多一个
+        self.active = np.zeros((n_configs, n_markets), dtype=bool)
+        self._legs = np.zeros((n_configs, n_markets, 2), dtype=np.intp)  # 两条腿的exchange序号
+        self._open_diff = np.zeros((n_configs, n_markets))
+        self._latest_diff = np.zeros((n_configs, n_markets))
+        self._open_row = np.zeros((n_configs, n_markets), dtype=np.intp)
+        self._init_trade_pnl = np.zeros((n_configs, n_markets, 2))  # 首次开仓前两条腿账户的快照
+        self._init_fund_pnl = np.zeros((n_configs, n_markets, 2))
+        # 加入_active_arb_trades的先后，换仓的新trade排到最后，加仓不改变位置
+        self._seq = np.zeros((n_configs, n_markets), dtype=np.int64)
+        self._n_inserted = 0
+
+        self.failed = np.zeros(n_configs, dtype=bool)  # 平仓或结算时发生了margin call
+
+        # ---------- 结果
+        self._closed: list[tuple] = []  # 每次平仓一组，字段见CLOSED_COLUMNS
+        self._pnl_sums: tuple[np.ndarray, list[float], list[float]] = None  # 每个config的trade数、PnL之和
+
+        # metric_history上的汇总，每次记录metrics时更新，不保存历史
+        self._n_records = 0
+        self._final_value = np.zeros((n_configs, n_exchanges))
+        self._peak_value = np.full((n_configs, n_exchanges), -np.inf)
+        self._max_drawdown = np.full((n_configs, n_exchanges), -np.inf)
+        self._max_used_margin = np.full((n_configs, n_exchanges), -np.inf)
+        self._final_fund_pnl = np.zeros((n_configs, n_exchanges))
+
+        self.risk = RiskStatsArray(init_cash)
+        self._years = 0.0
+
+    def __len__(self):
+        return len(self._configs)
+
+    # ------------------------------ exchange
+    def _book(self, ks: np.ndarray, es, ms, field: str, delta_cash: np.ndarray) -> np.ndarray:
+        """与Exchange._book相同，返回哪些config的cash<=0（margin call）"""
+        cash = self.cash[ks, es] + delta_cash
+        self.cash[ks, es] = cash
+        # 保证金与cash反向变化，PnL与cash同向变化
+        delta = -delta_cash if field == "used_margin" else delta_cash
+        self.accounts[field][ks, es, ms] += delta
+        self.totals[field][ks, es] += delta
+        return cash <= 0
+
+    def _trade_open(
+        self, ks: np.ndarray, e: int, m: int, is_long: int, price: np.ndarray, shares: np.ndarray
+    ):
+        """Exchange.trade的开仓部分；开仓的账户要么没有持仓，要么是同方向加仓，不会先平仓"""
+        accounts = self.accounts
+        margin_call = self._book(ks, e, m, "trade_pnl", -(price * shares * self._commission[ks]))
+
+        new_margin = shares * price * self._margin_rate[ks]
+        margin_call |= self._book(ks, e, m, "used_margin", -new_margin)
+
+        current = accounts["long_short_shares"][ks, e, m]
+        old_shares = np.abs(current)
+        current = current + is_long * shares
+        accounts["long_short_shares"][ks, e, m] = current
+        total_cost = old_shares * accounts["hold_price"][ks, e, m] + shares * price
+        accounts["hold_price"][ks, e, m] = total_cost / np.abs(current)
+        return margin_call
+
+    def _clear(self, ks: np.ndarray, es: np.ndarray, ms: np.ndarray, price: np.ndarray) -> np.ndarray:
+        """与Exchange.clear相同，按price平掉全部持仓"""
+        accounts = self.accounts
+        current = accounts["long_short_shares"][ks, es, ms]
+        is_long = np.where(current < 0, 1, -1)
+        shares = np.abs(current)
+        margin_call = self._book(ks, es, ms, "trade_pnl", -(price * shares * self._commission[ks]))
+
+        reduce_margin = shares / np.abs(current) * accounts["used_margin"][ks, es, ms]
+        margin_call |= self._book(ks, es, ms, "used_margin", reduce_margin)
+        pnl = -is_long * (price - accounts["hold_price"][ks, es, ms]) * shares
+        margin_call |= self._book(ks, es, ms, "trade_pnl", pnl)
+
+        current = current + is_long * shares
+        accounts["long_short_shares"][ks, es, ms] = current
+        hold_price = accounts["hold_price"][ks, es, ms]
+        accounts["hold_price"][ks, es, ms] = np.where(np.abs(current) <= 1e-6, 0.0, hold_price)
+        return margin_call
+
+    def _settle_leg(self, ks: np.ndarray, es: np.ndarray, ms: np.ndarray, row: int) -> np.ndarray:
+        """与Exchange.settle_trading和settle_funding相同"""
+        accounts = self.accounts
+        values = self._data_feeds.values[row]
+        price = values[ms, es, 1]
+        shares = accounts["long_short_shares"][ks, es, ms]
+
+        pnl = (price - accounts["hold_price"][ks, es, ms]) * shares
+        margin_call = self._book(ks, es, ms, "trade_pnl", pnl)
+        accounts["hold_price"][ks, es, ms] = price
+
+        new_margin = np.abs(shares) * price * self._margin_rate[ks]
+        margin_diff = new_margin - accounts["used_margin"][ks, es, ms]
+        margin_call |= self._book(ks, es, ms, "used_margin", -margin_diff)
+
+        hours = self._funding_hours[row, es]
+        funded = np.flatnonzero(hours > 0)  # 不结算funding的exchange只mark to market
+        if len(funded) > 0:
+            ks, es, ms = ks[funded], es[funded], ms[funded]
+            funding_rate = values[ms, es, 3] * hours[funded]
+            fund_pnl = -funding_rate * shares[funded] * values[ms, es, 2]
+            margin_call[funded] |= self._book(ks, es, ms, "fund_pnl", fund_pnl)
+        return margin_call
+
+    # ------------------------------ trades
+    def _order(self) -> np.ndarray:
+        """shape=(K, market)，每个config的active trade按加入的先后排在前面，即_active_arb_trades的dict顺序"""
+        return np.argsort(np.where(self.active, self._seq, np.iinfo(np.int64).max), axis=1, kind="stable")
+
+    def _iter_active(self):
+        """按dict顺序，依次返回每个config的第r个active trade：(config序号, market序号)"""
+        order = self._order()
+        configs = np.arange(len(self))
+        for rank in range(order.shape[1]):
+            ms = order[:, rank]
+            ks = np.flatnonzero(self.active[configs, ms])
+            if len(ks) == 0:  # 排在前面的都是active的，后面不会再有
+                return
+            yield ks, ms[ks]
+
+    def _fail(self, ks: np.ndarray):
+        """回测失败的config不再有任何持仓和动作"""
+        self.failed[ks] = True
+        self.active[ks] = False
+
+    def _close_trades(self, ks: np.ndarray, ms: np.ndarray, row: int, price_field: int):
+        """与FundingArbTrade.close相同：两条腿依次clear，再固化PnL"""
+        values = self._data_feeds.values[row]
+        margin_call = np.zeros(len(ks), dtype=bool)
+        for leg, is_long in enumerate(LEG_SIGNS):
+            es = self._legs[ks, ms, leg]
+            price = values[ms, es, price_field] * (1 + is_long * self._slippage[ks])
+            margin_call |= self._clear(ks, es, ms, price)
+
+        trade_pnl, fund_pnl = 0, 0
+        for leg in range(2):
+            es = self._legs[ks, ms, leg]
+            trade_pnl = trade_pnl + (
+                self.accounts["trade_pnl"][ks, es, ms] - self._init_trade_pnl[ks, ms, leg]
+            )
+            fund_pnl = fund_pnl + (self.accounts["fund_pnl"][ks, es, ms] - self._init_fund_pnl[ks, ms, leg])
+
+        self.active[ks, ms] = False
+        self._fail(ks[margin_call])
+        done = ~margin_call
+        ks, ms, trade_pnl, fund_pnl = ks[done], ms[done], trade_pnl[done], fund_pnl[done]
+        self._closed.append(
+            (
+                ks,
+                ms,
+                self._legs[ks, ms, 0],
+                self._legs[ks, ms, 1],
+                self._open_row[ks, ms],
+                np.full(len(ks), row),
+                trade_pnl,
+                fund_pnl,
+            )
+        )
+
+    def _open_trades(self, ks: np.ndarray, m: int, row: int, fresh: np.ndarray):
+        """与FundingArbTrade.safe_open相同，fresh是新开的trade，其余是在原trade上加仓
+        两条腿都在事务中：任何一步margin call，这个config两条腿的所有修改都回滚
+        """
+        long_ex, short_ex = int(self._long_ex[row, m]), int(self._short_ex[row, m])
+        fundrate_diff = float(self._signal_diff[row, m])
+        accounts = self.accounts
+        legs = [long_ex, short_ex]
+
+        # 回滚用的旧值；新开trade的两条腿，开仓前账户的快照也是这些值
+        saved_cash = self.cash[ks][:, legs]
+        saved_accounts = {field: column[ks][:, legs, m] for field, column in accounts.items()}
+        saved_totals = {field: column[ks][:, legs] for field, column in self.totals.items()}
+
+        open_prices = self._data_feeds.values[row, m, :, 0]
+        usd_amount = self._ordersize_usd[ks]
+        shares = usd_amount / open_prices[long_ex]
+        tmp = usd_amount / open_prices[short_ex]
+        shares = np.where(tmp < shares, tmp, shares)  # 两条腿必须是相同的shares才能对冲
+
+        margin_call = np.zeros(len(ks), dtype=bool)
+        for e, is_long in zip(legs, LEG_SIGNS):
+            price = open_prices[e] * (1 + is_long * self._slippage[ks])
+            margin_call |= self._trade_open(ks, e, m, is_long, price, shares)
+
+        if margin_call.any():
+            rollback = ks[margin_call]
+            for leg, e in enumerate(legs):
+                self.cash[rollback, e] = saved_cash[margin_call, leg]
+                for field, column in accounts.items():
+                    column[rollback, e, m] = saved_accounts[field][margin_call, leg]
+                for field, column in self.totals.items():
+                    column[rollback, e] = saved_totals[field][margin_call, leg]
+
+        opened = ~margin_call
+        new = ks[opened & fresh]
+        if len(new) > 0:
+            self._legs[new, m] = legs
+            self._open_row[new, m] = row
+            self._init_trade_pnl[new, m] = saved_accounts["trade_pnl"][opened & fresh]
+            self._init_fund_pnl[new, m] = saved_accounts["fund_pnl"][opened & fresh]
+            self._n_inserted += 1
+            self._seq[new, m] = self._n_inserted
+
+        ks = ks[opened]
+        self.active[ks, m] = True
+        self._open_diff[ks, m] = fundrate_diff
+        self._latest_diff[ks, m] = fundrate_diff
+
+    # ------------------------------ 每个bar的流程，与FundingArbStrategy相同
+    def close(self, row: int):
+        fund_rates = self._data_feeds.values[row, :, :, 3]
+        for ks, ms in self._iter_active():
+            long_ex, short_ex = self._legs[ks, ms, 0], self._legs[ks, ms, 1]
+            latest = fund_rates[ms, short_ex] - fund_rates[ms, long_ex]
+            self._latest_diff[ks, ms] = latest
+            closing = latest < self._diff_close[ks]  # fundrate差异收窄
+            if closing.any():
+                self._close_trades(ks[closing], ms[closing], row, price_field=0)
+
+    def open(self, row: int):
+        for m in range(self.active.shape[1]):
+            if not self._has_pair[row, m]:  # 所有exchange的fundrate都相同
+                continue
+            fundrate_diff = self._signal_diff[row, m]
+            candidate = ~self.failed & (fundrate_diff >= self._diff_open)
+            if not candidate.any():
+                continue
+
+            active = self.active[:, m]
+            same_pair = (self._legs[:, m, 0] == self._long_ex[row, m]) & (
+                self._legs[:, m, 1] == self._short_ex[row, m]
+            )
+            add = (
+                candidate
+                & active
+                & same_pair
+                & (fundrate_diff >= self._open_diff[:, m] * self._diff_change)
+            )
+            switch = (
+                candidate
+                & active
+                & ~same_pair
+                & (fundrate_diff >= self._latest_diff[:, m] * self._diff_change)
+            )
+            if switch.any():
+                ks = np.flatnonzero(switch)
+                self._close_trades(ks, np.full(len(ks), m), row, price_field=0)
+
+            fresh = (candidate & ~active) | (switch & ~self.failed)
+            ks = np.flatnonzero(fresh | add)
+            if len(ks) > 0:
+                self._open_trades(ks, m, row, fresh=fresh[ks])
+
+    def settle(self, row: int):
+        for ks, ms in self._iter_active():
+            margin_call = np.zeros(len(ks), dtype=bool)
+            for leg in range(2):
+                margin_call |= self._settle_leg(ks, self._legs[ks, ms, leg], ms, row)
+            self._fail(ks[margin_call])
+
+    def _update_risk(self):
+        # 失败的config的状态没有意义，结果会被丢弃，忽略其上的除零
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.risk.update(self.cash, self.totals["used_margin"])
+
+    def _record_metrics(self):
+        """只保留summarize需要的汇总：最后的total_value和fund_pnl，total_value的最大回撤，used_margin的峰值"""
+        total_value = self.cash + self.totals["used_margin"]
+        self._n_records += 1
+        self._final_value = total_value
+        self._peak_value = np.maximum(self._peak_value, total_value)
+        self._max_drawdown = np.maximum(self._max_drawdown, self._peak_value - total_value)
+        self._max_used_margin = np.maximum(self._max_used_margin, self.totals["used_margin"])
+        self._final_fund_pnl = self.totals["fund_pnl"].copy()
+
+    def run(self):
+        rows = np.flatnonzero(self._data_feeds.valid)
+        for row in rows.tolist():
+            self.close(row)
+            self.open(row)
+            self.settle(row)
+            self._update_risk()
+            if self._record_mask[row]:
+                self._record_metrics()
+
+        # 回测结束，按最后一个bar的收盘价关闭所有仓位
+        last = int(rows[-1])
+        for ks, ms in self._iter_active():
+            self._close_trades(ks, ms, last, price_field=1)
+        self._update_risk()
+        self._record_metrics()
+
+        timestamps = pd.DatetimeIndex(self._data_feeds.timestamps[rows[[0, -1]]]).to_pydatetime()
+        self._years = span_years(timestamps[0], timestamps[1])
+        self._pnl_sums = self._sum_closed_pnl()
+
+    def _closed_arrays(self) -> dict[str, np.ndarray]:
+        """所有平仓记录，按平仓的先后"""
+        if len(self._closed) == 0:
+            return {name: np.zeros(0, dtype=np.intp) for name in CLOSED_COLUMNS}
+        return {name: np.concatenate(values) for name, values in zip(CLOSED_COLUMNS, zip(*self._closed))}
+
+    def _sum_closed_pnl(self) -> tuple[np.ndarray, list[float], list[float]]:
+        """每个config的trade数和PnL之和
+        与summarize一样，对python float按平仓顺序调用sum()：python 3.12起sum()对float做补偿求和，
+        与numpy逐个累加的结果可能差1个ulp
+        """
+        closed = self._closed_arrays()
+        configs = closed["config"]
+        order = np.argsort(configs, kind="stable")
+        counts = np.bincount(configs, minlength=len(self))
+        splits = np.cumsum(counts)[:-1]
+        trade_pnl = np.split(closed["trade_pnl"][order].astype(np.float64), splits)
+        fund_pnl = np.split(closed["fund_pnl"][order].astype(np.float64), splits)
+        return counts, [sum(pnl.tolist()) for pnl in trade_pnl], [sum(pnl.tolist()) for pnl in fund_pnl]
+
+    # ------------------------------ 结果
+    @property
+    def closed_trades(self) -> pd.DataFrame:
+        """所有config的已平仓trade，每个config内部按平仓的先后，与FundingArbStrategy.closed_trades一致"""
+        df = pd.DataFrame(self._closed_arrays())
+        df = (
+            df.loc[~self.failed[df["config"].to_numpy()]]
+            .sort_values("config", kind="stable")
+            .reset_index(drop=True)
+        )
+
+        names = {
+            "market": self._configs[0].markets,
+            "long_ex": self._configs[0].exchanges,
+            "short_ex": self._configs[0].exchanges,
+        }
+        for column, values in names.items():
+            df[column] = np.asarray(values, dtype=object)[df[column].to_numpy()]
+        for column in ["open_tm", "close_tm"]:
+            df[column] = self._data_feeds.timestamps[df[column].to_numpy()]
+        return df
+
+    def summary(self, k: int) -> dict:
+        """第k个config的结果，与sweep.summarize(strategy)相同"""
+        if self.failed[k]:
+            return dict(error="MarginCall")
+        n_trades, trade_pnl, fund_pnl = self._pnl_sums
+        result = dict(
+            n_trades=int(n_trades[k]),
+            trade_pnl=trade_pnl[k],
+            fund_pnl=fund_pnl[k],
+            total_pnl=trade_pnl[k] + fund_pnl[k],
+        )
+
+        exchanges = self._configs[k].exchanges
+        if self._n_records > 0:
+            for e, name in enumerate(exchanges):
+                result[f"{name}_final_value"] = float(self._final_value[k, e])
+                result[f"{name}_max_drawdown"] = float(self._max_drawdown[k, e])
+                result[f"{name}_max_used_margin"] = float(self._max_used_margin[k, e])
+                result[f"{name}_fund_pnl"] = float(self._final_fund_pnl[k, e])
+
+        for e, name in enumerate(exchanges):
+            stats = self.risk.at((k, e)).summary(self._years, fund_pnl=float(self.totals["fund_pnl"][k, e]))
+            for key in RISK_KEYS:
+                result[f"{name}_{key}"] = stats[key]
+        return result
+
+    def results(self) -> pd.DataFrame:
+        """每个config一行，与sweep.run_sweep的结果相同"""
+        return pd.DataFrame(
+            [{**asdict(config), **self.summary(k)} for k, config in enumerate(self._configs)]
+        )
+
+
+def main(
+    config_file: Path,
+    grid_file: Path,
+    output: Path = Path("sweep.csv"),
+    n_samples: int = 0,
+    seed: int = 0,
+):
+    """与sweep.main相同的输入和输出，但是所有参数组合在一个进程里一起回测
+    - config_file: json，Config的所有字段，作为基准参数
+    - grid_file: json，n_samples=0时是字段名->候选值列表，网格搜索；n_samples>0时是字段名->[low, high]，随机采样
+    """
+    base = Config(**json.loads(config_file.read_text()))
+    grid = json.loads(grid_file.read_text())
+    if n_samples > 0:
+        configs = random_configs(base, space=grid, n=n_samples, seed=seed)
+    else:
+        configs = grid_configs(base, grid=grid)
+
+    strategy = BatchedStrategy(configs)
+    strategy.run()
+    results = strategy.results()
+    results.sort_values("total_pnl", ascending=False).to_csv(output, index=False)
+    print(f"{len(configs)} configs done, results saved to {output}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
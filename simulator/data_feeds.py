@@ -1,13 +1,27 @@
+import asyncio
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
 import pandas as pd
 from pathlib import Path
 from dataclasses import dataclass
 from datetime import datetime
 from collections import defaultdict
+from simulator.dataset import PartitionedDataset, to_timestamp
+
+# 数据块最后一维的字段顺序
+FIELDS = ["open_price", "close_price", "mark_price", "fund_rate"]
 
 
 class FeedOnce:  # 某个时刻下的数据
     def __init__(self) -> None:
         self.timestamp: datetime = None
+        self.index: int = None  # 在DataFeeds数据块中的行号
+        self.received_at: float = None  # LiveFeeds：这个bar最后一个update到达的时刻(perf_counter)
 
         # 外层key是market，内层dict是exchange -> price / funding rate
         self.open_prices: dict[str, dict[str, float]] = defaultdict(dict)
@@ -34,57 +48,336 @@ class FeedOnce:  # 某个时刻下的数据
         container[market][exchange] = value
 
 
+def read_input_csv(fname: Path) -> pd.DataFrame:
+    return pd.read_csv(fname, index_col="timestamp", parse_dates=True)
+
+
+def read_inputs(
+    data_dir: Path, exchanges: list[str], markets: list[str], start=None, end=None
+) -> dict[tuple[str, str], pd.DataFrame]:
+    """读取[start, end]之间每个exchange x market的数据
+    data_dir是PartitionedDataset时，只读范围内的分区；否则读取{data_dir}/{exchange}_{market}.csv再截取
+    """
+    start, end = to_timestamp(start), to_timestamp(end)
+    if PartitionedDataset.exists(data_dir):
+        dataset = PartitionedDataset(data_dir)
+        return {
+            (ex, market): dataset.read(ex, market, start=start, end=end, columns=FIELDS)
+            for ex in exchanges
+            for market in markets
+        }
+    return {
+        (ex, market): read_input_csv(data_dir / f"{ex}_{market}.csv").loc[start:end]
+        for ex in exchanges
+        for market in markets
+    }
+
+
+def make_feed(
+    timestamp: datetime, index: int, row: list, exchanges: list[str], markets: list[str]
+) -> FeedOnce:
+    """由数据块中的一行构造FeedOnce，row是values[index].tolist()，shape=(market, exchange, field)"""
+    feed = FeedOnce()
+    feed.timestamp = timestamp
+    feed.index = index
+
+    containers = [feed.get(col) for col in FIELDS]
+    for market, ex_values in zip(markets, row):
+        for fidx, container in enumerate(containers):
+            container[market] = {ex: values[fidx] for ex, values in zip(exchanges, ex_values)}
+
+    return feed
+
+
+class FeedCache:
+    """把data/input下的csv转换成.npy，之后的加载用np.load(mmap_mode="r")直接映射，不再解析csv
+    - 单个csv的缓存key由源文件的path、size、mtime和内容hash决定，任何一项变化都会重新转换
+    - 内容hash记在缓存目录的file_hashes.json中，size和mtime都没变时直接使用，只有两者之一变化时才重新读完整个源文件
+    - 拼好的整个数据块也会缓存一份，多个进程加载同一批文件时，映射的是同一份page cache，零拷贝
+    - 每个不同的(exchanges, markets, start, end)组合都会多缓存一个数据块，缓存不会自动清理，用evict()控制大小
+    """
+
+    HASHES_FILE = "file_hashes.json"
+
+    def __init__(self, cache_dir: Path | str) -> None:
+        self._cache_dir = Path(cache_dir)
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        self._hashes: dict[str, list] = None  # 源文件path -> [size, mtime_ns, 内容hash]，第一次用到时载入
+        self._hashes_changed = False
+
+    def _content_hash(self, fname: Path, stat: os.stat_result) -> str:
+        if self._hashes is None:
+            try:
+                self._hashes = json.loads((self._cache_dir / self.HASHES_FILE).read_text())
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._hashes = {}
+
+        entry = self._hashes.get(str(fname))
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+        content_hash = hashlib.sha1(fname.read_bytes()).hexdigest()
+        self._hashes[str(fname)] = [stat.st_size, stat.st_mtime_ns, content_hash]
+        self._hashes_changed = True
+        return content_hash
+
+    def _save_hashes(self):
+        # 与_save一样先写临时文件再rename；并发的进程互相覆盖时，丢失的记录只是下次重新hash
+        if not self._hashes_changed:
+            return
+        path = self._cache_dir / self.HASHES_FILE
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(self._hashes))
+        os.replace(tmp_path, path)
+        self._hashes_changed = False
+
+    def file_key(self, fname: Path) -> str:
+        fname = Path(fname).resolve()
+        stat = fname.stat()
+        content_hash = self._content_hash(fname, stat)
+        ident = f"{fname}|{stat.st_size}|{stat.st_mtime_ns}|{content_hash}"
+        return hashlib.sha1(ident.encode()).hexdigest()
+
+    def _paths(self, key: str) -> tuple[Path, Path]:
+        return self._cache_dir / f"{key}.times.npy", self._cache_dir / f"{key}.values.npy"
+
+    def _save(self, key: str, timestamps: np.ndarray, values: np.ndarray):
+        # 先写临时文件再rename，避免并发的worker读到写了一半的文件
+        for path, array in zip(self._paths(key), [timestamps, values]):
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as outf:
+                np.save(outf, array)
+            os.replace(tmp_path, path)
+
+    def _load(self, key: str) -> tuple[np.ndarray, np.ndarray] | None:
+        times_path, values_path = self._paths(key)
+        if not (times_path.exists() and values_path.exists()):
+            return None
+        values_path.touch()  # mtime记录最近一次使用的时间，evict()时先删除最久没用的
+        return np.load(times_path, mmap_mode="r"), np.load(values_path, mmap_mode="r")
+
+    def evict(self, max_bytes: int = 0) -> int:
+        """删除最久没有使用的缓存，直到所有.npy合计不超过max_bytes，返回删除的字节数
+        - max_bytes=0清空所有缓存
+        - 其它进程已经mmap的数据不受影响，删除的只是目录项
+        """
+        entries = []  # (最近使用的时间, 合计大小, 文件)
+        for values_path in self._cache_dir.glob("*.values.npy"):
+            key = values_path.name[: -len(".values.npy")]
+            paths = [path for path in self._paths(key) if path.exists()]
+            try:
+                entries.append(
+                    (values_path.stat().st_mtime_ns, sum(p.stat().st_size for p in paths), paths)
+                )
+            except FileNotFoundError:  # 并发的evict
+                continue
+        entries.sort(key=lambda entry: entry[0])
+
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for _, size, paths in entries:
+            if total - freed <= max_bytes:
+                break
+            for path in paths:
+                path.unlink(missing_ok=True)
+            freed += size
+
+        if max_bytes == 0:
+            (self._cache_dir / self.HASHES_FILE).unlink(missing_ok=True)
+            self._hashes = None
+        return freed
+
+    def load_csv(self, fname: Path) -> pd.DataFrame:
+        key = self.file_key(fname)
+        self._save_hashes()
+
+        cached = self._load(key)
+        if cached is None:
+            df = read_input_csv(fname)
+            timestamps = df.index.to_numpy(dtype="datetime64[ns]")
+            values = df.loc[:, FIELDS].to_numpy(dtype=np.float64)
+            self._save(key, timestamps, values)
+        else:
+            timestamps, values = cached
+
+        return pd.DataFrame(values, index=pd.DatetimeIndex(timestamps, name="timestamp"), columns=FIELDS)
+
+    def load_block(
+        self, data_dir: Path, exchanges: list[str], markets: list[str], start=None, end=None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        start, end = to_timestamp(start), to_timestamp(end)
+        is_dataset = PartitionedDataset.exists(data_dir)
+        if is_dataset:
+            # 数据集本身就是.npy，不需要单个文件的缓存，只缓存拼好的数据块
+            dataset = PartitionedDataset(data_dir)
+            fnames = [
+                fname
+                for ex in exchanges
+                for market in markets
+                for fname in dataset.files(ex, market, start=start, end=end, columns=FIELDS)
+            ]
+        else:
+            fnames = [data_dir / f"{ex}_{market}.csv" for ex in exchanges for market in markets]
+
+        file_keys = [self.file_key(fname) for fname in fnames]
+        self._save_hashes()
+        block_ident = exchanges + markets + [str(start), str(end)] + file_keys
+        block_key = hashlib.sha1("|".join(block_ident).encode()).hexdigest()
+
+        cached = self._load(block_key)
+        if cached is not None:
+            return cached
+
+        if is_dataset:
+            frames = read_inputs(data_dir, exchanges, markets, start=start, end=end)
+        else:
+            frames = {
+                (ex, market): self.load_csv(data_dir / f"{ex}_{market}.csv").loc[start:end]
+                for ex in exchanges
+                for market in markets
+            }
+        timestamps, values = DataFeeds._assemble(frames, exchanges=exchanges, markets=markets)
+        self._save(block_key, timestamps, values)
+        return self._load(block_key)
+
+
 class DataFeeds:
-    def __init__(self, data_dir: Path | str, exchanges: list[str], markets: list[str]) -> None:
+    """所有exchange x market的数据一次性载入一个dense block，shape=(time, market, exchange, field)
+    所有数据共享同一个时间轴，迭代时只需要按整数行号取数，不再每行构造pandas Series
+    """
+
+    def __init__(
+        self,
+        data_dir: Path | str,
+        exchanges: list[str],
+        markets: list[str],
+        cache_dir: Path | str | None = None,
+        start=None,
+        end=None,
+    ) -> None:
+        """
+        - data_dir: PartitionedDataset的根目录，或者存放{exchange}_{market}.csv的目录
+        - cache_dir: 不为None时，通过FeedCache加载，数据块是只读的memmap
+        - start/end: 只载入[start, end]（都包含）之间的数据，None表示不限；数据集只读取范围内的分区
+        """
         if isinstance(data_dir, str):
             data_dir = Path(data_dir)
 
-        self._datas = {}
+        if cache_dir is not None:
+            cache = FeedCache(cache_dir)
+            timestamps, values = cache.load_block(
+                data_dir, exchanges=exchanges, markets=markets, start=start, end=end
+            )
+        else:
+            frames = read_inputs(data_dir, exchanges, markets, start=start, end=end)
+            timestamps, values = self._assemble(frames, exchanges=exchanges, markets=markets)
+
+        self._setup(timestamps=timestamps, values=values, exchanges=exchanges, markets=markets)
+
+    @classmethod
+    def from_arrays(
+        cls, timestamps: np.ndarray, values: np.ndarray, exchanges: list[str], markets: list[str]
+    ) -> "DataFeeds":
+        """直接由内存中的数据块构造，不读文件
+        - timestamps: datetime64[ns], shape=(time,)
+        - values: shape=(time, market, exchange, field)，field的顺序见FIELDS
+        """
+        feeds = cls.__new__(cls)
+        feeds._setup(timestamps=timestamps, values=values, exchanges=exchanges, markets=markets)
+        return feeds
+
+    @staticmethod
+    def _assemble(
+        frames: dict[tuple[str, str], pd.DataFrame], exchanges: list[str], markets: list[str]
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # 所有文件的时间轴取并集，某个文件缺失的时刻填NaN，迭代时整行放弃
+        timeline = None
+        for df in frames.values():
+            timeline = df.index if timeline is None else timeline.union(df.index)
+        timeline = timeline.sort_values()
+
+        values = np.full((len(timeline), len(markets), len(exchanges), len(FIELDS)), np.nan)
+        for eidx, ex in enumerate(exchanges):
+            for midx, market in enumerate(markets):
+                df = frames[(ex, market)]
+                if not df.index.equals(timeline):
+                    df = df.reindex(index=timeline)
+                values[:, midx, eidx, :] = df.loc[:, FIELDS].to_numpy(dtype=np.float64)
+
+        return timeline.to_numpy(dtype="datetime64[ns]"), values
+
+    def _setup(self, timestamps: np.ndarray, values: np.ndarray, exchanges: list[str], markets: list[str]):
+        assert values.shape == (len(timestamps), len(markets), len(exchanges), len(FIELDS))
+
         self._exchanges = exchanges
         self._markets = markets
+        self._timestamps = timestamps
+        self._values = values
+        self._total_rows = len(timestamps)
         self._index = 0
 
-        self._total_rows = None
-        for ex in exchanges:
-            for market in markets:
+        # TODO:只要存在NaN，就放弃这个timestamp的所有market+exchange的数据
+        self._valid = ~np.isnan(values).any(axis=(1, 2, 3))
 
-                fname = data_dir / f"{ex}_{market}.csv"
-                df = pd.read_csv(fname, index_col="timestamp", parse_dates=True)
+        # 以下两个list只为迭代服务，避免每行都从numpy scalar转换
+        self._valid_list = self._valid.tolist()
+        self._pytimes = pd.DatetimeIndex(timestamps).to_pydatetime().tolist()
 
-                if self._total_rows is None:
-                    self._total_rows = df.shape[0]
-                else:
-                    assert self._total_rows == df.shape[0], "all exchanges should have same length of data"
+    @property
+    def exchanges(self) -> list[str]:
+        return self._exchanges
 
-                self._datas[f"{ex}/{market}"] = df
+    @property
+    def markets(self) -> list[str]:
+        return self._markets
 
-    def __iter__(self):
-        return self
+    @property
+    def timestamps(self) -> np.ndarray:
+        """datetime64[ns], shape=(time,)"""
+        return self._timestamps
 
-    def __read_current(self):
-        feed = FeedOnce()
+    @property
+    def values(self) -> np.ndarray:
+        """shape=(time, market, exchange, field)，field的顺序见FIELDS"""
+        return self._values
 
-        for market in self._markets:
-            for ex in self._exchanges:
-                row = self._datas[f"{ex}/{market}"].iloc[self._index, :]
+    @property
+    def valid(self) -> np.ndarray:
+        """bool, shape=(time,)，False的行在迭代时被跳过"""
+        return self._valid
 
-                # TODO:只要存在NaN，就放弃这个timestamp的所有market+exchange的数据
-                if row.isna().any():
-                    return None
+    def field(self, name: str) -> np.ndarray:
+        """某个字段的数据，shape=(time, market, exchange)，返回的是view，不拷贝"""
+        return self._values[:, :, :, FIELDS.index(name)]
 
-                if feed.timestamp is None:
-                    feed.timestamp = row.name.to_pydatetime()
-                else:
-                    assert feed.timestamp == row.name.to_pydatetime()
+    def __len__(self):
+        return self._total_rows
 
-                for col in ["open_price", "close_price", "mark_price", "fund_rate"]:
-                    feed.add(column=col, market=market, exchange=ex, value=row[col])
+    @property
+    def current_index(self) -> int:
+        """最近一次迭代返回的FeedOnce所在的行号，还没开始迭代时是-1"""
+        return self._index - 1
 
-        return feed
+    def seek(self, row: int):
+        """下一次迭代从第row行开始"""
+        assert 0 <= row <= self._total_rows
+        self._index = row
+
+    def __iter__(self):
+        return self
+
+    def __read_current(self):
+        # 一次性转成python list，比逐个读numpy元素快得多
+        return make_feed(
+            timestamp=self._pytimes[self._index],
+            index=self._index,
+            row=self._values[self._index].tolist(),
+            exchanges=self._exchanges,
+            markets=self._markets,
+        )
 
     def __next__(self):
         while self._index < self._total_rows:
-            feed = self.__read_current()
+            feed = self.__read_current() if self._valid_list[self._index] else None
 
             self._index += 1
 
@@ -92,3 +385,278 @@ class DataFeeds:
                 return feed
 
         raise StopIteration
+
+
+class StreamingDataFeeds:
+    """与DataFeeds相同的FeedOnce迭代接口，但是流式读取csv，占用的内存只与chunk_rows有关，与历史长度无关
+    - 所有csv以chunk_rows行为单位同步往前读，只有所有文件都已经读到的时间段，才拼成一个对齐的数据块
+    - data_dir是PartitionedDataset时，以月分区为单位往前读，chunk_rows不起作用
+    - 后台线程提前拼好下一个数据块(double buffer)，主线程消费当前的数据块
+    - FeedOnce.index是在整个数据流中的行号，与DataFeeds一致；但是不能seek，也没有完整的values
+    """
+
+    def __init__(
+        self,
+        data_dir: Path | str,
+        exchanges: list[str],
+        markets: list[str],
+        chunk_rows: int = 24 * 30,
+        start=None,
+        end=None,
+    ) -> None:
+        self._data_dir = Path(data_dir)
+        self._exchanges = exchanges
+        self._markets = markets
+        self._chunk_rows = chunk_rows
+        self._start = to_timestamp(start)
+        self._end = to_timestamp(end)
+
+        self._queue: queue.Queue = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread = None
+
+        # 当前正在消费的数据块
+        self._chunk_start = 0  # 数据块第一行在整个数据流中的行号
+        self._chunk_values: np.ndarray = None
+        self._chunk_valid: list[bool] = []
+        self._chunk_pytimes: list[datetime] = []
+        self._offset = 0  # 下一行在数据块中的位置
+
+    @property
+    def exchanges(self) -> list[str]:
+        return self._exchanges
+
+    @property
+    def markets(self) -> list[str]:
+        return self._markets
+
+    @property
+    def current_index(self) -> int:
+        """最近一次迭代返回的FeedOnce所在的行号，还没开始迭代时是-1"""
+        return self._chunk_start + self._offset - 1
+
+    def __readers(self) -> dict:
+        """每个exchange x market一个迭代器，依次生成[start, end]之间、按时间排序的非空DataFrame"""
+        keys = [(ex, market) for ex in self._exchanges for market in self._markets]
+        if PartitionedDataset.exists(self._data_dir):
+            dataset = PartitionedDataset(self._data_dir)
+            return {
+                key: (df for df in dataset.iter_months(*key, self._start, self._end, FIELDS) if len(df) > 0)
+                for key in keys
+            }
+
+        def read_csv(ex: str, market: str):
+            fname = self._data_dir / f"{ex}_{market}.csv"
+            for df in pd.read_csv(fname, index_col="timestamp", parse_dates=True, chunksize=self._chunk_rows):
+                if self._end is not None and df.index[0] > self._end:
+                    return
+                df = df.loc[self._start : self._end]
+                if len(df) > 0:
+                    yield df
+
+        return {key: read_csv(*key) for key in keys}
+
+    def chunks(self):
+        """依次生成对齐好的数据块(timestamps, values)，布局与DataFeeds相同"""
+        readers = self.__readers()
+        empty = pd.DataFrame(columns=FIELDS, index=pd.DatetimeIndex([], name="timestamp"), dtype=np.float64)
+        pending = {key: empty for key in readers}  # 已经读入，但还没有拼进数据块的部分
+        live = set(readers)  # 还没有读完的文件
+
+        while True:
+            for key in list(live):
+                if len(pending[key]) >= self._chunk_rows:
+                    continue
+                try:
+                    df = next(readers[key])
+                except StopIteration:
+                    live.remove(key)
+                    continue
+                pending[key] = df if len(pending[key]) == 0 else pd.concat([pending[key], df])
+
+            # 所有没读完的文件都已经读到了watermark，watermark(含)之前的时间段不会再有新数据
+            watermark = min((pending[key].index[-1] for key in live), default=None)
+            frames = {}
+            for key, df in pending.items():
+                split = len(df) if watermark is None else df.index.searchsorted(watermark, side="right")
+                frames[key] = df.iloc[:split]
+                pending[key] = df.iloc[split:]
+
+            if any(len(df) > 0 for df in frames.values()):
+                yield DataFeeds._assemble(frames, exchanges=self._exchanges, markets=self._markets)
+            elif watermark is None:
+                return
+
+    def __produce(self):
+        try:
+            for chunk in self.chunks():
+                while not self._stop.is_set():
+                    try:
+                        self._queue.put(chunk, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if self._stop.is_set():
+                    return
+            self._queue.put(None)
+        except BaseException as error:  # 在主线程中重新抛出
+            self._queue.put(error)
+
+    def close(self):
+        """提前结束迭代时，停止后台线程"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __iter__(self):
+        return self
+
+    def __next_chunk(self) -> bool:
+        if self._thread is None:
+            # 最多一个数据块在队列中等待，一个正在消费，内存有上界
+            self._queue = queue.Queue(maxsize=1)
+            self._thread = threading.Thread(target=self.__produce, daemon=True)
+            self._thread.start()
+
+        chunk = self._queue.get()
+        if chunk is None:
+            return False
+        if isinstance(chunk, BaseException):
+            raise chunk
+
+        timestamps, values = chunk
+        self._chunk_start += len(self._chunk_valid)
+        self._chunk_values = values
+        self._chunk_valid = (~np.isnan(values).any(axis=(1, 2, 3))).tolist()
+        self._chunk_pytimes = pd.DatetimeIndex(timestamps).to_pydatetime().tolist()
+        self._offset = 0
+        return True
+
+    def __next__(self):
+        while True:
+            while self._offset < len(self._chunk_valid):
+                offset = self._offset
+                self._offset += 1
+                if self._chunk_valid[offset]:
+                    return make_feed(
+                        timestamp=self._chunk_pytimes[offset],
+                        index=self._chunk_start + offset,
+                        row=self._chunk_values[offset].tolist(),
+                        exchanges=self._exchanges,
+                        markets=self._markets,
+                    )
+
+            if not self.__next_chunk():
+                raise StopIteration
+
+
+class LiveFeeds:
+    """异步的FeedOnce流，由逐条到达的行情update拼成bar，用于纸面交易
+    - 连接host:port，每行一个json update：{"exchange", "market", "timestamp", 以及FIELDS中的字段}
+    - 同一个(exchange, market)的update按时间先后到达，不同(exchange, market)之间的先后和延迟任意
+    - 所有(exchange, market)都收到了t或更晚的update(watermark)之后，t及之前的bar不会再有新数据，依次发出；
+      缺少任何一个update或者有NaN的bar整个放弃，与DataFeeds跳过有NaN的行一致
+    - 晚于watermark到达的update已经没有用了，只计数
+    - max_lag: 某个(exchange, market)停止推送时，watermark不能一直卡住；落后于最新update超过max_lag的bar
+      （pandas的时间间隔，例如"3h"）即使还缺数据也发出，按缺数据放弃。None表示一直等待
+    - FeedOnce.index是连接以来的bar序号（包括放弃的bar），received_at是bar可以发出的时刻
+    - 连接关闭时，发出剩下的完整bar，然后结束
+    """
+
+    def __init__(
+        self, host: str, port: int, exchanges: list[str], markets: list[str], max_lag: str = None
+    ) -> None:
+        self._host = host
+        self._port = port
+        self._exchanges = exchanges
+        self._markets = markets
+        self._slots = {
+            (ex, market): (midx, eidx)
+            for eidx, ex in enumerate(exchanges)
+            for midx, market in enumerate(markets)
+        }
+
+        self._pending: dict[datetime, np.ndarray] = {}  # 还没有发出的bar，shape=(market, exchange, field)
+        self._latest: dict[tuple[str, str], datetime] = {}  # 每个(exchange, market)最新update的时刻
+        self._emitted: datetime = None  # 最后一个发出（或放弃）的bar的时刻
+        self._newest: datetime = None  # 所有update中最新的时刻
+        self._max_lag = None if max_lag is None else pd.Timedelta(max_lag).to_pytimedelta()
+        self._n_bars = 0
+        self.n_updates = 0
+        self.n_late_updates = 0
+        self.n_dropped_bars = 0
+
+    @property
+    def exchanges(self) -> list[str]:
+        return self._exchanges
+
+    @property
+    def markets(self) -> list[str]:
+        return self._markets
+
+    @property
+    def current_index(self) -> int:
+        return self._n_bars - 1
+
+    def __aiter__(self):
+        return self._stream()
+
+    async def _stream(self):
+        reader, writer = await asyncio.open_connection(self._host, self._port)
+        try:
+            while line := await reader.readline():
+                for feed in self.on_update(json.loads(line)):
+                    yield feed
+            for feed in self._release(None, time.perf_counter()):
+                yield feed
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    def on_update(self, update: dict) -> list[FeedOnce]:
+        """收到一条update，返回因此可以发出的bar"""
+        received_at = time.perf_counter()
+        self.n_updates += 1
+        key = (update["exchange"], update["market"])
+        timestamp = datetime.fromisoformat(update["timestamp"])
+        if self._emitted is not None and timestamp <= self._emitted:
+            self.n_late_updates += 1
+            return []
+
+        values = self._pending.get(timestamp)
+        if values is None:
+            values = self._pending[timestamp] = np.full(
+                (len(self._markets), len(self._exchanges), len(FIELDS)), np.nan
+            )
+        midx, eidx = self._slots[key]
+        values[midx, eidx] = [update[field] for field in FIELDS]
+        self._latest[key] = timestamp
+        if self._newest is None or timestamp > self._newest:
+            self._newest = timestamp
+
+        watermark = None
+        if len(self._latest) == len(self._slots):  # 所有(exchange, market)都收到过update
+            watermark = min(self._latest.values())
+        if self._max_lag is not None:  # 停止推送的(exchange, market)最多让watermark落后max_lag
+            deadline = self._newest - self._max_lag
+            watermark = deadline if watermark is None else max(watermark, deadline)
+        if watermark is None:
+            return []
+        return self._release(watermark, received_at)
+
+    def _release(self, watermark: datetime | None, received_at: float) -> list[FeedOnce]:
+        """发出watermark及之前的所有bar，watermark=None时发出全部"""
+        feeds = []
+        for timestamp in sorted(self._pending):
+            if watermark is not None and timestamp > watermark:
+                break
+            values = self._pending.pop(timestamp)
+            self._emitted = timestamp
+            self._n_bars += 1
+            if np.isnan(values).any():
+                self.n_dropped_bars += 1
+                continue
+            feed = make_feed(timestamp, self._n_bars - 1, values.tolist(), self._exchanges, self._markets)
+            feed.received_at = received_at
+            feeds.append(feed)
+        return feeds
@@ -0,0 +1,131 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+METADATA_FILE = "_dataset.json"
+TIMESTAMP = "timestamp"
+
+
+def to_timestamp(value) -> pd.Timestamp | None:
+    """start/end统一成pd.Timestamp，避免字符串在.loc中按整天匹配"""
+    return None if value is None else pd.Timestamp(value)
+
+
+class PartitionedDataset:
+    """按exchange/market/month分区的列式数据集
+    - 目录布局：{root}/{exchange}/{market}/{YYYY-MM}/{column}.npy，每一列一个.npy文件，timestamp是datetime64[ns]
+    - 读取时只打开时间范围内的分区和需要的列，分区之间相互独立，可以并行写入
+    - root下的_dataset.json标记这是一个数据集，并记录列名
+    """
+
+    def __init__(self, root: Path | str) -> None:
+        self._root = Path(root)
+
+    @staticmethod
+    def exists(root: Path | str) -> bool:
+        return (Path(root) / METADATA_FILE).exists()
+
+    @property
+    def root(self) -> Path:
+        return self._root
+
+    def create(self, columns: list[str]):
+        """写入分区之前调用，记录列名"""
+        self._root.mkdir(parents=True, exist_ok=True)
+        with open(self._root / METADATA_FILE, "w") as fout:
+            json.dump({"columns": columns, "partitioning": ["exchange", "market", "month"]}, fout)
+
+    @property
+    def columns(self) -> list[str]:
+        with open(self._root / METADATA_FILE) as fin:
+            return json.load(fin)["columns"]
+
+    def months(self, exchange: str, market: str) -> list[pd.Period]:
+        market_dir = self._root / exchange / market
+        if not market_dir.exists():
+            return []
+        return sorted(
+            pd.Period(p.name, freq="M") for p in market_dir.iterdir() if p.is_dir() and "." not in p.name
+        )
+
+    def partition_dir(self, exchange: str, market: str, month: pd.Period) -> Path:
+        return self._root / exchange / market / str(month)
+
+    def write_partition(self, exchange: str, market: str, month: pd.Period, df: pd.DataFrame):
+        """写入（覆盖）一个分区，df的index是这个月内的时间
+        先写到临时目录再rename，读者不会看到写了一半的分区
+        """
+        target = self.partition_dir(exchange, market, month)
+        tmp_dir = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+
+        np.save(tmp_dir / f"{TIMESTAMP}.npy", df.index.to_numpy(dtype="datetime64[ns]"))
+        for column in df.columns:
+            np.save(tmp_dir / f"{column}.npy", df[column].to_numpy(dtype=np.float64))
+
+        if target.exists():
+            shutil.rmtree(target)
+        os.replace(tmp_dir, target)
+
+    def write(self, exchange: str, market: str, df: pd.DataFrame):
+        """按月切分之后写入所有分区"""
+        for month, part in df.groupby(df.index.to_period("M")):
+            self.write_partition(exchange, market, month, part)
+
+    def files(
+        self, exchange: str, market: str, start: pd.Timestamp = None, end: pd.Timestamp = None, columns=None
+    ) -> list[Path]:
+        """[start, end]范围内的分区中，timestamp和columns各列的文件"""
+        columns = [TIMESTAMP] + list(columns or self.columns)
+        return [
+            self.partition_dir(exchange, market, month) / f"{column}.npy"
+            for month in self.__months_between(exchange, market, start, end)
+            for column in columns
+        ]
+
+    def __months_between(self, exchange: str, market: str, start: pd.Timestamp, end: pd.Timestamp):
+        months = self.months(exchange, market)
+        if start is not None:
+            months = [m for m in months if m >= pd.Timestamp(start).to_period("M")]
+        if end is not None:
+            months = [m for m in months if m <= pd.Timestamp(end).to_period("M")]
+        return months
+
+    def read(
+        self,
+        exchange: str,
+        market: str,
+        start: pd.Timestamp = None,
+        end: pd.Timestamp = None,
+        columns: list[str] = None,
+    ) -> pd.DataFrame:
+        """读取[start, end]（都包含）之间的数据，只打开范围内的分区和需要的列"""
+        columns = list(columns or self.columns)
+        frames = list(self.iter_months(exchange, market, start, end, columns))
+        if len(frames) == 0:
+            return pd.DataFrame(
+                columns=columns, index=pd.DatetimeIndex([], name=TIMESTAMP), dtype=np.float64
+            )
+        return pd.concat(frames)
+
+    def iter_months(
+        self,
+        exchange: str,
+        market: str,
+        start: pd.Timestamp = None,
+        end: pd.Timestamp = None,
+        columns: list[str] = None,
+    ):
+        """按月依次生成[start, end]之间的数据，每次只有一个分区在内存中"""
+        columns = list(columns or self.columns)
+        start, end = to_timestamp(start), to_timestamp(end)
+        for month in self.__months_between(exchange, market, start, end):
+            partition = self.partition_dir(exchange, market, month)
+            index = pd.DatetimeIndex(np.load(partition / f"{TIMESTAMP}.npy"), name=TIMESTAMP)
+            df = pd.DataFrame({c: np.load(partition / f"{c}.npy") for c in columns}, index=index)
+            if start is not None or end is not None:
+                df = df.loc[start:end]
+            yield df
@@ -0,0 +1,264 @@
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from simulator.arbitrage_trade import FundingArbTrade
+from simulator.metrics import record_mask
+from simulator.strategy import FundingArbStrategy
+
+# 批量结算时直接跳到目标状态的账户字段，顺序与_fast_forward中leg_states一致
+JUMP_FIELDS = ("hold_price", "used_margin", "trade_pnl", "fund_pnl")
+
+
+class EventSkippingStrategy(FundingArbStrategy):
+    """与FundingArbStrategy.run结果相同的回测引擎，但是跳过"平静"的bar
+    大部分bar上只是持仓不动，只需要对每条腿做settle_trading和settle_funding：
+    - mark to market的PnL逐bar telescope，每个bar的保证金只取决于当bar的价格
+    - funding PnL是-rate*shares*mark_price的累加
+    这些bar的结算用向量化的cumsum批量完成。只有可能触发开仓/加仓/换仓/平仓，或者现金可能<=0（margin call）的bar，
+    才走FundingArbStrategy逐bar的流程
+    cumsum按照逐bar结算时完全相同的顺序累加，所以每个账户的最终状态与逐bar回测完全一致；
+    exchange级别的合计由Ledger增量维护，与累加路径有关，metric_history只在浮点误差之内一致
+    journal中这些bar的fundrate差和结算记录也批量写入，条数、顺序和seq与逐bar回测相同
+    """
+
+    MIN_SCAN_ROWS = 64  # 寻找下一个事件时，第一次向前看多少行，之后逐次翻倍
+    MIN_SKIP_BARS = 8  # 批量结算有固定的numpy开销，太短的平静区间还是逐bar处理更快
+
+    def run(self, checkpoint: Path | str = None):
+        assert self._signals is not None, "event skipping needs the whole history, not StreamingDataFeeds"
+        feeds = self._data_feeds
+        self._rows = np.flatnonzero(feeds.valid)
+        self._record_mask = record_mask(feeds.timestamps, self._metrics_period)
+        # exchange -> 每行结算funding的小时数，不结算的行是0
+        self._funding_hours = {
+            ex: self._funding_calendar.hours_array(ex, len(feeds)) for ex in self._config.exchanges
+        }
+        self._exchange_idx = {name: idx for idx, name in enumerate(self._config.exchanges)}
+        self._market_events = {}  # market -> (持仓状态, 下一个事件的位置)
+        self.n_stepped_bars = 0  # 逐bar处理的bar数
+
+        stats = self.stats
+        timer = self._timer()
+        start = time.perf_counter()
+        feed = None
+        pos = int(np.searchsorted(self._rows, feeds.current_index + 1))  # resume之后从checkpoint的位置开始
+        if stats is not None:
+            stats.count(
+                "skipped_nan_bars", (len(feeds) - feeds.current_index - 1) - (len(self._rows) - pos)
+            )
+        while pos < len(self._rows):
+            next_pos = self._next_event(pos)
+            if next_pos - pos >= self.MIN_SKIP_BARS:
+                # 批量结算可能在中途遇到margin call风险而提前停下，从停下的bar开始逐bar处理
+                with timer("fast_forward"):
+                    pos = self._fast_forward(pos, next_pos)
+
+            # 剩下的bar，包括触发事件的那个bar，逐bar处理
+            stop = min(next_pos + 1, len(self._rows))
+            if pos < stop:
+                self._data_feeds.seek(self._rows[pos])
+            for pos in range(pos, stop):
+                feed = next(self._data_feeds)
+                self._on_feed(pos + 1, feed)
+                self.n_stepped_bars += 1
+            pos = stop
+
+        if len(self._rows) > 0 and (
+            feed is None or feed.index != self._rows[-1]
+        ):  # 最后几个bar是批量结算的
+            feeds.seek(self._rows[-1])
+            feed = next(feeds)
+        self._n_bars = len(self._rows)
+        self._last_feed = feed
+
+        if checkpoint is not None:
+            self.save_checkpoint(checkpoint)
+        if feed is not None:  # 没有任何有效的bar时，与FundingArbStrategy.run一样返回空的结果
+            self._finish(feed)
+        if stats is not None:
+            self._report_stats(time.perf_counter() - start)
+
+    def _next_event(self, pos: int) -> int:
+        """从第pos个有效bar开始，第一个需要逐bar处理的位置，没有则返回有效bar的总数"""
+        next_pos = len(self._rows)
+        for midx, market in enumerate(self._config.markets):
+            # 每个market的事件只取决于它自己的持仓状态，状态没变时，上次找到的事件位置仍然有效
+            trade = self._active_arb_trades.get(market)
+            state = None if trade is None else (trade, trade.open_fundrate_diff)
+
+            cached = self._market_events.get(market)
+            if cached is None or cached[0] != state or cached[1] < pos:
+                cached = (state, self._next_market_event(pos, midx, trade))
+                self._market_events[market] = cached
+            next_pos = min(next_pos, cached[1])
+
+        return next_pos
+
+    def _next_market_event(self, pos: int, midx: int, trade: FundingArbTrade) -> int:
+        start, width = pos, self.MIN_SCAN_ROWS
+        while start < len(self._rows):
+            stop = min(start + width, len(self._rows))
+            events = np.flatnonzero(self._event_mask(self._rows[start:stop], midx, trade))
+            if len(events) > 0:
+                return start + int(events[0])
+            start, width = stop, width * 2
+        return len(self._rows)
+
+    def _event_mask(self, rows: np.ndarray, midx: int, trade: FundingArbTrade) -> np.ndarray:
+        """在持仓不变的前提下，这些行上是否会触发close()或open()的动作，与两者的判断条件一一对应"""
+        signals = self._signals
+        above_open = signals.above_open[rows, midx]
+        if trade is None:  # 没有持仓，只要有套利对就开仓
+            return above_open
+
+        fund_rates = self._data_feeds.field("fund_rate")
+        change = 1 + self._config.fundrate_diff_change_pct
+        long_idx = self._exchange_idx[trade.orders["long"].ex_name]
+        short_idx = self._exchange_idx[trade.orders["short"].ex_name]
+        fundrate_diff = fund_rates[rows, midx, short_idx] - fund_rates[rows, midx, long_idx]
+        same_pair = (signals.long_ex[rows, midx] == long_idx) & (signals.short_ex[rows, midx] == short_idx)
+        signal_diff = signals.fundrate_diff[rows, midx]
+
+        return (
+            (fundrate_diff < self._config.fundrate_diff_close)  # 平仓
+            | (above_open & same_pair & (signal_diff >= trade.open_fundrate_diff * change))  # 加仓
+            | (above_open & ~same_pair & (signal_diff >= fundrate_diff * change))  # 换仓
+        )
+
+    def _fast_forward(self, pos: int, stop: int) -> int:
+        """批量结算第[pos, stop)个有效bar，返回实际结算到的位置（不含）"""
+        rows = self._rows[pos:stop]
+        close_prices = self._data_feeds.field("close_price")
+        mark_prices = self._data_feeds.field("mark_price")
+        fund_rates = self._data_feeds.field("fund_rate")
+
+        leg_slots, leg_states = [], []
+        ex_cash_updates = {
+            name: [] for name in self._exchanges
+        }  # 每个exchange每个bar上的现金变化，按发生顺序
+        ex_margin_updates = {name: [] for name in self._exchanges}  # 每条腿的保证金相对于当前的变化
+        journal_diffs, journal_settles = [], []  # 逐bar结算时close()和settle()写入journal的记录
+        for market, trade in self._active_arb_trades.items():
+            midx = self._config.markets.index(market)
+            long_ex, short_ex = trade.orders["long"].exchange, trade.orders["short"].exchange
+            journal_diffs.append(
+                (
+                    (long_ex.market_id(market), long_ex.journal_id, short_ex.journal_id),
+                    (
+                        fund_rates[rows, midx, self._exchange_idx[long_ex.name]],
+                        fund_rates[rows, midx, self._exchange_idx[short_ex.name]],
+                    ),
+                )
+            )
+            for order in trade.orders.values():
+                eidx = self._exchange_idx[order.ex_name]
+                account = order.exchange.get_account(market)
+                shares = account.long_short_shares
+
+                prices = close_prices[rows, midx, eidx]
+                trade_pnl = (prices - np.concatenate([[account.hold_price], prices[:-1]])) * shares
+                margin = abs(shares) * prices * account.margin_rate
+                margin_diff = margin - np.concatenate([[account.used_margin], margin[:-1]])
+                # 与settle_funding的运算顺序相同；不结算funding的bar上是0，累加0不改变结果
+                funding_rate = fund_rates[rows, midx, eidx] * self._funding_hours[order.ex_name][rows]
+                fund_pnl = -funding_rate * shares * mark_prices[rows, midx, eidx]
+                journal_settles.append(
+                    (
+                        (order.exchange.journal_id, order.exchange.market_id(market), order.is_long),
+                        # 不结算funding的bar上，settle记录的是0.0，而不是-0.0
+                        (
+                            trade_pnl,
+                            margin_diff,
+                            np.where(self._funding_hours[order.ex_name][rows] > 0, fund_pnl, 0.0),
+                        ),
+                    )
+                )
+
+                # 与逐个update()的累加顺序相同，累加结果完全一致
+                cum_trade_pnl = np.cumsum(np.concatenate([[account.trade_pnl], trade_pnl]))[1:]
+                cum_fund_pnl = np.cumsum(np.concatenate([[account.fund_pnl], fund_pnl]))[1:]
+                leg_slots.append(account.slot)
+                leg_states.append((prices, margin, cum_trade_pnl, cum_fund_pnl))
+
+                # settle_trading: TRADE_PNL, MARGIN; settle_funding: FUND_PNL
+                ex_cash_updates[order.ex_name].extend([trade_pnl, -margin_diff, fund_pnl])
+                ex_margin_updates[order.ex_name].append(margin - account.used_margin)
+
+        n_bars = len(rows)
+        ex_cash = {}
+        for name, updates in ex_cash_updates.items():
+            cash = self._exchanges[name].cash
+            if len(updates) == 0:
+                ex_cash[name] = np.full(len(rows), cash)
+                continue
+
+            # 每个bar内的每一次现金变化之后都要检查，与Exchange._update_cash一致
+            deltas = np.stack(updates, axis=1)
+            paths = np.cumsum(np.concatenate([[cash], deltas.ravel()]))[1:].reshape(deltas.shape)
+            unsafe = np.flatnonzero((paths <= 0).any(axis=1))
+            if len(unsafe) > 0:
+                n_bars = min(n_bars, int(unsafe[0]))
+            ex_cash[name] = paths[:, -1]
+
+        if n_bars == 0:
+            return pos
+        if self.stats is not None:
+            self.stats.count("bars", n_bars)
+            self.stats.count("fast_forward_bars", n_bars)
+            self.stats.count("settlements", n_bars * len(self._active_arb_trades))
+
+        slots = np.array(leg_slots, dtype=np.intp)
+        states = (
+            np.array(leg_states).reshape(len(leg_slots), len(JUMP_FIELDS), len(rows)).transpose(1, 0, 2)
+        )
+        cash = np.stack([ex_cash[name] for name in self.ledger.exchanges])
+
+        # 风险统计按批更新，exchange的保证金合计是当前合计加上各条腿的变化，必须在_jump_to之前计算
+        total_margin = self.ledger.totals["used_margin"]
+        used_margin = np.stack(
+            [
+                total_margin[idx] + sum(ex_margin_updates[name], np.zeros(len(rows)))
+                for idx, name in enumerate(self.ledger.exchanges)
+            ]
+        )
+        timestamps = self._data_feeds.timestamps
+        # journal与逐bar结算时一样，记录这些bar上的fundrate差和结算
+        self.journal.hold_bars(
+            timestamps[rows[:n_bars]],
+            [(*ids, *(values[:n_bars] for values in arrays)) for ids, arrays in journal_diffs],
+            [(*ids, *(values[:n_bars] for values in arrays)) for ids, arrays in journal_settles],
+        )
+        self.risk.update_batch(
+            pd.Timestamp(timestamps[rows[0]]).to_pydatetime(),
+            pd.Timestamp(timestamps[rows[n_bars - 1]]).to_pydatetime(),
+            cash[:, :n_bars],
+            used_margin[:, :n_bars],
+        )
+
+        for k in np.flatnonzero(self._record_mask[rows[:n_bars]]):
+            self._jump_to(slots, states, cash, k)
+            self._record_metrics(pd.Timestamp(self._data_feeds.timestamps[rows[k]]).to_pydatetime())
+        self._jump_to(slots, states, cash, n_bars - 1)
+
+        # close()在每个bar上都会更新latest_fundrate_diff
+        last_row = rows[n_bars - 1]
+        for market, trade in self._active_arb_trades.items():
+            midx = self._config.markets.index(market)
+            long_idx = self._exchange_idx[trade.orders["long"].ex_name]
+            short_idx = self._exchange_idx[trade.orders["short"].ex_name]
+            trade.latest_fundrate_diff = float(fund_rates[last_row, midx, short_idx]) - float(
+                fund_rates[last_row, midx, long_idx]
+            )
+
+        return pos + n_bars
+
+    def _jump_to(self, slots: np.ndarray, states: np.ndarray, cash: np.ndarray, k: int):
+        """将所有账户设置为批量结算区间内第k个bar结算之后的状态
+        - slots: 各条腿在ledger中的位置
+        - states: shape=(len(JUMP_FIELDS), leg, bar)
+        - cash: shape=(exchange, bar)，exchange的顺序与ledger一致
+        """
+        for field, values in zip(JUMP_FIELDS, states):
+            self.ledger.batch_set(field, slots, values[:, k])
+        np.frombuffer(self.ledger.cash)[:] = cash[:, k]
@@ -1,26 +1,206 @@
+import numpy as np
 import pandas as pd
+from array import array
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import datetime
 import logging
 from prettytable import PrettyTable
 from enum import Enum
+from simulator.instrument import RunStats
+from simulator.journal import Journal
+from simulator.metrics import MetricsRecorder
+
+# metric_history中exchange合计的列，per-market的列在其后，见Exchange.__init__
+METRIC_COLUMNS = ["total_value", "cash", "used_margin", "trade_pnl", "fund_pnl"]
 
 # 资金变化反映在哪个会议科目上
 CashItem = Enum("CashItem", ["MARGIN", "TRADE_PNL", "FUND_PNL"])
 
 
+class Ledger:
+    """所有(exchange, market)账户的struct-of-arrays账本
+    - 每个账户字段是一段连续的double数组(array.array)，下标是slot=exchange_idx*n_markets+market_idx
+      单个读写得到的是python float，比numpy标量快；批量操作时用view()得到零拷贝的numpy数组
+    - used_margin/trade_pnl/fund_pnl在exchange级别的合计随每次写入增量维护，record_metrics不必重新求和
+    - cash是exchange级别的，每个exchange一个
+    - 支持可嵌套的事务：begin之后的每次写入都在undo log中记下旧值，rollback时逆序恢复；
+      没有事务时undo为None，写入不做任何记录
+    """
+
+    ACCOUNT_FIELDS = ("long_short_shares", "hold_price", "used_margin", "trade_pnl", "fund_pnl", "margin_rate")
+    TOTAL_FIELDS = ("used_margin", "trade_pnl", "fund_pnl")
+
+    def __init__(self, exchanges: list[str], markets: list[str]) -> None:
+        self.exchanges = list(exchanges)
+        self.markets = list(markets)
+        self.n_markets = len(self.markets)
+
+        n_accounts = len(self.exchanges) * self.n_markets
+        self.columns = {field: array("d", bytes(8 * n_accounts)) for field in self.ACCOUNT_FIELDS}
+        self.totals = {field: array("d", bytes(8 * len(self.exchanges))) for field in self.TOTAL_FIELDS}
+        self.cash = array("d", bytes(8 * len(self.exchanges)))
+
+        self.undo: list[tuple] = None  # (数组, 下标, 旧值)
+        self._savepoints: list[int] = []  # 每层事务开始时undo log的长度
+
+    def exchange_idx(self, exchange: str) -> int:
+        return self.exchanges.index(exchange)
+
+    def slot(self, exchange: str, market: str) -> int:
+        return self.exchanges.index(exchange) * self.n_markets + self.markets.index(market)
+
+    def set(self, field: str, slot: int, value: float) -> None:
+        column = self.columns[field]
+        total = self.totals.get(field)
+        if self.undo is not None:
+            self.log(column, slot)
+            if total is not None:
+                self.log(total, slot // self.n_markets)
+
+        if total is not None:
+            total[slot // self.n_markets] += value - column[slot]
+        column[slot] = value
+
+    def add(self, field: str, slot: int, delta: float) -> None:
+        column = self.columns[field]
+        total = self.totals.get(field)
+        if self.undo is not None:
+            self.log(column, slot)
+            if total is not None:
+                self.log(total, slot // self.n_markets)
+
+        column[slot] += delta
+        if total is not None:
+            total[slot // self.n_markets] += delta
+
+    def view(self, field: str) -> np.ndarray:
+        """零拷贝的numpy视图，写入会直接反映到账本中，但不会更新合计，批量写入请用batch_add/batch_set"""
+        return np.frombuffer(self.columns[field], dtype=np.float64)
+
+    def batch_add(self, field: str, slots: np.ndarray, deltas: np.ndarray) -> None:
+        """一次性对多个账户的field加上deltas，slots可以重复"""
+        slots = np.asarray(slots, dtype=np.intp)
+        deltas = np.broadcast_to(np.asarray(deltas, dtype=np.float64), slots.shape)
+        self.__log_batch(field, slots)
+        np.add.at(self.view(field), slots, deltas)
+        if field in self.totals:
+            np.add.at(np.frombuffer(self.totals[field]), slots // self.n_markets, deltas)
+
+    def batch_set(self, field: str, slots: np.ndarray, values: np.ndarray) -> None:
+        """一次性设置多个账户的field，slots不能重复"""
+        slots = np.asarray(slots, dtype=np.intp)
+        self.__log_batch(field, slots)
+        column = self.view(field)
+        if field in self.totals:
+            deltas = np.asarray(values, dtype=np.float64) - column[slots]
+            np.add.at(np.frombuffer(self.totals[field]), slots // self.n_markets, deltas)
+        column[slots] = values
+
+    # ------------------------------ transaction
+    def begin(self) -> None:
+        """开始一个事务，可以嵌套"""
+        if self.undo is None:
+            self.undo = []
+        self._savepoints.append(len(self.undo))
+
+    def commit(self) -> None:
+        """提交最内层的事务，它的undo记录归入外层事务；最外层事务提交时丢弃undo log"""
+        self._savepoints.pop()
+        if not self._savepoints:
+            self.undo = None
+
+    def rollback(self) -> None:
+        """撤销最内层事务开始之后的所有写入"""
+        start = self._savepoints.pop()
+        for column, index, old in reversed(self.undo[start:]):
+            column[index] = old
+        del self.undo[start:]
+        if not self._savepoints:
+            self.undo = None
+
+    def log(self, column, index) -> None:
+        """在undo log中记下column[index]的旧值，只在事务中调用"""
+        self.undo.append((column, index, column[index]))
+
+    def __log_batch(self, field: str, slots: np.ndarray):
+        if self.undo is None:
+            return
+        column = self.view(field)
+        self.undo.append((column, slots, column[slots].copy()))
+        if field in self.totals:
+            total = np.frombuffer(self.totals[field])
+            self.undo.append((total, slice(None), total.copy()))
+
+
+# AccountSnapshot中除market之外的字段，顺序与AccountSnapshot的定义一致
+SNAPSHOT_FIELDS = ("margin_rate", "long_short_shares", "hold_price", "used_margin", "trade_pnl", "fund_pnl")
+
+
+@dataclass(slots=True)
+class AccountSnapshot:
+    """脱离Ledger的账户快照，copy(PerpsAccount)的结果"""
+
+    market: str
+    margin_rate: float
+    long_short_shares: float
+    hold_price: float
+    used_margin: float
+    trade_pnl: float
+    fund_pnl: float
+
+
+class _LedgerField:
+    """PerpsAccount上的字段，读写直接作用在Ledger对应的数组上"""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, account: "PerpsAccount", owner=None):
+        if account is None:
+            return self
+        return account._columns[self.name][account._slot]
+
+    def __set__(self, account: "PerpsAccount", value: float):
+        account._ledger.set(self.name, account._slot, value)
+
+
 class PerpsAccount:
-    def __init__(self, market: str, margin_rate: float, cash_callback) -> None:
+    """Ledger中一个(exchange, market)账户的视图，不传ledger时自带一个只有一个账户的Ledger"""
+
+    margin_rate = _LedgerField()
+    long_short_shares = _LedgerField()  # >0, long; <0, short.之所以不叫shares，提醒我这个shares能正能负
+    hold_price = _LedgerField()
+    used_margin = _LedgerField()
+    trade_pnl = _LedgerField()  # 由买卖产生的PnL
+    fund_pnl = _LedgerField()  # 根据funding rate带来的支出或收入
+
+    def __init__(
+        self, market: str, margin_rate: float, cash_callback, ledger: Ledger = None, slot: int = None
+    ) -> None:
         self.market = market
+        if ledger is None:
+            ledger = Ledger(exchanges=[""], markets=[market])
+            slot = 0
+        self._ledger = ledger
+        self._columns = ledger.columns
+        self._slot = slot
         self.margin_rate = margin_rate
 
-        self.long_short_shares = 0  # >0, long; <0, short.之所以不叫shares，提醒我这个shares能正能负
-        self.hold_price = 0
-        self.used_margin = 0
-        self.trade_pnl = 0  # 由买卖产生的PnL
-        self.fund_pnl = 0  # 根据funding rate带来的支出或收入
-
         self._cash_callback = cash_callback
 
+    @property
+    def slot(self) -> int:
+        return self._slot
+
+    def __copy__(self) -> AccountSnapshot:
+        return AccountSnapshot(self.market, *(self._columns[field][self._slot] for field in SNAPSHOT_FIELDS))
+
+    def assign(self, snapshot: AccountSnapshot) -> None:
+        """把快照的状态写回ledger，用于回滚"""
+        for field in SNAPSHOT_FIELDS:
+            self._ledger.set(field, self._slot, getattr(snapshot, field))
+
     def update(self, cash_item: CashItem, delta_cash: float):
         """account账户下的cash_item这个会计科目，导致了delta_cash的资金变化
         - cash_item：资金变化反映在哪个会计科目上
@@ -32,109 +212,239 @@ class PerpsAccount:
             case CashItem.MARGIN:
                 # delta_cash>0，cash账户增加，是因为释放保证金，所以used_margin减少
                 # delta_cash<0，cash账户减少，是因为追加保证金，所以used_margin增加
-                self.used_margin -= delta_cash
+                self._ledger.add("used_margin", self._slot, -delta_cash)
             case CashItem.TRADE_PNL:
-                self.trade_pnl += delta_cash  # PnL的变化应该与cash变化同向
+                self._ledger.add("trade_pnl", self._slot, delta_cash)  # PnL的变化应该与cash变化同向
             case CashItem.FUND_PNL:
-                self.fund_pnl += delta_cash
+                self._ledger.add("fund_pnl", self._slot, delta_cash)
             case _:
                 raise ValueError(f"Unknown CashItem={cash_item}")
 
 
 class MarginCall(Exception):
-    pass
+    """args[0]是发生margin call的exchange的名字"""
+
+    @property
+    def exchange(self) -> str:
+        return self.args[0] if self.args else None
+
+
+@contextmanager
+def transaction(*exchanges: "Exchange"):
+    """多个exchange上的一个事务，with块中抛出异常时全部回滚，异常继续向外抛出
+    共享同一个ledger的exchange只开启一次事务；可以嵌套
+    """
+    ledgers = list({id(exchange.ledger): exchange.ledger for exchange in exchanges}.values())
+    for ledger in ledgers:
+        ledger.begin()
+    try:
+        yield
+    except BaseException:
+        for ledger in reversed(ledgers):
+            ledger.rollback()
+        raise
+    for ledger in reversed(ledgers):
+        ledger.commit()
 
 
 class Exchange:
-    def __init__(self, name: str, init_cash: float, markets: dict[str, float], commission: float) -> None:
+    def __init__(
+        self,
+        name: str,
+        init_cash: float,
+        markets: dict[str, float],
+        commission: float,
+        journal: Journal = None,
+        ledger: Ledger = None,
+        metrics_per_market: bool = False,
+        metrics_check_every: int = 1,
+        metrics_capacity: int = 64,
+    ) -> None:
+        """
+        - ledger: 多个exchange可以共享同一个Ledger，为None时自己建一个
+        - metrics_per_market: metric_history中是否还有每个market的{market}_used_margin/trade_pnl/fund_pnl
+        - metrics_check_every: 每记录多少次metrics检查一次会计恒等式，0表示不检查
+        - metrics_capacity: 预计记录metrics的次数，超过时自动扩容
+        """
         self.name = name
 
+        # 成交等记录写入journal，多个exchange可以共享同一个journal
+        self.journal = journal if journal is not None else Journal()
+        self.journal_id = self.journal.exchange_id(name)
+        self._market_ids = {market: self.journal.market_id(market) for market in markets}
+
+        self.ledger = ledger if ledger is not None else Ledger(exchanges=[name], markets=list(markets))
+        self._ledger_idx = self.ledger.exchange_idx(name)
+
         self.__init_cash = init_cash
-        self.__cash = init_cash  # 可用资金
+        self.ledger.cash[self._ledger_idx] = init_cash  # 可用资金
         self.commission = commission
 
         self._perps_accounts = {
-            market: PerpsAccount(market, margin_rate, cash_callback=self._update_cash)
+            market: PerpsAccount(
+                market,
+                margin_rate,
+                cash_callback=self._update_cash,
+                ledger=self.ledger,
+                slot=self.ledger.slot(name, market),
+            )
             for market, margin_rate in markets.items()
         }
 
-        self._metrics = []
+        # 热点路径上直接读写ledger的数组，不经过PerpsAccount
+        columns = self.ledger.columns
+        self._cash = self.ledger.cash
+        self._slots = {market: account.slot for market, account in self._perps_accounts.items()}
+        self._shares = columns["long_short_shares"]
+        self._hold_price = columns["hold_price"]
+        self._used_margin = columns["used_margin"]
+        self._margin_rate = columns["margin_rate"]
+        # 每个会计科目：(账户数组, exchange合计数组, 与cash变化的方向)
+        totals = self.ledger.totals
+        self._margin_book = (columns["used_margin"], totals["used_margin"], -1)
+        self._trade_pnl_book = (columns["trade_pnl"], totals["trade_pnl"], 1)
+        self._fund_pnl_book = (columns["fund_pnl"], totals["fund_pnl"], 1)
+
+        # per-market的列直接读ledger中这个exchange的账户
+        self._metric_slots = list(self._slots.values()) if metrics_per_market else []
+        columns = METRIC_COLUMNS + [
+            f"{market}_{field}" for market in self._slots if metrics_per_market for field in Ledger.TOTAL_FIELDS
+        ]
+        self.metrics = MetricsRecorder(columns, capacity=metrics_capacity)
+        self._metrics_check_every = metrics_check_every
+        self.stats: RunStats = None  # 不为None时记录成交、结算和margin call的次数
 
     @property
     def cash(self):
-        return self.__cash
+        return self.ledger.cash[self._ledger_idx]
 
     @cash.setter
     def cash(self, value: float):
-        self.__cash = value
+        if self.ledger.undo is not None:
+            self.ledger.log(self._cash, self._ledger_idx)
+        self._cash[self._ledger_idx] = value
+
+    # ------------------------------ transaction
+    # 事务作用于exchange所在的整个ledger，多个exchange上的操作请用transaction(*exchanges)
+    def begin(self) -> None:
+        self.ledger.begin()
+
+    def commit(self) -> None:
+        self.ledger.commit()
+
+    def rollback(self) -> None:
+        self.ledger.rollback()
+
+    def market_id(self, market: str) -> int:
+        """market在journal中的id"""
+        return self._market_ids[market]
 
     def get_account(self, market: str) -> PerpsAccount:
         return self._perps_accounts[market]
 
     def set_account(self, market: str, account: PerpsAccount) -> None:
-        """主要用于回滚操作，将某个market状态回滚至操作前的状态"""
-        self._perps_accounts[market] = account
+        """将某个market的状态设置为account（一般是copy得到的快照）
+        账户对象本身不变，只是把account的状态写回ledger
+        """
+        self._perps_accounts[market].assign(account)
+
+    def _margin_call(self, delta_cash: float):
+        if self.stats is not None:
+            self.stats.count("exchange.margin_calls")
+        if not self.journal.silent:
+            logging.critical(f"🚨😱💣Not Enough Margin: original cash={self.cash},delta_cash={delta_cash}")
+        raise MarginCall(self.name)
 
     def _update_cash(self, delta_cash: float):
-        temp = self.__cash + delta_cash
+        cash = self._cash
+        temp = cash[self._ledger_idx] + delta_cash
         if temp <= 0:
-            logging.critical(f"🚨😱💣Not Enough Margin: original cash={self.__cash},delta_cash={delta_cash}")
-            raise MarginCall()
-        self.__cash = temp
+            self._margin_call(delta_cash)
+        if self.ledger.undo is not None:
+            self.ledger.log(cash, self._ledger_idx)
+        cash[self._ledger_idx] = temp
+
+    def _book(self, slot: int, book: tuple, delta_cash: float):
+        """与PerpsAccount.update相同，但是直接操作ledger的数组，同时更新exchange的合计"""
+        idx = self._ledger_idx
+        cash = self._cash
+        temp = cash[idx] + delta_cash
+        if temp <= 0:
+            self._margin_call(delta_cash)
+
+        column, total, sign = book
+        if self.ledger.undo is not None:
+            self.ledger.log(cash, idx)
+            self.ledger.log(column, slot)
+            self.ledger.log(total, idx)
+
+        cash[idx] = temp
+        delta = sign * delta_cash
+        column[slot] += delta
+        total[idx] += delta
+
+    def _log_position(self, slot: int):
+        """事务中，记下持仓和持仓价格的旧值"""
+        if self.ledger.undo is not None:
+            self.ledger.log(self._shares, slot)
+            self.ledger.log(self._hold_price, slot)
 
     def _close(self, market: str, is_long: int, price: float, shares: float):
-        account = self._perps_accounts[market]
+        slot = self._slots[market]
+        long_short_shares = self._shares
 
-        reduce_margin = shares / abs(account.long_short_shares) * account.used_margin  # 肯定是个正数
-        account.update(cash_item=CashItem.MARGIN, delta_cash=reduce_margin)  # 释放保证金
+        reduce_margin = shares / abs(long_short_shares[slot]) * self._used_margin[slot]  # 肯定是个正数
+        self._book(slot, self._margin_book, reduce_margin)  # 释放保证金
 
         # is_long>0，买入平仓，说明平的是空仓，price < hold_price才profit
         # is_long<0，卖出平仓，说明平的是多仓，price > hold_price才profit
-        pnl = -is_long * (price - account.hold_price) * shares
-        account.update(cash_item=CashItem.TRADE_PNL, delta_cash=pnl)
+        pnl = -is_long * (price - self._hold_price[slot]) * shares
+        self._book(slot, self._trade_pnl_book, pnl)
 
         # is_long>0，买入平仓，说明平的是空仓，原来的long_short_shares<0，加上正shares，持仓才变小
         # is_long<0，卖出平仓，说明平的是多仓，原来的long_short_shares>0，加上负shares，持仓才变小
         # 另外，平仓时不用更新hold price，因为PnL被转移到cash账户中了，不在资产帐户中
-        old_shares = account.long_short_shares
-        account.long_short_shares += is_long * shares
-        assert abs(account.long_short_shares) < abs(old_shares)
+        self._log_position(slot)
+        old_shares = long_short_shares[slot]
+        long_short_shares[slot] += is_long * shares
+        assert abs(long_short_shares[slot]) < abs(old_shares)
 
-        if abs(account.long_short_shares) <= 1e-6:
-            account.hold_price = 0
+        if abs(long_short_shares[slot]) <= 1e-6:
+            self._hold_price[slot] = 0
 
-        logging.info(
-            f"[{self.name:>8}] --CLOSE-- {'BUY ' if is_long>0 else 'SELL'} [{market}] at price={price:.4f} for {shares:.4f} shares"
-        )
+        self.journal.fill(self.journal_id, self._market_ids[market], is_long, False, price, shares, -reduce_margin)
 
     def _open(self, market: str, is_long: int, price: float, shares: float):
-        account = self._perps_accounts[market]
+        slot = self._slots[market]
+        long_short_shares = self._shares
 
-        new_margin = shares * price * account.margin_rate  # 新建仓位需要的保证金
-        account.update(cash_item=CashItem.MARGIN, delta_cash=-new_margin)
+        new_margin = shares * price * self._margin_rate[slot]  # 新建仓位需要的保证金
+        self._book(slot, self._margin_book, -new_margin)
 
-        old_shares = abs(account.long_short_shares)
-        account.long_short_shares += is_long * shares
-        assert abs(account.long_short_shares) > old_shares
+        self._log_position(slot)
+        old_shares = abs(long_short_shares[slot])
+        long_short_shares[slot] += is_long * shares
+        assert abs(long_short_shares[slot]) > old_shares
 
-        total_cost = old_shares * account.hold_price + shares * price
-        account.hold_price = total_cost / abs(account.long_short_shares)
-        logging.info(
-            f"[{self.name:>8}] ++OPEN++ {'BUY ' if is_long>0 else 'SELL'} [{market}] at price={price:.4f} for {shares:.4f} shares"
-        )
+        total_cost = old_shares * self._hold_price[slot] + shares * price
+        self._hold_price[slot] = total_cost / abs(long_short_shares[slot])
+        self.journal.fill(self.journal_id, self._market_ids[market], is_long, True, price, shares, new_margin)
 
     def trade(self, market: str, is_long: int, price: float, shares: float) -> None:
         assert shares > 0
-        account = self._perps_accounts[market]
+        if self.stats is not None:
+            self.stats.count("exchange.trades")
+        slot = self._slots[market]
+        current_shares = self._shares[slot]
 
-        if is_long * account.long_short_shares >= 0:  # 本次交易方向与目前持仓方向相同，无需先平仓
+        if is_long * current_shares >= 0:  # 本次交易方向与目前持仓方向相同，无需先平仓
             close_shares = 0
         else:
-            close_shares = min(abs(account.long_short_shares), shares)
+            close_shares = min(abs(current_shares), shares)
         open_shares = shares - close_shares
 
         fee = price * shares * self.commission
-        account.update(cash_item=CashItem.TRADE_PNL, delta_cash=-fee)
+        self._book(slot, self._trade_pnl_book, -fee)
 
         if close_shares > 0:  # 先平仓
             self._close(market=market, is_long=is_long, price=price, shares=shares)
@@ -149,78 +459,84 @@ class Exchange:
         self.trade(market=market, is_long=-1, price=price, shares=shares)
 
     def clear(self, market: str, price: float):
-        account = self._perps_accounts[market]
-        is_long = 1 if account.long_short_shares < 0 else -1  # 平仓时的交易方向肯定与当前持仓方向相反
-        self.trade(market=market, is_long=is_long, price=price, shares=abs(account.long_short_shares))
+        current_shares = self._shares[self._slots[market]]
+        is_long = 1 if current_shares < 0 else -1  # 平仓时的交易方向肯定与当前持仓方向相反
+        self.trade(market=market, is_long=is_long, price=price, shares=abs(current_shares))
 
     def settle_trading(self, market: str, price: float):
-        account = self._perps_accounts[market]
-        assert abs(account.long_short_shares) > 1e-6, "zero-position account has NO chance to be settled"
+        slot = self._slots[market]
+        long_short_shares = self._shares[slot]
+        assert abs(long_short_shares) > 1e-6, "zero-position account has NO chance to be settled"
+        if self.stats is not None:
+            self.stats.count("exchange.settle_trading")
 
         # ----------- mark to market
         # long_short_shares>0，持有多仓，price>hold_price才profit
         # long_short_shares<0，持有空仓，price<hold_price才profit
-        pnl = (price - account.hold_price) * account.long_short_shares
-        account.update(cash_item=CashItem.TRADE_PNL, delta_cash=pnl)
-        account.hold_price = price  # mark to market
+        pnl = (price - self._hold_price[slot]) * long_short_shares
+        self._book(slot, self._trade_pnl_book, pnl)
+        self._log_position(slot)
+        self._hold_price[slot] = price  # mark to market
 
         # ----------- new margin requirement
-        new_margin = abs(account.long_short_shares) * price * account.margin_rate
-        margin_diff = new_margin - account.used_margin
-        account.update(cash_item=CashItem.MARGIN, delta_cash=-margin_diff)
-        
+        new_margin = abs(long_short_shares) * price * self._margin_rate[slot]
+        margin_diff = new_margin - self._used_margin[slot]
+        self._book(slot, self._margin_book, -margin_diff)
+
         return pnl, margin_diff
 
     def settle_funding(self, market: str, mark_price: float, funding_rate: float):
-        account = self._perps_accounts[market]
-        assert abs(account.long_short_shares) > 1e-6, "zero-position account has NO chance to be settled"
+        slot = self._slots[market]
+        long_short_shares = self._shares[slot]
+        assert abs(long_short_shares) > 1e-6, "zero-position account has NO chance to be settled"
+        if self.stats is not None:
+            self.stats.count("exchange.settle_funding")
 
         # long_short_shares>0==>long position, funding_rate>0==>long pay short, pnl<0
         # long_short_shares>0==>long position, funding_rate<0==>short pay long, pnl>0
         # long_short_shares<0==>short position, funding_rate<0==>short pay long, pnl<0
         # long_short_shares<0==>short position, funding_rate>0==>long pay short, pnl>0
-        pnl = -funding_rate * account.long_short_shares * mark_price
-        account.update(cash_item=CashItem.FUND_PNL, delta_cash=pnl)
+        pnl = -funding_rate * long_short_shares * mark_price
+        self._book(slot, self._fund_pnl_book, pnl)
         return pnl
 
     def record_metrics(self, timestamp: datetime) -> dict:
-        total_used_margin = 0
-        total_trade_pnl = 0
-        total_fund_pnl = 0
-        for account in self._perps_accounts.values():
-            total_used_margin += account.used_margin
-            total_trade_pnl += account.trade_pnl
-            total_fund_pnl += account.fund_pnl
-        total_value = self.__cash + total_used_margin
-        assert abs(self.__init_cash + total_trade_pnl + total_fund_pnl - total_value) < 1e-6
-
-        metric = dict(
-            timestamp=timestamp,
-            used_margin=total_used_margin,
-            cash=self.__cash,
-            total_value=total_value,
-            trade_pnl=total_trade_pnl,
-            fund_pnl=total_fund_pnl,
-        )
+        """记录一行metrics，timestamp=None时只返回当前的值，不记录（用于debug）"""
+        # 合计由ledger增量维护，不必遍历所有账户
+        idx = self._ledger_idx
+        totals = self.ledger.totals
+        total_used_margin = totals["used_margin"][idx]
+        total_trade_pnl = totals["trade_pnl"][idx]
+        total_fund_pnl = totals["fund_pnl"][idx]
+        cash = self._cash[idx]
+        total_value = cash + total_used_margin
+
+        # 会计恒等式只在抽样的记录上检查，debug时总是检查
+        check_every = self._metrics_check_every
+        if timestamp is None or (check_every > 0 and len(self.metrics) % check_every == 0):
+            assert abs(self.__init_cash + total_trade_pnl + total_fund_pnl - total_value) < 1e-6
+
+        row = [total_value, cash, total_used_margin, total_trade_pnl, total_fund_pnl]
+        if self._metric_slots:
+            columns = self.ledger.columns
+            for slot in self._metric_slots:
+                row += [columns[field][slot] for field in Ledger.TOTAL_FIELDS]
 
         if timestamp is not None:  # 算是隐藏控制选项，timestamp=None用于debug
-            self._metrics.append(metric)
+            self.metrics.append(timestamp, row)
 
-        return metric
+        return dict(timestamp=timestamp, **dict(zip(self.metrics.columns, row)))
 
     @property
-    def metric_history(self):
-        df = pd.DataFrame(self._metrics)
-        df.set_index("timestamp", inplace=True)
-        df = df.loc[:, ["total_value", "cash", "used_margin", "trade_pnl", "fund_pnl"]]  # reorder columns
-        return df
+    def metric_history(self) -> pd.DataFrame:
+        """零拷贝地引用MetricsRecorder中的数组"""
+        return self.metrics.frame()
 
     def inspect(self):
         # ---------- summary
-        metric_keys = ["total_value", "cash", "used_margin", "trade_pnl", "fund_pnl"]
-        pt = PrettyTable(metric_keys, title=f"Summary Exchange[{self.name}]")
+        pt = PrettyTable(METRIC_COLUMNS, title=f"Summary Exchange[{self.name}]")
         metric = self.record_metrics(None)
-        pt.add_row([f"{metric[k]:.3f}" for k in metric_keys])
+        pt.add_row([f"{metric[k]:.3f}" for k in METRIC_COLUMNS])
         logging.info(pt)
         # ---------- each account
         pt = PrettyTable(
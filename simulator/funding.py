@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+DEFAULT_FUNDING_INTERVAL = "1h"
+
+
+class FundingCalendar:
+    """每个exchange的funding结算时刻
+    - 数据中的fund_rate都是小时费率，结算周期为N小时的exchange，每次结算支付rate*N
+    - 每个结算周期内第一个有效bar结算funding，其余的bar只mark to market
+    - 小时bar+1h结算周期时，每个有效bar都结算，与原来逐bar结算完全相同
+    - index()之后预先计算成稀疏的行号索引，at()只是一次dict查找；没有index()时（流式数据）逐bar比较所在的结算周期
+    """
+
+    def __init__(self, exchanges: list[str], intervals: dict[str, str] = None) -> None:
+        """intervals: exchange -> 结算周期（pandas的时间间隔，例如"1h"，"8h"），没有指定的exchange每小时结算"""
+        intervals = intervals or {}
+        self._exchanges = exchanges
+        self._periods = {
+            ex: pd.Timedelta(intervals.get(ex, DEFAULT_FUNDING_INTERVAL)).value for ex in exchanges
+        }  # 纳秒
+        self.hours = {ex: period / pd.Timedelta("1h").value for ex, period in self._periods.items()}
+
+        self.rows: dict[str, np.ndarray] = None  # exchange -> 结算funding的行号，升序
+        self._events: dict[int, dict[str, float]] = None  # 行号 -> {exchange: 结算的小时数}
+        self._last_periods: dict[str, int] = {}  # 流式数据时，每个exchange上一次结算所在的周期
+
+    def index(self, timestamps: np.ndarray, valid: np.ndarray):
+        """由整个时间轴预先计算所有结算时刻
+        - timestamps: datetime64[ns], shape=(time,)
+        - valid: bool, shape=(time,)，只在有效的行上结算
+        """
+        valid_rows = np.flatnonzero(valid)
+        nanos = np.asarray(timestamps, dtype="datetime64[ns]")[valid_rows].view(np.int64)
+
+        self.rows = {}
+        self._events = {}
+        for ex, period in self._periods.items():
+            # 每个结算周期内的第一个有效行
+            _, first = np.unique(nanos // period, return_index=True)
+            self.rows[ex] = valid_rows[first]
+            for row in self.rows[ex].tolist():
+                self._events.setdefault(row, {})[ex] = self.hours[ex]
+
+    def at(self, row: int, timestamp: datetime) -> dict[str, float]:
+        """第row行（时刻timestamp）上需要结算funding的exchange -> 结算的小时数，没有exchange结算时返回空dict"""
+        if self._events is not None:
+            return self._events.get(row, {})
+
+        nanos = pd.Timestamp(timestamp).value
+        events = {}
+        for ex, period in self._periods.items():
+            current = nanos // period
+            if self._last_periods.get(ex) != current:
+                self._last_periods[ex] = current
+                events[ex] = self.hours[ex]
+        return events
+
+    def hours_array(self, exchange: str, n_rows: int) -> np.ndarray:
+        """dense的数组，结算funding的行上是结算的小时数，其余行是0，用于批量结算"""
+        hours = np.zeros(n_rows)
+        hours[self.rows[exchange]] = self.hours[exchange]
+        return hours
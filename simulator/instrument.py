@@ -0,0 +1,95 @@
+import time
+import numpy as np
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from prettytable import PrettyTable
+
+# 回测循环中计时的各个阶段；decision只在纸面交易时有，是从bar的行情到齐到完成决策的延迟
+PHASES = ("feed", "logging", "close", "open", "settle", "risk", "metrics", "fast_forward", "decision")
+PERCENTILES = (50, 90, 99)
+# 总是出现在结果中的计数，没有发生时是0
+COUNTERS = (
+    "bars",
+    "skipped_nan_bars",
+    "opens",
+    "adds",
+    "switches",
+    "closes",
+    "margin_call_rollbacks",
+    "settlements",
+    "exchange.trades",
+    "exchange.settle_trading",
+    "exchange.settle_funding",
+    "exchange.margin_calls",
+)
+
+
+_NULL_CONTEXT = nullcontext()
+
+
+def null_timer(phase: str):
+    """关闭instrument时代替RunStats.timer，什么也不记录"""
+    return _NULL_CONTEXT
+
+
+class RunStats:
+    """回测的计时与计数，Config.instrument=True时才创建
+    - 关闭时strategy和exchange上的stats是None，计数只多一次is None判断，计时用什么也不做的null_timer
+    - timings: phase -> 每次调用的耗时（秒），用于计算累计耗时和分位数
+    - counters: 事件名 -> 次数，exchange上的事件以"exchange."开头
+    """
+
+    def __init__(self) -> None:
+        self.timings: dict[str, list[float]] = {phase: [] for phase in PHASES}
+        self.counters: Counter = Counter(dict.fromkeys(COUNTERS, 0))
+        self.wall_seconds = 0.0
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        self.timings[phase].append(seconds)
+
+    @contextmanager
+    def timer(self, phase: str):
+        """with stats.timer(phase): 记录with块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def phase_summary(self, phase: str) -> dict:
+        durations = np.asarray(self.timings[phase])
+        summary = {"calls": len(durations), "total": float(durations.sum()) if len(durations) > 0 else 0.0}
+        if len(durations) > 0:
+            summary["mean"] = summary["total"] / len(durations)
+            for q, value in zip(PERCENTILES, np.percentile(durations, PERCENTILES)):
+                summary[f"p{q}"] = float(value)
+            summary["max"] = float(durations.max())
+        return summary
+
+    def to_dict(self) -> dict:
+        return {
+            "wall_seconds": self.wall_seconds,
+            "phases": {phase: self.phase_summary(phase) for phase in PHASES if self.timings[phase]},
+            "counters": dict(self.counters),
+        }
+
+    def report(self) -> str:
+        stats = self.to_dict()
+        columns = ["calls", "total", "mean"] + [f"p{q}" for q in PERCENTILES] + ["max"]
+
+        pt = PrettyTable(["phase"] + [c if c == "calls" else f"{c}(us)" for c in columns] + ["share"])
+        for phase, summary in stats["phases"].items():
+            share = summary["total"] / self.wall_seconds if self.wall_seconds > 0 else 0.0
+            pt.add_row(
+                [phase, summary["calls"]]
+                + [f"{summary[c] * 1e6:,.1f}" for c in columns[1:]]
+                + [f"{share:.1%}"]
+            )
+
+        counters = PrettyTable(["counter", "value"])
+        for name, value in stats["counters"].items():
+            counters.add_row([name, value])
+        return f"wall time: {self.wall_seconds:.3f}s\n{pt}\n{counters}"
@@ -0,0 +1,238 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from datetime import datetime
+from simulator.arbitrage_trade import FundingArbTrade
+from simulator.data_feeds import DataFeeds
+from simulator.exchange import Ledger
+from simulator.risk import RiskStats, RiskTracker, span_years
+from simulator.strategy import FundingArbStrategy
+from simulator.utils import Config
+
+
+@dataclass
+class MergedExchange:
+    """所有market合并之后的一个exchange，只有结果，没有账户"""
+
+    name: str
+    metric_history: pd.DataFrame
+
+
+@dataclass
+class MergedRisk:
+    """所有market合并之后每个exchange的逐bar风险统计，summary()与RiskTracker相同"""
+
+    stats: dict[str, RiskStats]
+    fund_pnl: dict[str, float]
+    years: float
+
+    def summary(self) -> dict[str, dict]:
+        return {
+            name: stats.summary(self.years, fund_pnl=self.fund_pnl[name])
+            for name, stats in self.stats.items()
+        }
+
+
+@dataclass
+class EquityRecord:
+    """一个market的回测中，每次风险统计更新时各exchange的cash和used_margin，shape=(exchange, 更新次数)"""
+
+    timestamps: np.ndarray
+    cash: np.ndarray
+    used_margin: np.ndarray
+    fund_pnl: np.ndarray  # 回测结束时各exchange的funding收益
+
+
+class _EquityRecorder(RiskTracker):
+    """worker中代替RiskTracker，另外记录每次更新时的cash和used_margin，用于合并各market的逐bar风险统计"""
+
+    def __init__(self, ledger: Ledger, init_cash: float, valid_timestamps: np.ndarray) -> None:
+        """valid_timestamps: 所有有效bar的时刻，用于还原批量更新中每个bar的时刻"""
+        super().__init__(ledger, init_cash)
+        self._valid_timestamps = valid_timestamps
+        self._timestamps = []
+        self._cash = []
+        self._used_margin = []
+
+    def update(self, timestamp: datetime):
+        super().update(timestamp)
+        self._timestamps.append(np.datetime64(timestamp, "ns")[None])
+        self._cash.append(np.array(self.ledger.cash)[:, None])
+        self._used_margin.append(np.array(self.ledger.totals["used_margin"])[:, None])
+
+    def update_batch(self, first: datetime, last: datetime, cash: np.ndarray, used_margin: np.ndarray):
+        super().update_batch(first, last, cash, used_margin)
+        start = int(np.searchsorted(self._valid_timestamps, np.datetime64(first, "ns")))
+        timestamps = self._valid_timestamps[start : start + cash.shape[1]]
+        assert timestamps[-1] == np.datetime64(last, "ns")
+        self._timestamps.append(timestamps)
+        self._cash.append(np.array(cash))
+        self._used_margin.append(np.array(used_margin))
+
+    def record(self) -> EquityRecord:
+        n_exchanges = len(self.ledger.exchanges)
+        return EquityRecord(
+            timestamps=np.concatenate(self._timestamps or [np.array([], dtype="datetime64[ns]")]),
+            cash=np.concatenate(self._cash or [np.empty((n_exchanges, 0))], axis=1),
+            used_margin=np.concatenate(self._used_margin or [np.empty((n_exchanges, 0))], axis=1),
+            fund_pnl=np.array(self.ledger.totals["fund_pnl"]),
+        )
+
+
+def market_config(config: Config, market: str) -> Config:
+    """单个market的回测参数，每个exchange上分到init_cash/len(exchanges)/len(markets)的资金"""
+    return replace(
+        config, markets=[market], init_cash=config.init_cash / len(config.markets), isolated_margin=False
+    )
+
+
+def _run_market(
+    config: Config, timestamps: np.ndarray, values: np.ndarray, engine: type[FundingArbStrategy]
+) -> tuple[list[FundingArbTrade], dict[str, pd.DataFrame], EquityRecord]:
+    """在worker进程中回测一个market，返回平仓的trade、每个exchange的metric_history和逐bar的权益"""
+    feeds = DataFeeds.from_arrays(timestamps, values, exchanges=config.exchanges, markets=config.markets)
+    strategy = engine(config, data_feeds=feeds)
+    strategy.risk = _EquityRecorder(
+        strategy.ledger,
+        init_cash=config.init_cash / len(config.exchanges),
+        valid_timestamps=np.asarray(feeds.timestamps, dtype="datetime64[ns]")[feeds.valid],
+    )
+    strategy.run()
+    histories = {ex.name: ex.metric_history for ex in strategy.iter_exchanges()}
+    return strategy.closed_trades, histories, strategy.risk.record()
+
+
+def merge_metric_histories(histories: list[pd.DataFrame], init_cash: float) -> pd.DataFrame:
+    """把各个market在同一个exchange上的metric_history加总，per-market的列各自只在一个market中，原样保留
+    各market的记录时刻可能不同（缺数据的bar），其余时刻沿用上一次记录的值，第一次记录之前是初始状态
+    同一时刻记录了多次的（最后一个bar的定时记录和平仓之后的记录），以最后一次为准
+    """
+    histories = [h.loc[~h.index.duplicated(keep="last")] for h in histories]
+    timeline = pd.DatetimeIndex(sorted(set().union(*(h.index for h in histories))), name="timestamp")
+    columns = list(dict.fromkeys(c for h in histories for c in h.columns))
+    initial = {"total_value": init_cash, "cash": init_cash}
+
+    merged = pd.DataFrame(0.0, index=timeline, columns=columns)
+    for history in histories:  # 按market的顺序累加，结果是确定的
+        filled = history.reindex(timeline).ffill().fillna({c: initial.get(c, 0.0) for c in history.columns})
+        merged = merged.add(filled, fill_value=0.0)
+    return merged[columns]
+
+
+def merge_risk(records: list[EquityRecord], exchanges: list[str], init_cash: float) -> MergedRisk:
+    """把各个market的逐bar权益按时刻加总，再计算每个exchange的风险统计
+    - 时间轴是各market更新时刻的并集，其余时刻沿用上一次的值，第一次更新之前是初始状态
+    - 同一时刻的多次更新（最后一个bar和平仓之后）按先后分别对齐，与全仓回测一样都计入统计
+    """
+
+    def steps(record: EquityRecord) -> pd.MultiIndex:
+        timestamps = pd.Series(record.timestamps)
+        return pd.MultiIndex.from_arrays([timestamps, timestamps.groupby(timestamps).cumcount()])
+
+    timeline = pd.MultiIndex.from_tuples(sorted(set().union(*(steps(r) for r in records))))
+    cash = np.zeros((len(exchanges), len(timeline)))
+    used_margin = np.zeros((len(exchanges), len(timeline)))
+    for record in records:
+        index = steps(record)
+        cash += (
+            pd.DataFrame(record.cash.T, index=index)
+            .reindex(timeline)
+            .ffill()
+            .fillna(init_cash)
+            .to_numpy()
+            .T
+        )
+        used_margin += (
+            pd.DataFrame(record.used_margin.T, index=index)
+            .reindex(timeline)
+            .ffill()
+            .fillna(0.0)
+            .to_numpy()
+            .T
+        )
+
+    stats = {name: RiskStats(init_cash * len(records)) for name in exchanges}
+    for idx, name in enumerate(exchanges):
+        stats[name].update_batch(cash[idx], used_margin[idx])
+    return MergedRisk(
+        stats=stats,
+        fund_pnl={name: float(sum(r.fund_pnl[idx] for r in records)) for idx, name in enumerate(exchanges)},
+        years=span_years(timeline[0][0], timeline[-1][0]) if len(timeline) > 0 else 0.0,
+    )
+
+
+class IsolatedMarginStrategy:
+    """逐仓模式：每个market在每个exchange上有独立的资金，market之间不再通过exchange的现金池相互影响
+    - 每个market是一个独立的回测，在各自的进程中并行，墙钟时间约为 market数/核数 个单market回测
+    - 结束后按config.markets的顺序合并结果：closed_trades按平仓时间排序，每个exchange的metric_history逐时刻加总
+    - 每个market只看自己的数据是否缺失，其他market缺数据的bar不会被跳过
+    - max_workers=1时在当前进程中依次回测，可以在sweep的worker中使用
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        data_feeds: DataFeeds = None,
+        engine: type[FundingArbStrategy] = FundingArbStrategy,
+        max_workers: int = None,
+    ) -> None:
+        assert config.isolated_margin, "IsolatedMarginStrategy needs config.isolated_margin=True"
+        assert config.chunk_rows is None, "isolated margin splits the whole history by market"
+        if data_feeds is None:
+            data_feeds = DataFeeds(
+                data_dir=config.data_dir,
+                exchanges=config.exchanges,
+                markets=config.markets,
+                cache_dir=config.cache_dir,
+                start=config.start,
+                end=config.end,
+            )
+        assert data_feeds.exchanges == config.exchanges and data_feeds.markets == config.markets
+        self._config = config
+        self._data_feeds = data_feeds
+        self._engine = engine
+        self._max_workers = max_workers or min(len(config.markets), os.cpu_count())
+
+        self.closed_trades: list[FundingArbTrade] = []
+        self.risk: MergedRisk = None  # run()之后是各market逐bar权益加总之后的风险统计
+        self._exchanges: dict[str, MergedExchange] = {}
+
+    def iter_exchanges(self):
+        return self._exchanges.values()
+
+    def run(self):
+        # 每个worker只拿到自己market的数据
+        timestamps = self._data_feeds.timestamps
+        jobs = [
+            (
+                market_config(self._config, market),
+                timestamps,
+                self._data_feeds.values[:, [midx]],
+                self._engine,
+            )
+            for midx, market in enumerate(self._config.markets)
+        ]
+
+        if self._max_workers == 1:
+            results = [_run_market(*job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=self._max_workers) as executor:
+                results = list(executor.map(_run_market, *zip(*jobs)))
+
+        closed_trades = [trade for trades, _, _ in results for trade in trades]
+        # 稳定排序，同一时刻平仓的trade保持market的顺序
+        self.closed_trades = sorted(closed_trades, key=lambda trade: trade.close_tm)
+
+        init_cash = self._config.init_cash / len(self._config.exchanges) / len(self._config.markets)
+        self._exchanges = {
+            name: MergedExchange(
+                name=name,
+                metric_history=merge_metric_histories(
+                    [histories[name] for _, histories, _ in results], init_cash
+                ),
+            )
+            for name in self._config.exchanges
+        }
+        self.risk = merge_risk([record for _, _, record in results], self._config.exchanges, init_cash)
@@ -0,0 +1,292 @@
+import heapq
+import logging
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from pathlib import Path
+from simulator.utils import hfr2a
+
+FILL_DTYPE = np.dtype(
+    [
+        ("seq", np.int64),
+        ("timestamp", "datetime64[ns]"),
+        ("exchange", np.int16),
+        ("market", np.int16),
+        ("is_long", np.int8),
+        ("is_open", np.bool_),
+        ("price", np.float64),
+        ("shares", np.float64),
+        ("margin", np.float64),  # 这次成交导致的used margin变化，开仓>0，平仓<0
+    ]
+)
+
+SETTLE_DTYPE = np.dtype(
+    [
+        ("seq", np.int64),
+        ("timestamp", "datetime64[ns]"),
+        ("exchange", np.int16),
+        ("market", np.int16),
+        ("is_long", np.int8),
+        ("trade_pnl", np.float64),  # mark to market
+        ("margin_diff", np.float64),  # 保证金的变化
+        ("fund_pnl", np.float64),  # funding payment
+    ]
+)
+
+FUNDRATE_DIFF_DTYPE = np.dtype(
+    [
+        ("seq", np.int64),
+        ("timestamp", "datetime64[ns]"),
+        ("market", np.int16),
+        ("long_ex", np.int16),
+        ("short_ex", np.int16),
+        ("long_fundrate", np.float64),
+        ("short_fundrate", np.float64),
+        ("fundrate_diff", np.float64),
+    ]
+)
+
+
+class RecordTable:
+    """可增长的numpy record array，容量不够时翻倍"""
+
+    def __init__(self, dtype: np.dtype, capacity: int = 1024) -> None:
+        self._data = np.empty(capacity, dtype=dtype)
+        self._size = 0
+
+    def append(self, record: tuple) -> None:
+        if self._size == len(self._data):
+            data = np.empty(2 * len(self._data), dtype=self._data.dtype)
+            data[: self._size] = self._data
+            self._data = data
+        self._data[self._size] = record
+        self._size += 1
+
+    def extend(self, records: np.ndarray) -> None:
+        """一次追加多条记录，records的dtype与表相同"""
+        size = self._size + len(records)
+        if size > len(self._data):
+            data = np.empty(max(size, 2 * len(self._data)), dtype=self._data.dtype)
+            data[: self._size] = self._data[: self._size]
+            self._data = data
+        self._data[self._size : size] = records
+        self._size = size
+
+    @property
+    def last(self) -> np.void:
+        return self._data[self._size - 1]
+
+    @property
+    def records(self) -> np.ndarray:
+        return self._data[: self._size]
+
+    def __len__(self):
+        return self._size
+
+
+class Journal:
+    """成交、结算（包括保证金变化和funding payment）、funding rate差的结构化记录
+    - exchange和market都用整数id记录，id与名字的对应见exchanges/markets
+    - silent=True时完全不格式化字符串；否则每条记录都按原来的格式输出一行logging.info（INFO级别开启时）
+    - 可读的日志只是journal之上的一个renderer，事后也可以用lines()重新生成
+    """
+
+    def __init__(self, silent: bool = False) -> None:
+        self.silent = silent
+        self.exchanges: list[str] = []
+        self.markets: list[str] = []
+        self.timestamp = np.datetime64("NaT", "ns")
+
+        self._seq = 0
+        self.fills = RecordTable(FILL_DTYPE)
+        self.settlements = RecordTable(SETTLE_DTYPE)
+        self.fundrate_diffs = RecordTable(FUNDRATE_DIFF_DTYPE)
+
+    def exchange_id(self, name: str) -> int:
+        if name not in self.exchanges:
+            self.exchanges.append(name)
+        return self.exchanges.index(name)
+
+    def market_id(self, market: str) -> int:
+        if market not in self.markets:
+            self.markets.append(market)
+        return self.markets.index(market)
+
+    def set_time(self, timestamp: datetime):
+        """之后的记录都打上这个时间戳，每个bar开始时调用一次"""
+        self.timestamp = np.datetime64(timestamp, "ns")
+
+    def __verbose(self) -> bool:
+        # logging.info没有开启时，同样不必格式化
+        return not self.silent and logging.root.isEnabledFor(logging.INFO)
+
+    def __next_seq(self):
+        self._seq += 1
+        return self._seq
+
+    def fill(
+        self,
+        exchange: int,
+        market: int,
+        is_long: int,
+        is_open: bool,
+        price: float,
+        shares: float,
+        margin: float,
+    ):
+        self.fills.append(
+            (self.__next_seq(), self.timestamp, exchange, market, is_long, is_open, price, shares, margin)
+        )
+        if self.__verbose():
+            logging.info(self.render_fill(self.fills.last))
+
+    def settle(
+        self,
+        exchange: int,
+        market: int,
+        is_long: int,
+        trade_pnl: float,
+        margin_diff: float,
+        fund_pnl: float,
+    ):
+        self.settlements.append(
+            (self.__next_seq(), self.timestamp, exchange, market, is_long, trade_pnl, margin_diff, fund_pnl)
+        )
+        if self.__verbose():
+            logging.info(self.render_settle(self.settlements.last))
+
+    def fundrate_diff(
+        self, market: int, long_ex: int, short_ex: int, long_fundrate: float, short_fundrate: float
+    ):
+        self.fundrate_diffs.append(
+            (
+                self.__next_seq(),
+                self.timestamp,
+                market,
+                long_ex,
+                short_ex,
+                long_fundrate,
+                short_fundrate,
+                short_fundrate - long_fundrate,
+            )
+        )
+        if self.__verbose():
+            logging.info(self.render_fundrate_diff(self.fundrate_diffs.last))
+
+    def hold_bars(
+        self,
+        timestamps: np.ndarray,
+        fundrate_diffs: list[tuple[int, int, int, np.ndarray, np.ndarray]],
+        settlements: list[tuple[int, int, int, np.ndarray, np.ndarray, np.ndarray]],
+    ):
+        """批量追加一段只持仓不动的bar的记录，与逐bar调用fundrate_diff和settle的结果相同
+        每个bar上先是各个trade的fundrate_diff，再是各条腿的settle，seq也按这个顺序编号
+        - fundrate_diffs: 每个trade一项，(market, long_ex, short_ex, long_fundrate, short_fundrate)
+        - settlements: 每条腿一项，(exchange, market, is_long, trade_pnl, margin_diff, fund_pnl)
+        - 数组的长度都与timestamps相同
+        """
+        n_bars, n_diffs, n_settles = len(timestamps), len(fundrate_diffs), len(settlements)
+        width = n_diffs + n_settles  # 每个bar的记录数
+        seq = self._seq + 1 + np.arange(n_bars)[:, None] * width  # 每个bar第一条记录的seq
+        self._seq += n_bars * width
+        timestamps = np.asarray(timestamps, dtype="datetime64[ns]")
+
+        diffs = np.empty((n_bars, n_diffs), dtype=FUNDRATE_DIFF_DTYPE)
+        diffs["seq"] = seq + np.arange(n_diffs)
+        diffs["timestamp"] = timestamps[:, None]
+        for col, (market, long_ex, short_ex, long_fundrate, short_fundrate) in enumerate(fundrate_diffs):
+            diffs["market"][:, col] = market
+            diffs["long_ex"][:, col] = long_ex
+            diffs["short_ex"][:, col] = short_ex
+            diffs["long_fundrate"][:, col] = long_fundrate
+            diffs["short_fundrate"][:, col] = short_fundrate
+            diffs["fundrate_diff"][:, col] = short_fundrate - long_fundrate
+
+        settles = np.empty((n_bars, n_settles), dtype=SETTLE_DTYPE)
+        settles["seq"] = seq + n_diffs + np.arange(n_settles)
+        settles["timestamp"] = timestamps[:, None]
+        for col, (exchange, market, is_long, trade_pnl, margin_diff, fund_pnl) in enumerate(settlements):
+            settles["exchange"][:, col] = exchange
+            settles["market"][:, col] = market
+            settles["is_long"][:, col] = is_long
+            settles["trade_pnl"][:, col] = trade_pnl
+            settles["margin_diff"][:, col] = margin_diff
+            settles["fund_pnl"][:, col] = fund_pnl
+
+        self.fundrate_diffs.extend(diffs.ravel())
+        self.settlements.extend(settles.ravel())
+        if n_bars > 0:
+            self.timestamp = timestamps[-1]
+        if self.__verbose():
+            for k in range(n_bars):
+                for record in diffs[k]:
+                    logging.info(self.render_fundrate_diff(record))
+                for record in settles[k]:
+                    logging.info(self.render_settle(record))
+
+    # ------------------------------ renderers
+    def render_fill(self, r: np.void) -> str:
+        return (
+            f"[{self.exchanges[r['exchange']]:>8}] {'++OPEN++' if r['is_open'] else '--CLOSE--'} "
+            f"{'BUY ' if r['is_long'] > 0 else 'SELL'} [{self.markets[r['market']]}] "
+            f"at price={r['price']:.4f} for {r['shares']:.4f} shares"
+        )
+
+    def render_settle(self, r: np.void) -> str:
+        return (
+            f"Settle [{self.exchanges[r['exchange']]:>8}] {'Long' if r['is_long'] > 0 else 'SELL'} "
+            f"{self.markets[r['market']]}, "
+            f"TradePnl={r['trade_pnl']:.4f}, MarginDiff={r['margin_diff']:.4f}, FundPnl={r['fund_pnl']:.4f}"
+        )
+
+    def render_fundrate_diff(self, r: np.void) -> str:
+        long_ex, short_ex = self.exchanges[r["long_ex"]], self.exchanges[r["short_ex"]]
+        name = f"L[{long_ex}].S[{short_ex}].{self.markets[r['market']]}"
+        return (
+            f"Trade[{name}] ASFR={hfr2a(r['short_fundrate']):.2%}"
+            f", ALFR={hfr2a(r['long_fundrate']):.2%}"
+            f", AFRdiff={hfr2a(r['fundrate_diff']):.2%}"
+        )
+
+    def lines(self):
+        """按发生顺序，重新生成所有记录的可读日志"""
+        tables = [
+            (self.fills, self.render_fill),
+            (self.settlements, self.render_settle),
+            (self.fundrate_diffs, self.render_fundrate_diff),
+        ]
+        streams = [
+            zip(table.records["seq"], table.records, [render] * len(table)) for table, render in tables
+        ]
+        for _, record, render in heapq.merge(*streams, key=lambda item: item[0]):
+            yield render(record)
+
+    # ------------------------------ export
+    def to_frames(self) -> dict[str, pd.DataFrame]:
+        """table name -> DataFrame，整数id被替换成exchange/market的名字"""
+        frames = {}
+        for name, table in [
+            ("fills", self.fills),
+            ("settlements", self.settlements),
+            ("fundrate_diffs", self.fundrate_diffs),
+        ]:
+            df = pd.DataFrame(table.records)
+            for col in ["exchange", "long_ex", "short_ex"]:
+                if col in df.columns:
+                    df[col] = pd.Categorical.from_codes(df[col], categories=self.exchanges)
+            df["market"] = pd.Categorical.from_codes(df["market"], categories=self.markets)
+            frames[name] = df
+        return frames
+
+    def to_csv(self, out_dir: Path | str):
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for name, df in self.to_frames().items():
+            df.to_csv(out_dir / f"{name}.csv", index=False)
+
+    def to_parquet(self, out_dir: Path | str):
+        """需要安装pyarrow（poetry install -E parquet）或fastparquet"""
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for name, df in self.to_frames().items():
+            df.to_parquet(out_dir / f"{name}.parquet", index=False)
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import random
+import numpy as np
+import pandas as pd
+import typer
+from pathlib import Path
+from simulator.data_feeds import FIELDS, DataFeeds, LiveFeeds
+from simulator.strategy import FundingArbStrategy
+from simulator.utils import Config
+
+
+class ReplayServer:
+    """本地的行情服务，把录制好的dYdX/RabbitX数据（data/input下的csv或PartitionedDataset）当作实时行情推送
+    - 每个客户端连接都从头回放一遍，协议见LiveFeeds
+    - 每个bar上各个(exchange, market)的update分别发送，顺序随机打乱，模拟各交易所推送的先后不同
+    - interval: 相邻两个bar之间等待的秒数，0表示尽快发送
+    - jitter: 每个update发送之前随机等待[0, jitter)秒
+    - 缺失的数据不发送，与交易所没有推送一样
+    """
+
+    def __init__(
+        self,
+        data_dir: Path | str,
+        exchanges: list[str],
+        markets: list[str],
+        start=None,
+        end=None,
+        interval: float = 0.0,
+        jitter: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        feeds = DataFeeds(data_dir, exchanges=exchanges, markets=markets, start=start, end=end)
+        self._exchanges = exchanges
+        self._markets = markets
+        self._times = [ts.isoformat() for ts in pd.DatetimeIndex(feeds.timestamps).to_pydatetime()]
+        self._values = feeds.values
+        self._interval = interval
+        self._jitter = jitter
+        self._seed = seed
+        self._server: asyncio.AbstractServer = None
+        self.n_sent = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> tuple[str, int]:
+        """开始监听，port=0时由系统分配，返回实际监听的地址"""
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        rng = random.Random(self._seed)
+        keys = [(midx, eidx) for midx in range(len(self._markets)) for eidx in range(len(self._exchanges))]
+        try:
+            for row, timestamp in enumerate(self._times):
+                rng.shuffle(keys)
+                for midx, eidx in keys:
+                    values = self._values[row, midx, eidx]
+                    if np.isnan(values).any():
+                        continue
+                    if self._jitter > 0:
+                        await asyncio.sleep(rng.uniform(0, self._jitter))
+                    update = dict(
+                        exchange=self._exchanges[eidx],
+                        market=self._markets[midx],
+                        timestamp=timestamp,
+                        **dict(zip(FIELDS, values.tolist())),
+                    )
+                    writer.write(json.dumps(update).encode() + b"\n")
+                    self.n_sent += 1
+                await writer.drain()
+                if self._interval > 0:
+                    await asyncio.sleep(self._interval)
+        except ConnectionError:  # 客户端提前断开
+            pass
+        finally:
+            writer.close()
+
+
+async def paper_trade(config: Config, host: str, port: int, max_lag: str = None) -> FundingArbStrategy:
+    """连接host:port上的行情，用与回测相同的FundingArbStrategy纸面交易，直到行情结束，max_lag见LiveFeeds"""
+    feeds = LiveFeeds(host, port, exchanges=config.exchanges, markets=config.markets, max_lag=max_lag)
+    strategy = FundingArbStrategy(config, data_feeds=feeds)
+    await strategy.run_live()
+    return strategy
+
+
+async def replay_and_trade(
+    config: Config, interval: float = 0.0, jitter: float = 0.0, max_lag: str = None
+) -> FundingArbStrategy:
+    """在本地启动ReplayServer回放config.data_dir中的数据，并在同一个事件循环上纸面交易"""
+    server = ReplayServer(
+        config.data_dir,
+        exchanges=config.exchanges,
+        markets=config.markets,
+        start=config.start,
+        end=config.end,
+        interval=interval,
+        jitter=jitter,
+    )
+    host, port = await server.start()
+    try:
+        return await paper_trade(config, host, port, max_lag=max_lag)
+    finally:
+        await server.close()
+
+
+def main(
+    config_file: Path,
+    host: str = None,
+    port: int = None,
+    interval: float = 0.0,
+    jitter: float = 0.0,
+    max_lag: str = None,
+):
+    """
+    - config_file: json，Config的所有字段
+    - host/port: 行情服务的地址；不给出时在本地回放config中data_dir的数据
+    - interval/jitter: 本地回放时bar之间的间隔和每个update的随机延迟（秒）
+    - max_lag: 某个(exchange, market)停止推送时，最多等待多久（例如"3h"）就放弃缺数据的bar
+    """
+    config = Config(**json.loads(config_file.read_text()))
+    if host is None:
+        strategy = asyncio.run(replay_and_trade(config, interval=interval, jitter=jitter, max_lag=max_lag))
+    else:
+        strategy = asyncio.run(paper_trade(config, host, port, max_lag=max_lag))
+
+    decision = strategy.stats.phase_summary("decision")
+    pnl = sum(trade.trade_pnl + trade.fund_pnl for trade in strategy.closed_trades)
+    print(f"{decision['calls']} bars, {len(strategy.closed_trades)} trades, total pnl={pnl:.2f}")
+    if decision["calls"] > 0:
+        print(f"decision latency p50={decision['p50'] * 1e6:.0f}us, p99={decision['p99'] * 1e6:.0f}us")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+SECONDS_PER_DAY = 24 * 3600
+EVERY_BAR = "bar"
+
+
+def metrics_period(freq: str) -> int | None:
+    """记录metrics的周期（秒），freq="bar"时每个bar都记录，返回None
+    其余的freq如"4h"、"1D"，必须整除一天，在每个周期最后一个小时的开始记录，例如"1D"是每天23:00
+    """
+    if freq == EVERY_BAR:
+        return None
+    period = int(pd.Timedelta(freq).total_seconds())
+    if period <= 0 or SECONDS_PER_DAY % period != 0:
+        raise ValueError(f"metrics freq {freq} should divide one day")
+    return period
+
+
+def is_record_time(timestamp: datetime, period: int | None) -> bool:
+    if period is None:
+        return True
+    seconds = timestamp.hour * 3600 + timestamp.minute * 60 + timestamp.second
+    return timestamp.microsecond == 0 and (seconds + 3600) % period == 0
+
+
+def record_mask(timestamps: np.ndarray, period: int | None) -> np.ndarray:
+    """is_record_time的向量化版本"""
+    if period is None:
+        return np.ones(len(timestamps), dtype=bool)
+    times = pd.DatetimeIndex(timestamps)
+    seconds = times.hour * 3600 + times.minute * 60 + times.second
+    return np.asarray((times.microsecond == 0) & (times.nanosecond == 0) & ((seconds + 3600) % period == 0))
+
+
+class MetricsRecorder:
+    """预先分配的列式metrics记录
+    - 每次记录写入二维数组的一行，写满时容量翻倍，记录本身不创建任何python对象
+    - frame()得到的DataFrame直接引用数组中已经写入的部分，不复制
+    """
+
+    def __init__(self, columns: list[str], capacity: int = 64) -> None:
+        self.columns = list(columns)
+        self._times = np.empty(max(capacity, 1), dtype="datetime64[ns]")
+        self._values = np.empty((max(capacity, 1), len(self.columns)), dtype=np.float64)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def capacity(self) -> int:
+        return len(self._times)
+
+    def reserve(self, capacity: int):
+        """保证至少能容纳capacity条记录"""
+        if capacity <= self.capacity:
+            return
+        times = np.empty(capacity, dtype=self._times.dtype)
+        values = np.empty((capacity, len(self.columns)), dtype=np.float64)
+        times[: self._size] = self._times[: self._size]
+        values[: self._size] = self._values[: self._size]
+        self._times, self._values = times, values
+
+    def append(self, timestamp: datetime, values) -> None:
+        if self._size == self.capacity:
+            self.reserve(2 * self.capacity)
+        self._times[self._size] = timestamp
+        self._values[self._size] = values
+        self._size += 1
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self._times[: self._size]
+
+    @property
+    def values(self) -> np.ndarray:
+        """shape=(记录数, 列数)，零拷贝的视图"""
+        return self._values[: self._size]
+
+    def frame(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            self.values,
+            index=pd.DatetimeIndex(self.timestamps, name="timestamp", copy=False),
+            columns=self.columns,
+            copy=False,
+        )
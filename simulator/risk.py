@@ -0,0 +1,227 @@
+import math
+import numpy as np
+from datetime import datetime
+from simulator.exchange import Ledger
+from simulator.utils import HOURS_PER_YEAR
+
+# used_margin的合计是增量维护的，平仓之后可能留下浮点误差，不算持仓
+MIN_MARGIN = 1e-6
+
+
+def span_years(start: datetime, end: datetime) -> float:
+    """[start, end]覆盖的年数，用于年化"""
+    return (end - start).total_seconds() / 3600 / HOURS_PER_YEAR
+
+
+class RiskStats:
+    """一个exchange上的流式风险统计，每个bar O(1)更新，不保存权益曲线
+    - 权益(total_value=cash+used_margin)的历史最高点和最大回撤
+    - 每个bar收益率的均值和方差（Welford）
+    - 有持仓（used_margin>MIN_MARGIN）的bar数，used_margin/cash的峰值
+    """
+
+    def __init__(self, init_value: float) -> None:
+        self.init_value = init_value
+        self.n_bars = 0
+        self.last_value = init_value
+        self.peak_value = init_value
+        self.max_drawdown = 0.0
+        self.max_drawdown_pct = 0.0
+
+        self.return_mean = 0.0
+        self._return_m2 = 0.0
+
+        self.bars_in_market = 0
+        self.used_margin_sum = 0.0
+        self.peak_margin_ratio = 0.0
+
+    def update(self, cash: float, used_margin: float):
+        value = cash + used_margin
+        self.n_bars += 1
+        n = self.n_bars
+
+        ret = value / self.last_value - 1
+        delta = ret - self.return_mean
+        self.return_mean += delta / n
+        self._return_m2 += delta * (ret - self.return_mean)
+        self.last_value = value
+
+        if value > self.peak_value:
+            self.peak_value = value
+        else:
+            drawdown = self.peak_value - value
+            if drawdown > self.max_drawdown:
+                self.max_drawdown = drawdown
+            if drawdown / self.peak_value > self.max_drawdown_pct:
+                self.max_drawdown_pct = drawdown / self.peak_value
+
+        if used_margin > MIN_MARGIN:
+            self.bars_in_market += 1
+            self.used_margin_sum += used_margin
+            ratio = used_margin / cash
+            if ratio > self.peak_margin_ratio:
+                self.peak_margin_ratio = ratio
+
+    def update_batch(self, cash: np.ndarray, used_margin: np.ndarray):
+        """与对每个bar依次调用update的结果相同（浮点误差之内），收益率的均值和方差按Chan的公式合并"""
+        if len(cash) == 0:
+            return
+        values = cash + used_margin
+        rets = values / np.concatenate([[self.last_value], values[:-1]]) - 1
+        n_old, n_new = self.n_bars, len(rets)
+        self.n_bars += n_new
+        batch_mean = float(rets.mean())
+        delta = batch_mean - self.return_mean
+        self.return_mean += delta * n_new / self.n_bars
+        self._return_m2 += float(((rets - batch_mean) ** 2).sum()) + delta**2 * n_old * n_new / self.n_bars
+        self.last_value = float(values[-1])
+
+        peaks = np.maximum.accumulate(np.concatenate([[self.peak_value], values]))[1:]
+        drawdowns = peaks - values
+        self.peak_value = float(peaks[-1])
+        self.max_drawdown = max(self.max_drawdown, float(drawdowns.max()))
+        self.max_drawdown_pct = max(self.max_drawdown_pct, float((drawdowns / peaks).max()))
+
+        in_market = used_margin > MIN_MARGIN
+        self.bars_in_market += int(in_market.sum())
+        self.used_margin_sum += float(used_margin[in_market].sum())
+        if in_market.any():
+            ratio = float((used_margin[in_market] / cash[in_market]).max())
+            self.peak_margin_ratio = max(self.peak_margin_ratio, ratio)
+
+    @property
+    def return_std(self) -> float:
+        return math.sqrt(self._return_m2 / (self.n_bars - 1)) if self.n_bars > 1 else 0.0
+
+    def summary(self, years: float, fund_pnl: float) -> dict:
+        """years: 统计覆盖的时长，用于年化"""
+        bars_per_year = self.n_bars / years if years > 0 else HOURS_PER_YEAR
+        std = self.return_std
+        return dict(
+            total_return=self.last_value / self.init_value - 1,
+            max_drawdown=self.max_drawdown,
+            max_drawdown_pct=self.max_drawdown_pct,
+            return_mean=self.return_mean,
+            return_std=std,
+            sharpe=self.return_mean / std * math.sqrt(bars_per_year) if std > 0 else 0.0,
+            funding_yield=fund_pnl / self.init_value / years if years > 0 else 0.0,
+            time_in_market=self.bars_in_market / self.n_bars if self.n_bars > 0 else 0.0,
+            mean_used_margin=self.used_margin_sum / self.bars_in_market if self.bars_in_market > 0 else 0.0,
+            peak_margin_ratio=self.peak_margin_ratio,
+        )
+
+
+class RiskTracker:
+    """回测中所有exchange的RiskStats，直接读ledger中的cash和used_margin合计"""
+
+    def __init__(self, ledger: Ledger, init_cash: float) -> None:
+        """init_cash: 每个exchange的初始资金"""
+        self.ledger = ledger
+        self.stats = {name: RiskStats(init_cash) for name in ledger.exchanges}
+        self._stats_list = list(self.stats.values())  # 与ledger中exchange的顺序一致
+        self.start: datetime = None
+        self.end: datetime = None
+
+    def update(self, timestamp: datetime):
+        if self.start is None:
+            self.start = timestamp
+        self.end = timestamp
+        cash = self.ledger.cash
+        used_margin = self.ledger.totals["used_margin"]
+        for idx, stats in enumerate(self._stats_list):
+            stats.update(cash[idx], used_margin[idx])
+
+    def update_batch(self, first: datetime, last: datetime, cash: np.ndarray, used_margin: np.ndarray):
+        """first/last: 这批bar的第一个和最后一个时刻
+        cash/used_margin: shape=(exchange, bar)，exchange的顺序与ledger一致
+        """
+        if self.start is None:
+            self.start = first
+        self.end = last
+        for idx, stats in enumerate(self._stats_list):
+            stats.update_batch(cash[idx], used_margin[idx])
+
+    @property
+    def years(self) -> float:
+        if self.start is None:
+            return 0.0
+        return span_years(self.start, self.end)
+
+    def summary(self) -> dict[str, dict]:
+        """exchange -> 风险统计"""
+        years = self.years
+        fund_pnl = self.ledger.totals["fund_pnl"]
+        return {
+            name: stats.summary(years, fund_pnl=fund_pnl[idx])
+            for idx, (name, stats) in enumerate(self.stats.items())
+        }
+
+
+class RiskStatsArray:
+    """一组独立的RiskStats（例如config x exchange），所有元素每个bar一起更新
+    与对每个元素依次调用RiskStats.update的结果逐位相同，用于批量回测多组参数
+    """
+
+    def __init__(self, init_value: np.ndarray) -> None:
+        self.init_value = np.array(init_value, dtype=np.float64)
+        self.n_bars = 0
+        self.last_value = self.init_value.copy()
+        self.peak_value = self.init_value.copy()
+        self.max_drawdown = np.zeros_like(self.init_value)
+        self.max_drawdown_pct = np.zeros_like(self.init_value)
+
+        self.return_mean = np.zeros_like(self.init_value)
+        self._return_m2 = np.zeros_like(self.init_value)
+
+        self.bars_in_market = np.zeros(self.init_value.shape, dtype=np.int64)
+        self.used_margin_sum = np.zeros_like(self.init_value)
+        self.peak_margin_ratio = np.zeros_like(self.init_value)
+
+    def update(self, cash: np.ndarray, used_margin: np.ndarray):
+        """cash/used_margin的shape与init_value相同，运算顺序与RiskStats.update一致"""
+        value = cash + used_margin
+        self.n_bars += 1
+        n = self.n_bars
+
+        ret = value / self.last_value - 1
+        delta = ret - self.return_mean
+        self.return_mean = self.return_mean + delta / n
+        self._return_m2 = self._return_m2 + delta * (ret - self.return_mean)
+        self.last_value = value
+
+        new_peak = value > self.peak_value
+        drawdown = self.peak_value - value
+        drawdown_pct = drawdown / self.peak_value
+        self.max_drawdown = np.where(
+            ~new_peak & (drawdown > self.max_drawdown), drawdown, self.max_drawdown
+        )
+        self.max_drawdown_pct = np.where(
+            ~new_peak & (drawdown_pct > self.max_drawdown_pct), drawdown_pct, self.max_drawdown_pct
+        )
+        self.peak_value = np.where(new_peak, value, self.peak_value)
+
+        in_market = used_margin > MIN_MARGIN
+        self.bars_in_market += in_market
+        self.used_margin_sum = np.where(in_market, self.used_margin_sum + used_margin, self.used_margin_sum)
+        ratio = np.divide(used_margin, cash, out=np.zeros_like(value), where=in_market)
+        self.peak_margin_ratio = np.where(
+            in_market & (ratio > self.peak_margin_ratio), ratio, self.peak_margin_ratio
+        )
+
+    def at(self, idx) -> RiskStats:
+        """第idx个元素的RiskStats"""
+        stats = RiskStats(float(self.init_value[idx]))
+        stats.n_bars = self.n_bars
+        for attr in [
+            "last_value",
+            "peak_value",
+            "max_drawdown",
+            "max_drawdown_pct",
+            "return_mean",
+            "_return_m2",
+            "used_margin_sum",
+            "peak_margin_ratio",
+        ]:
+            setattr(stats, attr, float(getattr(self, attr)[idx]))
+        stats.bars_in_market = int(self.bars_in_market[idx])
+        return stats
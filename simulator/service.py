@@ -0,0 +1,212 @@
+import asyncio
+import json
+import os
+import socket
+import time
+import pandas as pd
+import typer
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, replace
+from pathlib import Path
+from typing import Iterator
+from simulator.event_engine import EventSkippingStrategy
+from simulator.exchange import MarginCall
+from simulator.strategy import FundingArbStrategy
+from simulator.sweep import load_shared_block, make_strategy, shared_feeds, summarize, worker_pool
+from simulator.utils import Config
+
+# 请求中可以选择的回测引擎
+ENGINES: dict[str, type[FundingArbStrategy]] = {"bar": FundingArbStrategy, "event": EventSkippingStrategy}
+# 决定数据的字段，job不能修改，只能使用服务启动时载入的数据
+FEED_FIELDS = ("data_dir", "exchanges", "markets", "start", "end")
+
+
+def _ping(_: int) -> int:
+    return os.getpid()
+
+
+def _history_dict(history: pd.DataFrame) -> dict[str, list]:
+    """metric_history转成可以json序列化的列表，timestamp是ISO格式的字符串"""
+    columns = {"timestamp": [ts.isoformat() for ts in history.index]}
+    columns.update({column: history[column].tolist() for column in history.columns})
+    return columns
+
+
+def history_frame(columns: dict[str, list]) -> pd.DataFrame:
+    """_history_dict的逆变换，客户端用来恢复metric_history"""
+    columns = dict(columns)
+    index = pd.DatetimeIndex(pd.to_datetime(columns.pop("timestamp")), name="timestamp").as_unit("ns")
+    return pd.DataFrame(columns, index=index)
+
+
+def run_job(config: Config, engine: str, history: bool) -> dict:
+    """在worker中回测一个job，数据是worker中常驻的共享数据块"""
+    start = time.perf_counter()
+    result = dict(config=asdict(config))
+    try:
+        strategy = make_strategy(config, shared_feeds(config), ENGINES[engine])
+        strategy.run()
+        result["result"] = summarize(strategy)
+        if history:
+            result["metric_history"] = {
+                exchange.name: _history_dict(exchange.metric_history)
+                for exchange in strategy.iter_exchanges()
+            }
+    except MarginCall:
+        result["error"] = "MarginCall"
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+class BacktestService:
+    """常驻的本地回测服务，数据只载入一次，每个job只付出回测本身的时间
+    - 启动时通过FeedCache载入数据块，worker进程mmap同一份数据，之后一直保持在page cache中
+    - worker在启动时预先fork好，job不再付出python启动、import和读csv的开销
+    - 协议是unix socket上的json lines：客户端每行一个job，关闭写端表示没有更多job；
+      服务端每完成一个job回复一行（完成的先后，不是提交的先后），全部完成后关闭连接
+    - job: {"id": ..., "config": {Config的部分字段，覆盖base}, "engine": "bar"|"event", "history": bool}
+    - 回复: {"id": ..., "config": {...}, "result": {summarize的结果}, "metric_history": {...}, "seconds": 回测耗时,
+      "latency": 从收到到回复的耗时}，出错时没有result，只有"error"
+    - {"op": "shutdown"}停止服务
+    """
+
+    def __init__(self, base: Config, max_workers: int = None) -> None:
+        """base: 数据由base的data_dir/exchanges/markets/start/end决定，job中的config是对base的修改"""
+        self._base = base
+        self._max_workers = max_workers or os.cpu_count()
+        self._executor: ProcessPoolExecutor = None
+        self._server: asyncio.AbstractServer = None
+        self.n_jobs = 0
+
+    def __enter__(self):
+        cache_dir, _ = load_shared_block([self._base])
+        self._executor = worker_pool(self._base, cache_dir, self._max_workers)
+        # 一次提交max_workers个任务，所有worker都在这里启动并载入数据
+        list(self._executor.map(_ping, range(self._max_workers)))
+        return self
+
+    def __exit__(self, *exc):
+        self._executor.shutdown(cancel_futures=True)
+
+    def parse_job(self, job: dict) -> tuple[Config, str, bool]:
+        """由一行请求得到Config，不合法时抛出ValueError"""
+        config = replace(self._base, **job.get("config", {}))
+        if config.data_dir is not None:
+            config = replace(config, data_dir=Path(config.data_dir))
+        for field in FEED_FIELDS:
+            if getattr(config, field) != getattr(self._base, field):
+                raise ValueError(f"{field} differs from the service's feeds")
+        engine = job.get("engine", "bar")
+        if engine not in ENGINES:
+            raise ValueError(f"unknown engine {engine}")
+        return config, engine, bool(job.get("history", False))
+
+    async def _run(self, job: dict) -> dict:
+        received = time.perf_counter()
+        try:
+            config, engine, history = self.parse_job(job)
+        except (TypeError, ValueError) as err:
+            return dict(id=job.get("id"), error=str(err))
+
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self._executor, run_job, config, engine, history)
+        except Exception as err:  # 一个job的异常不能让常驻的服务退出
+            return dict(id=job.get("id"), error=repr(err))
+        self.n_jobs += 1
+        return dict(id=job.get("id"), **result, latency=time.perf_counter() - received)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        pending = set()
+        lock = asyncio.Lock()  # 多个job同时完成时，一次只写一行
+
+        async def reply(response: dict):
+            async with lock:
+                writer.write(json.dumps(response, default=str).encode() + b"\n")
+                await writer.drain()
+
+        async def run(job: dict):
+            await reply(await self._run(job))
+
+        while line := await reader.readline():
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as err:
+                await reply(dict(id=None, error=f"invalid json: {err}"))
+                continue
+            if not isinstance(job, dict):
+                await reply(dict(id=None, error="job should be a json object"))
+                continue
+            if job.get("op") == "shutdown":
+                self._server.close()
+                break
+            pending.add(asyncio.create_task(run(job)))
+
+        if pending:
+            await asyncio.gather(*pending)
+        writer.close()
+        await writer.wait_closed()
+
+    async def serve(self, path: Path | str):
+        """在unix socket上服务，直到收到shutdown请求"""
+        path = Path(path)
+        path.unlink(missing_ok=True)
+        self._server = await asyncio.start_unix_server(self._handle, path=str(path))
+        try:
+            async with self._server:
+                await self._server.wait_closed()
+        finally:
+            path.unlink(missing_ok=True)
+
+
+class BacktestClient:
+    """BacktestService的同步客户端"""
+
+    def __init__(self, path: Path | str, timeout: float = 10) -> None:
+        """timeout: 等待服务启动的最长时间"""
+        self._path = str(path)
+        self._timeout = timeout
+
+    def _connect(self) -> socket.socket:
+        deadline = time.monotonic() + self._timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self._path)
+                return sock
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def run(self, jobs: list[dict]) -> Iterator[dict]:
+        """提交一批job，按完成的先后返回结果；没有id的job，id是它在jobs中的序号"""
+        with self._connect() as sock:
+            lines = [json.dumps({"id": idx, **job}, default=str) for idx, job in enumerate(jobs)]
+            sock.sendall(("\n".join(lines) + "\n").encode())
+            sock.shutdown(socket.SHUT_WR)
+            with sock.makefile("rb") as reader:
+                for line in reader:
+                    yield json.loads(line)
+
+    def shutdown(self):
+        with self._connect() as sock:
+            sock.sendall(json.dumps({"op": "shutdown"}).encode() + b"\n")
+
+
+def main(config_file: Path, path: Path = Path("backtest.sock"), workers: int = None):
+    """
+    - config_file: json，Config的所有字段，数据由其中的data_dir/exchanges/markets/start/end决定
+    - path: unix socket的路径
+    """
+    base = Config(**json.loads(config_file.read_text()))
+    base = replace(base, data_dir=Path(base.data_dir))
+    with BacktestService(base, max_workers=workers) as service:
+        print(f"serving {base.data_dir} on {path}")
+        asyncio.run(service.serve(path))
+        print(f"{service.n_jobs} jobs done")
+
+
+if __name__ == "__main__":
+    typer.run(main)
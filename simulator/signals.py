@@ -0,0 +1,57 @@
+import numpy as np
+from simulator.data_feeds import DataFeeds
+
+
+def compute_arb_signals(
+    fund_rates: np.ndarray, fundrate_diff_open: float
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """对整个历史一次性计算每个时刻、每个market上最好的套利对
+    Args:
+        fund_rates: shape=(time, market, exchange)
+    Returns: 每个都是shape=(time, market)
+        - long_ex: fundrate最小的exchange的序号
+        - short_ex: fundrate最大的exchange的序号
+        - fundrate_diff: short_ex与long_ex之间的fundrate差，>=0
+        - above_open: fundrate_diff是否达到开仓门槛
+
+    最大的两两fundrate差，一定是max-min，所以O(E)的argmin/argmax就够了，不必两两比较
+    argmin/argmax返回第一个出现的位置，与FundingArbStrategy._best_arb_pair的双重循环遇到并列时的选择一致
+    每一行的结果只依赖于这一行的funding rates，不会用到未来的数据
+    """
+    long_ex = np.argmin(fund_rates, axis=2)
+    short_ex = np.argmax(fund_rates, axis=2)
+
+    min_rates = np.take_along_axis(fund_rates, long_ex[:, :, np.newaxis], axis=2)[:, :, 0]
+    max_rates = np.take_along_axis(fund_rates, short_ex[:, :, np.newaxis], axis=2)[:, :, 0]
+    fundrate_diff = max_rates - min_rates
+
+    # fundrate_diff==0，说明所有exchange的fundrate都相同，不存在套利对
+    above_open = (fundrate_diff >= fundrate_diff_open) & (fundrate_diff > 0)
+    return long_ex, short_ex, fundrate_diff, above_open
+
+
+class ArbSignals:
+    """预先计算好的信号矩阵，(time, market) -> (long_ex id, short_ex id, fundrate_diff, above_open)
+    只能查询DataFeeds已经迭代到的行，防止回测时不小心用到了未来的数据
+    """
+
+    def __init__(self, data_feeds: DataFeeds, fundrate_diff_open: float) -> None:
+        self._data_feeds = data_feeds
+        self.long_ex, self.short_ex, self.fundrate_diff, self.above_open = compute_arb_signals(
+            data_feeds.field("fund_rate"), fundrate_diff_open
+        )
+
+    def at(self, row: int, market_idx: int) -> tuple[int, int, float] | None:
+        """
+        Returns: (long_ex id, short_ex id, fundrate_diff)，fundrate_diff不够大时返回None
+        """
+        if row > self._data_feeds.current_index:
+            raise LookupError(f"row={row} is in the future of data feeds at {self._data_feeds.current_index}")
+
+        if not self.above_open[row, market_idx]:
+            return None
+        return (
+            int(self.long_ex[row, market_idx]),
+            int(self.short_ex[row, market_idx]),
+            float(self.fundrate_diff[row, market_idx]),
+        )
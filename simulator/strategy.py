@@ -1,9 +1,21 @@
-from dataclasses import dataclass
+import hashlib
+import os
+import pickle
+import time
+import numpy as np
+from dataclasses import dataclass, replace
+from pathlib import Path
 from typing import Tuple
 from datetime import datetime
-from simulator.data_feeds import DataFeeds, FeedOnce
-from simulator.exchange import Exchange
+from simulator.data_feeds import DataFeeds, FeedOnce, LiveFeeds, StreamingDataFeeds
+from simulator.exchange import Exchange, Ledger
+from simulator.funding import FundingCalendar
+from simulator.instrument import RunStats, null_timer
+from simulator.journal import Journal
+from simulator.metrics import is_record_time, metrics_period, record_mask
 from simulator.arbitrage_trade import FundingArbTrade
+from simulator.risk import RiskTracker
+from simulator.signals import ArbSignals
 from simulator.utils import Config, hfr2a
 import logging
 
@@ -17,27 +29,84 @@ class ArbPair:
 
 
 class FundingArbStrategy:
-    def __init__(self, config: Config) -> None:
+    def __init__(
+        self, config: Config, data_feeds: DataFeeds | StreamingDataFeeds | LiveFeeds = None
+    ) -> None:
+        """data_feeds不为None时直接使用，exchanges和markets的顺序必须与config一致"""
         self._config = config
 
-        self._data_feeds = DataFeeds(
-            data_dir=config.data_dir, exchanges=config.exchanges, markets=config.markets
+        if data_feeds is None and config.chunk_rows is not None:
+            data_feeds = StreamingDataFeeds(
+                data_dir=config.data_dir,
+                exchanges=config.exchanges,
+                markets=config.markets,
+                chunk_rows=config.chunk_rows,
+                start=config.start,
+                end=config.end,
+            )
+        elif data_feeds is None:
+            data_feeds = DataFeeds(
+                data_dir=config.data_dir,
+                exchanges=config.exchanges,
+                markets=config.markets,
+                cache_dir=config.cache_dir,
+                start=config.start,
+                end=config.end,
+            )
+        assert data_feeds.exchanges == config.exchanges and data_feeds.markets == config.markets
+        self._data_feeds = data_feeds
+        # 流式读取或者实时行情时没有完整的历史，无法预先计算信号，只能逐bar比较fundrate
+        self._signals = (
+            ArbSignals(data_feeds, fundrate_diff_open=config.fundrate_diff_open)
+            if isinstance(data_feeds, DataFeeds)
+            else None
+        )
+        self._market_idx = {market: idx for idx, market in enumerate(config.markets)}  # 信号矩阵中的列
+        self._funding_calendar = FundingCalendar(config.exchanges, intervals=config.funding_intervals)
+        if isinstance(data_feeds, DataFeeds):
+            self._funding_calendar.index(data_feeds.timestamps, data_feeds.valid)
+
+        self._metrics_period = metrics_period(config.metrics_freq)
+        # 有完整的历史时，预先知道要记录多少次metrics，一次分配好；+1是回测结束时的记录
+        n_records = (
+            int(record_mask(data_feeds.timestamps, self._metrics_period).sum()) + 1
+            if isinstance(data_feeds, DataFeeds)
+            else 64
         )
 
+        self.journal = Journal(silent=config.silent)
+        # 所有exchange的账户都在同一个ledger里
+        self.ledger = Ledger(exchanges=config.exchanges, markets=config.markets)
         self._exchanges = {
             ex_name: Exchange(
                 name=ex_name,
                 init_cash=config.init_cash / len(config.exchanges),
                 markets={m: config.margin_rate for m in config.markets},
                 commission=config.commission,
+                journal=self.journal,
+                ledger=self.ledger,
+                metrics_per_market=config.metrics_per_market,
+                metrics_check_every=config.metrics_check_every,
+                metrics_capacity=n_records,
             )
             for ex_name in config.exchanges
         }
+        # 每个bar更新的风险统计，不需要保存完整的权益曲线
+        self.risk = RiskTracker(self.ledger, init_cash=config.init_cash / len(config.exchanges))
+        self.stats: RunStats = RunStats() if config.instrument else None
+        self._attach_stats()
 
         # market --> trade，同一时刻一个market只存在一个trade，1 long vs. 1 short，不存在multi long vs. multi short可能性
         self._active_arb_trades: dict[str, FundingArbTrade] = {}
         self.closed_trades: list[FundingArbTrade] = []
 
+        self._n_bars = 0  # 已经处理的bar数
+        self._last_feed: FeedOnce = None  # 最近一次处理的feed，回测结束时按它的价格平仓
+
+    def _attach_stats(self):
+        for exchange in self._exchanges.values():
+            exchange.stats = self.stats
+
     def iter_exchanges(self):
         return self._exchanges.values()
 
@@ -71,13 +140,32 @@ class FundingArbStrategy:
         if max_frate_diff < self._config.fundrate_diff_open:  # fundingrate差异不够大
             return None
 
-        logging.debug(
-            f"[{market}] best pair: "
-            f"long {long_ex} with AFR={hfr2a(ex_fundrates[long_ex]):.2%}, "
-            f"short {short_ex} with AFR={hfr2a(ex_fundrates[short_ex]):.2%}, "
-            f"AFRdiff={hfr2a(max_frate_diff):.2%}"
-        )
-        return ArbPair(market=market, long_ex=long_ex, short_ex=short_ex, fundrate_diff=max_frate_diff)
+        return self.__arb_pair(market, long_ex, short_ex, max_frate_diff, ex_fundrates)
+
+    def _signal_arb_pair(
+        self, row: int, market: str, funding_rates: dict[str, dict[str, float]]
+    ) -> ArbPair:
+        """与_best_arb_pair结果相同，但是直接读取预先计算好的信号矩阵"""
+        signal = self._signals.at(row, self._market_idx[market])
+        if signal is None:  # fundingrate差异不够大
+            return None
+
+        long_idx, short_idx, frate_diff = signal
+        long_ex = self._config.exchanges[long_idx]
+        short_ex = self._config.exchanges[short_idx]
+        return self.__arb_pair(market, long_ex, short_ex, frate_diff, funding_rates[market])
+
+    def __arb_pair(
+        self, market: str, long_ex: str, short_ex: str, frate_diff: float, ex_fundrates: dict[str, float]
+    ) -> ArbPair:
+        if not self._config.silent:
+            logging.debug(
+                f"[{market}] best pair: "
+                f"long {long_ex} with AFR={hfr2a(ex_fundrates[long_ex]):.2%}, "
+                f"short {short_ex} with AFR={hfr2a(ex_fundrates[short_ex]):.2%}, "
+                f"AFRdiff={hfr2a(frate_diff):.2%}"
+            )
+        return ArbPair(market=market, long_ex=long_ex, short_ex=short_ex, fundrate_diff=frate_diff)
 
     def __open(self, arbpair: ArbPair) -> Tuple[FundingArbTrade, FundingArbTrade]:
         """返回两个trade，第1个是要关闭的trade，第2个是要开仓或加仓的trade"""
@@ -89,10 +177,10 @@ class FundingArbStrategy:
         )
 
         if arbpair.market not in self._active_arb_trades:
-            self._active_arb_trades[arbpair.market] = new_trade
-            logging.info(
-                f"open new trade: {new_trade.name}, when AFRdiff={hfr2a(arbpair.fundrate_diff):.2%}"
-            )
+            if not self._config.silent:
+                logging.info(
+                    f"open new trade: {new_trade.name}, when AFRdiff={hfr2a(arbpair.fundrate_diff):.2%}"
+                )
             return None, new_trade
 
         old_trade = self._active_arb_trades[arbpair.market]
@@ -102,11 +190,12 @@ class FundingArbStrategy:
             arbpair.fundrate_diff
             >= old_trade.open_fundrate_diff * (1 + self._config.fundrate_diff_change_pct)
         ):
-            logging.info(
-                f"increase position on {new_trade.name}, "
-                f"last AFRdiff={hfr2a(old_trade.open_fundrate_diff ):.2%}, "
-                f"current AFRdiff={hfr2a(arbpair.fundrate_diff):.2%}"
-            )
+            if not self._config.silent:
+                logging.info(
+                    f"increase position on {new_trade.name}, "
+                    f"last AFRdiff={hfr2a(old_trade.open_fundrate_diff ):.2%}, "
+                    f"current AFRdiff={hfr2a(arbpair.fundrate_diff):.2%}"
+                )
             return None, old_trade  # 加仓
 
         # 本次发现的best pair与上次发现的best pair不同，并且fundrate_diff大了很多，换仓
@@ -114,10 +203,11 @@ class FundingArbStrategy:
             arbpair.fundrate_diff
             >= old_trade.latest_fundrate_diff * (1 + self._config.fundrate_diff_change_pct)
         ):
-            logging.info(
-                f"change trade from {old_trade.name}(AFRdiff={hfr2a(old_trade.latest_fundrate_diff):.2%}) to"
-                f" {new_trade.name}(AFRdiff={hfr2a(arbpair.fundrate_diff):.2%})"
-            )
+            if not self._config.silent:
+                logging.info(
+                    f"change trade from {old_trade.name}(AFRdiff={hfr2a(old_trade.latest_fundrate_diff):.2%}) to"
+                    f" {new_trade.name}(AFRdiff={hfr2a(arbpair.fundrate_diff):.2%})"
+                )
             # 关闭old active trade，开仓new_trade
             return old_trade, new_trade
 
@@ -126,34 +216,56 @@ class FundingArbStrategy:
     def __close(self, trade: FundingArbTrade, tm: datetime, ex2prices: dict[str, float]):
         trade.close(tm, ex2prices)
         self.closed_trades.append(trade)
+        if self.stats is not None:
+            self.stats.count("closes")
 
     def open(
         self,
         tm: datetime,
         prices: dict[str, dict[str, float]],
         funding_rates: dict[str, dict[str, float]],
+        row: int = None,
     ):
         """
         Args:
             prices:        out-key=market, inner dict: exchange->price
             funding_rates: out-key=market, inner dict: exchange->funding rate
+            row:           当前feed在DataFeeds中的行号，不为None时直接读取预先计算好的信号
         """
         for market in self._config.markets:
-            arbpair = self._best_arb_pair(market=market, funding_rates=funding_rates)
+            if row is None:
+                arbpair = self._best_arb_pair(market=market, funding_rates=funding_rates)
+            else:
+                arbpair = self._signal_arb_pair(row=row, market=market, funding_rates=funding_rates)
             if arbpair is None:  # fundingrate差异不够大，没有找到套利对
                 continue
 
             trade2close, trade2open = self.__open(arbpair)
             if trade2close is not None:
                 self.__close(trade2close, tm, prices[market])
+                del self._active_arb_trades[market]
 
             if trade2open is not None:
-                trade2open.safe_open(
+                is_add = trade2open.is_active
+                opened = trade2open.safe_open(
                     tm=tm,
                     usd_amount=self._config.ordersize_usd,
                     ex2prices=prices[market],
                     fundrate_diff=arbpair.fundrate_diff,
                 )
+                # 新开的trade只有真正开仓成功才算active，加仓失败则原trade保持不变
+                if opened:
+                    self._active_arb_trades[market] = trade2open
+
+                if self.stats is not None:
+                    if not opened:
+                        self.stats.count("margin_call_rollbacks")
+                    elif is_add:
+                        self.stats.count("adds")
+                    elif trade2close is not None:
+                        self.stats.count("switches")
+                    else:
+                        self.stats.count("opens")
 
     def close(
         self,
@@ -176,34 +288,187 @@ class FundingArbStrategy:
                 keep_open_trades[market] = trade
         self._active_arb_trades = keep_open_trades
 
-    def run(self):
-        for idx, feed in enumerate(self._data_feeds, start=1):
-            logging.info(f"\n********************** [{idx}] {feed.timestamp}")
+    def _timer(self):
+        """计时的hook，关闭instrument时是什么也不做的null_timer"""
+        return self.stats.timer if self.stats is not None else null_timer
+
+    def _on_feed(self, idx: int, feed: FeedOnce):
+        """一个bar上的完整流程：平仓、开仓、结算、记录metrics"""
+        timer = self._timer()
+        if self.stats is not None:
+            self.stats.count("bars")
+
+        with timer("logging"):
+            self.journal.set_time(feed.timestamp)
+            if not self._config.silent:
+                logging.info(f"\n********************** [{idx}] {feed.timestamp}")
+        with timer("close"):
             self.close(tm=feed.timestamp, prices=feed.open_prices, funding_rates=feed.funding_rates)
-            self.open(tm=feed.timestamp, prices=feed.open_prices, funding_rates=feed.funding_rates)
-
-            # begin debug
-            # for exchange in self._exchanges.values():
-            #     logging.debug(f"\n\n---------- before settle Exchange[{exchange.name}]")
-            #     exchange.inspect()
-            # end debug
-
-            for market, trade in self._active_arb_trades.items():
-                trade.settle(
-                    ex2prices=feed.close_prices[market],
-                    ex2markprices=feed.mark_prices[market],
-                    ex2fundrates=feed.funding_rates[market],
-                )
-            if feed.timestamp.hour == 23:  # 每天结束时记录一次metrics
-                trade.record_metrics(feed.timestamp)
+        with timer("open"):
+            row = feed.index if self._signals is not None else None
+            self.open(tm=feed.timestamp, prices=feed.open_prices, funding_rates=feed.funding_rates, row=row)
+
+        # begin debug
+        # for exchange in self._exchanges.values():
+        #     logging.debug(f"\n\n---------- before settle Exchange[{exchange.name}]")
+        #     exchange.inspect()
+        # end debug
+
+        if self.stats is not None:
+            self.stats.count("settlements", len(self._active_arb_trades))
+        with timer("settle"):
+            self._settle(feed)
+        with timer("risk"):
+            self.risk.update(feed.timestamp)
+        if is_record_time(feed.timestamp, self._metrics_period):  # 每个周期结束时记录一次metrics
+            with timer("metrics"):
+                self._record_metrics(feed.timestamp)
 
-            # begin debug
-            # for exchange in self._exchanges.values():
-            #     logging.debug(f"\n\n---------- after settle Exchange[{exchange.name}]")
-            #     exchange.inspect()
-            # end debug
+        # begin debug
+        # for exchange in self._exchanges.values():
+        #     logging.debug(f"\n\n---------- after settle Exchange[{exchange.name}]")
+        #     exchange.inspect()
+        # end debug
 
-        # 退出循环时，feed指向最后一个feed
+    def _settle(self, feed: FeedOnce):
+        # 只有结算时刻才支付funding，其余的bar只mark to market
+        funding_hours = self._funding_calendar.at(feed.index, feed.timestamp)
+        for market, trade in self._active_arb_trades.items():
+            trade.settle(
+                ex2prices=feed.close_prices[market],
+                ex2markprices=feed.mark_prices[market],
+                ex2fundrates=feed.funding_rates[market],
+                funding_hours=funding_hours,
+            )
+
+    def _record_metrics(self, timestamp: datetime):
+        # 每个exchange都记录，不论有没有持仓
+        for exchange in self._exchanges.values():
+            exchange.record_metrics(timestamp)
+
+    def _finish(self, feed: FeedOnce):
+        """回测结束，按最后一个feed的价格关闭所有仓位"""
         for market, trade in self._active_arb_trades.items():
             self.__close(trade, feed.timestamp, feed.close_prices[market])
-        trade.record_metrics(feed.timestamp)
+        self.risk.update(feed.timestamp)  # 平仓的手续费也计入回撤
+        self._record_metrics(feed.timestamp)
+
+    def run(self, checkpoint: Path | str = None):
+        """checkpoint不为None时，在回测结束平仓之前保存checkpoint，之后有了新数据可以用resume()接着回测
+        instrument时另外记录读取每个feed的耗时和跳过的无效行，结束时输出报告
+        """
+        timer = self._timer()
+        start = time.perf_counter()
+        prev_index = self._cursor() - 1
+        feeds = iter(self._data_feeds)
+        while True:
+            with timer("feed"):
+                feed = next(feeds, None)
+            if feed is None:
+                break
+            if self.stats is not None:
+                self.stats.count("skipped_nan_bars", feed.index - prev_index - 1)
+                prev_index = feed.index
+
+            self._n_bars += 1
+            self._on_feed(self._n_bars, feed)
+            self._last_feed = feed
+
+        if checkpoint is not None:
+            self.save_checkpoint(checkpoint)
+        if self._last_feed is not None:  # 没有任何有效的bar时，没有持仓，也不记录metrics
+            self._finish(self._last_feed)
+        if self.stats is not None:
+            self._report_stats(time.perf_counter() - start)
+
+    async def run_live(self):
+        """由LiveFeeds驱动的纸面交易，每个bar的update到齐时，走与run相同的_on_feed流程
+        - 处理一个bar的过程中没有await，读取行情在事件循环上进行，不阻塞
+        - 总是记录RunStats，另外记录"decision"：从bar可以发出到平仓/开仓/结算完成的延迟
+        - 行情结束时按最后一个bar的价格平仓
+        """
+        if self.stats is None:
+            self.stats = RunStats()
+            self._attach_stats()
+
+        start = time.perf_counter()
+        async for feed in self._data_feeds:
+            self._n_bars += 1
+            self._on_feed(self._n_bars, feed)
+            self.stats.add_time("decision", time.perf_counter() - feed.received_at)
+            self._last_feed = feed
+
+        if self._last_feed is not None:
+            self._finish(self._last_feed)
+        self._report_stats(time.perf_counter() - start)
+
+    def _report_stats(self, wall_seconds: float):
+        self.stats.wall_seconds += wall_seconds
+        if not self._config.silent:
+            logging.info(f"\n************************* Run Stats\n{self.stats.report()}")
+
+    # ------------------------------ checkpoint
+    # 模拟的全部可变状态，一起pickle才能保留对象之间的引用（trade->exchange->ledger/journal）
+    _STATE_ATTRS = [
+        "ledger",
+        "journal",
+        "_exchanges",
+        "_active_arb_trades",
+        "closed_trades",
+        "risk",
+        "_n_bars",
+        "_last_feed",
+    ]
+
+    def _cursor(self) -> int:
+        """下一个要处理的行号，最后一个处理过的有效行之后的无效行，在新数据中可能变得有效，所以要重新读"""
+        return 0 if self._last_feed is None else self._last_feed.index + 1
+
+    def _fingerprint(self, cursor: int) -> str:
+        """已经处理过的数据的hash，resume时用来检查旧数据有没有被修改"""
+        digest = hashlib.sha1()
+        digest.update(np.ascontiguousarray(self._data_feeds.timestamps[:cursor]).tobytes())
+        digest.update(np.ascontiguousarray(self._data_feeds.values[:cursor]).tobytes())
+        return digest.hexdigest()
+
+    def save_checkpoint(self, path: Path | str):
+        assert isinstance(self._data_feeds, DataFeeds), "checkpoint needs DataFeeds"
+        cursor = self._cursor()
+        state = dict(
+            config=self._config,
+            cursor=cursor,
+            fingerprint=self._fingerprint(cursor),
+            **{attr: getattr(self, attr) for attr in self._STATE_ATTRS},
+        )
+
+        # 先写临时文件再rename，中途失败不会破坏原来的checkpoint
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as outf:
+            pickle.dump(state, outf, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def resume(cls, checkpoint: Path | str, data_feeds: DataFeeds = None, config: Config = None):
+        """由checkpoint恢复，只处理checkpoint之后的新数据，结果与在全部数据上重新回测完全相同
+        - config为None时使用checkpoint中的config，除了数据目录之外必须与checkpoint一致
+        - data_feeds为None时由config重新载入数据，新数据的开头必须与checkpoint时处理过的数据完全相同
+        """
+        with open(checkpoint, "rb") as inf:
+            state = pickle.load(inf)
+
+        config = config if config is not None else state["config"]
+        # 数据目录和instrument不影响回测结果，可以与checkpoint不同
+        ignored = dict(data_dir=None, cache_dir=None, instrument=False)
+        if replace(config, **ignored) != replace(state["config"], **ignored):
+            raise ValueError("config differs from the checkpoint")
+
+        strategy = cls(config, data_feeds=data_feeds)
+        if strategy._fingerprint(state["cursor"]) != state["fingerprint"]:
+            raise ValueError("data before the checkpoint has changed, rerun from the first row")
+
+        for attr in cls._STATE_ATTRS:
+            setattr(strategy, attr, state[attr])
+        strategy._attach_stats()  # 恢复的exchange上带着保存checkpoint时的stats
+        strategy._data_feeds.seek(state["cursor"])
+        return strategy
@@ -0,0 +1,174 @@
+import itertools
+import json
+import os
+import numpy as np
+import pandas as pd
+import typer
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, replace
+from pathlib import Path
+from simulator.data_feeds import DataFeeds, FeedCache
+from simulator.exchange import MarginCall
+from simulator.isolated import IsolatedMarginStrategy
+from simulator.strategy import FundingArbStrategy
+from simulator.utils import Config
+
+# summarize中每个exchange的风险统计
+RISK_KEYS = ["sharpe", "max_drawdown_pct", "funding_yield", "time_in_market", "peak_margin_ratio"]
+
+# 每个worker进程里共享的只读数据块，由_init_worker载入
+_feed_block: tuple[np.ndarray, np.ndarray] = None
+
+
+def grid_configs(base: Config, grid: dict[str, list]) -> list[Config]:
+    """grid: Config的字段名 -> 候选值，返回所有组合"""
+    names = list(grid)
+    return [replace(base, **dict(zip(names, values))) for values in itertools.product(*grid.values())]
+
+
+def random_configs(base: Config, space: dict[str, tuple[float, float]], n: int, seed: int = 0) -> list[Config]:
+    """space: Config的字段名 -> (low, high)，在区间内均匀采样n组"""
+    rng = np.random.default_rng(seed)
+    return [
+        replace(base, **{name: float(rng.uniform(low, high)) for name, (low, high) in space.items()})
+        for _ in range(n)
+    ]
+
+
+def summarize(strategy: FundingArbStrategy) -> dict:
+    """一次回测的结果汇总成一行"""
+    trade_pnl = sum(trade.trade_pnl for trade in strategy.closed_trades)
+    fund_pnl = sum(trade.fund_pnl for trade in strategy.closed_trades)
+    result = dict(
+        n_trades=len(strategy.closed_trades),
+        trade_pnl=trade_pnl,
+        fund_pnl=fund_pnl,
+        total_pnl=trade_pnl + fund_pnl,
+    )
+
+    for exchange in strategy.iter_exchanges():
+        history = exchange.metric_history
+        if len(history) == 0:  # 没有任何有效的bar
+            continue
+        total_value = history["total_value"]
+        result[f"{exchange.name}_final_value"] = total_value.iloc[-1]
+        result[f"{exchange.name}_max_drawdown"] = (total_value.cummax() - total_value).max()
+        result[f"{exchange.name}_max_used_margin"] = history["used_margin"].max()
+        result[f"{exchange.name}_fund_pnl"] = history["fund_pnl"].iloc[-1]
+
+    # 逐bar的风险统计，比只在记录metrics的时刻采样更精确
+    if strategy.risk is not None:
+        for name, stats in strategy.risk.summary().items():
+            for key in RISK_KEYS:
+                result[f"{name}_{key}"] = stats[key]
+
+    return result
+
+
+def _init_worker(data_dir: Path, exchanges: list[str], markets: list[str], start, end, cache_dir: Path):
+    global _feed_block
+    # 主进程已经生成了缓存，这里只是mmap，所有worker映射的是同一份page cache
+    _feed_block = FeedCache(cache_dir).load_block(
+        Path(data_dir), exchanges=exchanges, markets=markets, start=start, end=end
+    )
+
+
+def make_strategy(
+    config: Config, feeds: DataFeeds, engine: type[FundingArbStrategy] = FundingArbStrategy
+) -> FundingArbStrategy | IsolatedMarginStrategy:
+    if config.isolated_margin:  # sweep已经是多进程了，每组参数的各个market在worker中依次回测
+        return IsolatedMarginStrategy(config, data_feeds=feeds, engine=engine, max_workers=1)
+    return engine(config, data_feeds=feeds)
+
+
+def shared_feeds(config: Config, rows: slice = slice(None)) -> DataFeeds:
+    """worker中共享数据块rows范围内的数据，切片是view，不拷贝；只能在worker_pool的进程中调用"""
+    timestamps, values = _feed_block
+    return DataFeeds.from_arrays(
+        timestamps[rows], values[rows], exchanges=config.exchanges, markets=config.markets
+    )
+
+
+def run_config(config: Config, engine: type[FundingArbStrategy], rows: slice = slice(None)) -> dict:
+    """在worker中回测一组Config，rows是共享数据块中使用的行"""
+    result = asdict(config)
+    try:
+        strategy = make_strategy(config, shared_feeds(config, rows), engine)
+        strategy.run()
+        result.update(summarize(strategy))
+    except MarginCall:
+        # 结算时发生margin call，这组参数不可用
+        result["error"] = "MarginCall"
+    return result
+
+
+def load_shared_block(configs: list[Config]) -> tuple[Path, tuple[np.ndarray, np.ndarray]]:
+    """所有Config必须使用相同的data_dir/exchanges/markets/start/end，数据通过FeedCache只载入一次
+    没有设置cache_dir时，缓存放在data_dir/.feed_cache下，返回缓存目录和mmap的数据块
+    """
+    base = configs[0]
+    feed_key = (base.data_dir, base.exchanges, base.markets, base.start, base.end)
+    for config in configs:
+        assert (
+            config.data_dir,
+            config.exchanges,
+            config.markets,
+            config.start,
+            config.end,
+        ) == feed_key, "configs should share feed data"
+
+    cache_dir = base.cache_dir if base.cache_dir is not None else Path(base.data_dir) / ".feed_cache"
+    block = FeedCache(cache_dir).load_block(
+        Path(base.data_dir), exchanges=base.exchanges, markets=base.markets, start=base.start, end=base.end
+    )
+    return cache_dir, block
+
+
+def worker_pool(base: Config, cache_dir: Path, max_workers: int = None) -> ProcessPoolExecutor:
+    """每个worker启动时mmap共享的数据块，之后的任务只传Config和行的范围"""
+    return ProcessPoolExecutor(
+        max_workers=max_workers or os.cpu_count(),
+        initializer=_init_worker,
+        initargs=(base.data_dir, base.exchanges, base.markets, base.start, base.end, cache_dir),
+    )
+
+
+def run_sweep(
+    configs: list[Config], max_workers: int = None, engine: type[FundingArbStrategy] = FundingArbStrategy
+) -> pd.DataFrame:
+    """在进程池中并行回测多组Config，每组结果一行，数据只载入一次，worker之间只读共享"""
+    cache_dir, _ = load_shared_block(configs)
+    max_workers = max_workers or os.cpu_count()
+    chunksize = max(1, len(configs) // (max_workers * 4))
+    with worker_pool(configs[0], cache_dir, max_workers) as executor:
+        results = list(executor.map(run_config, configs, itertools.repeat(engine), chunksize=chunksize))
+
+    return pd.DataFrame(results)
+
+
+def main(
+    config_file: Path,
+    grid_file: Path,
+    output: Path = Path("sweep.csv"),
+    workers: int = None,
+    n_samples: int = 0,
+    seed: int = 0,
+):
+    """
+    - config_file: json，Config的所有字段，作为基准参数
+    - grid_file: json，n_samples=0时是字段名->候选值列表，网格搜索；n_samples>0时是字段名->[low, high]，随机采样
+    """
+    base = Config(**json.loads(config_file.read_text()))
+    grid = json.loads(grid_file.read_text())
+    if n_samples > 0:
+        configs = random_configs(base, space=grid, n=n_samples, seed=seed)
+    else:
+        configs = grid_configs(base, grid=grid)
+
+    results = run_sweep(configs, max_workers=workers)
+    results.sort_values("total_pnl", ascending=False).to_csv(output, index=False)
+    print(f"{len(configs)} configs done, results saved to {output}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
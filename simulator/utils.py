@@ -18,6 +18,18 @@ class Config:
     exchanges: list[str]
     markets: list[str]
 
+    cache_dir: Path = None  # 不为None时，DataFeeds通过这个目录下的.npy缓存加载数据
+    silent: bool = False  # True时只往Journal中记录，不格式化任何日志字符串
+    chunk_rows: int = None  # 不为None时，用StreamingDataFeeds每次读入chunk_rows行，内存与历史长度无关
+    funding_intervals: dict[str, str] = None  # exchange -> funding结算周期，例如"8h"，没有指定的exchange每小时结算
+    start: str = None  # 只回测[start, end]之间的数据，None表示不限
+    end: str = None
+    metrics_freq: str = "1D"  # "bar"每个bar都记录metrics，或者"4h"、"1D"这样整除一天的周期，在周期最后一个小时记录
+    metrics_per_market: bool = False  # True时metric_history中还有每个market的列
+    metrics_check_every: int = 1  # 每记录多少次metrics检查一次会计恒等式，0表示不检查
+    isolated_margin: bool = False  # True时每个market有独立的资金，用IsolatedMarginStrategy按market并行回测
+    instrument: bool = False  # True时记录各阶段的耗时和事件计数，见RunStats，不影响回测结果
+
 HOURS_PER_YEAR = 24 * 365
 
 def hfr2a(hourly_fundrate):
@@ -0,0 +1,189 @@
+import itertools
+import json
+import os
+import numpy as np
+import pandas as pd
+import typer
+from dataclasses import dataclass
+from pathlib import Path
+from simulator.exchange import MarginCall
+from simulator.strategy import FundingArbStrategy
+from simulator.sweep import (
+    grid_configs,
+    load_shared_block,
+    make_strategy,
+    run_config,
+    shared_feeds,
+    summarize,
+    worker_pool,
+)
+from simulator.utils import Config
+
+
+@dataclass
+class WalkForwardResult:
+    windows: pd.DataFrame  # 每个窗口一行：训练/测试的时间范围，选中的参数，样本内和样本外的结果
+    equity: pd.Series  # 拼接起来的样本外权益曲线，所有exchange的total_value之和
+
+
+def make_windows(timestamps: np.ndarray, train_days: float, test_days: float) -> list[tuple[slice, slice]]:
+    """滚动的(训练, 测试)行范围，每次向前移动test_days，测试窗口首尾相接；最后一个测试窗口可能不满"""
+    times = pd.DatetimeIndex(timestamps)
+    train, test = pd.Timedelta(days=train_days), pd.Timedelta(days=test_days)
+
+    windows = []
+    train_start = times[0]
+    while train_start + train <= times[-1]:
+        rows = np.searchsorted(times, [train_start, train_start + train, train_start + train + test])
+        windows.append((slice(int(rows[0]), int(rows[1])), slice(int(rows[1]), int(rows[2]))))
+        train_start += test
+    return windows
+
+
+def equity_curve(strategy) -> pd.Series:
+    """所有exchange的total_value之和；最后一个bar上定时记录和平仓之后各有一条时，取平仓之后的"""
+    total = sum(exchange.metric_history["total_value"] for exchange in strategy.iter_exchanges())
+    return total.loc[~total.index.duplicated(keep="last")]
+
+
+def liquidation_curve(strategy, err: MarginCall) -> pd.Series:
+    """测试窗口中途margin call时的权益曲线：margin call之前记录的权益，加上强平时刻的一个点
+    强平时发生margin call的exchange上的资金全部损失，其余exchange按当时的市价计算
+    """
+    value = sum(
+        exchange.record_metrics(None)["total_value"]
+        for exchange in strategy.iter_exchanges()
+        if exchange.name != err.exchange
+    )
+    liquidation = pd.Series([value], index=[pd.Timestamp(strategy.journal.timestamp)], name="total_value")
+    equity = pd.concat([equity_curve(strategy), liquidation])
+    return equity.loc[~equity.index.duplicated(keep="last")]
+
+
+def _run_test(config: Config, engine: type[FundingArbStrategy], rows: slice) -> tuple[dict, pd.Series]:
+    strategy = make_strategy(config, shared_feeds(config, rows), engine)
+    try:
+        strategy.run()
+    except MarginCall as err:
+        return {"error": "MarginCall"}, liquidation_curve(strategy, err)
+    return summarize(strategy), equity_curve(strategy)
+
+
+def best_config(configs: list[Config], results: list[dict], objective: str) -> tuple[int | None, float]:
+    """objective最大的一组参数，margin call的参数不参与；并列时取configs中靠前的，结果是确定的
+    所有参数都margin call时返回(None, nan)
+    """
+    scores = [result.get(objective, np.nan) for result in results]
+    scores = [-np.inf if np.isnan(score) else score for score in scores]
+    best = int(np.argmax(scores))
+    if scores[best] == -np.inf:
+        return None, np.nan
+    return best, scores[best]
+
+
+def walk_forward(
+    base: Config,
+    grid: dict[str, list],
+    train_days: float,
+    test_days: float,
+    objective: str = "total_pnl",
+    max_workers: int = None,
+    engine: type[FundingArbStrategy] = FundingArbStrategy,
+) -> WalkForwardResult:
+    """滚动的样本内优化、样本外检验
+    - 数据只载入一次（FeedCache），各个窗口是共享数据块的行切片，worker之间只读共享，不拷贝
+    - 所有窗口的所有参数组合一起提交到进程池，在每个训练窗口上按objective选出最好的参数
+    - 用选中的参数回测紧接着的测试窗口，每个测试窗口从空仓和base.init_cash开始，结束时平仓
+    - 测试窗口的PnL首尾相接，拼成一条样本外的权益曲线
+    - 训练窗口上所有参数都margin call时，这个测试窗口不交易；测试窗口中途margin call时，权益曲线带上强平的损失
+    """
+    configs = grid_configs(base, grid)
+    cache_dir, (timestamps, _) = load_shared_block([base])
+    windows = make_windows(timestamps, train_days, test_days)
+    assert len(windows) > 0, "not enough data for one train window"
+
+    max_workers = max_workers or os.cpu_count()
+    with worker_pool(base, cache_dir, max_workers) as executor:
+        # 所有窗口的所有参数组合一起提交，进程池一直是满的
+        tasks = [(config, train) for train, _ in windows for config in configs]
+        configs_, trains = zip(*tasks)
+        chunksize = max(1, len(tasks) // (max_workers * 4))
+        train_results = list(
+            executor.map(run_config, configs_, itertools.repeat(engine), trains, chunksize=chunksize)
+        )
+
+        winners, rows = [], []
+        for widx, (train, test) in enumerate(windows):
+            results = train_results[widx * len(configs) : (widx + 1) * len(configs)]
+            best, score = best_config(configs, results, objective)
+            winners.append(None if best is None else configs[best])
+            rows.append(
+                dict(
+                    train_start=timestamps[train.start],
+                    train_end=timestamps[train.stop - 1],
+                    test_start=timestamps[test.start],
+                    test_end=timestamps[test.stop - 1],
+                    # 训练窗口上所有参数都margin call时，不在测试窗口上交易
+                    status="ok" if best is not None else "no_valid_config",
+                    **{name: None if best is None else getattr(configs[best], name) for name in grid},
+                    **{f"train_{objective}": score},
+                )
+            )
+
+        tested = [widx for widx, winner in enumerate(winners) if winner is not None]
+        test_results = dict(
+            zip(
+                tested,
+                executor.map(
+                    _run_test,
+                    [winners[widx] for widx in tested],
+                    itertools.repeat(engine),
+                    [windows[widx][1] for widx in tested],
+                ),
+            )
+        )
+
+    # 每个测试窗口都从init_cash开始，把前面窗口累计的PnL加上去
+    # 中途margin call的窗口，权益曲线到强平时刻为止，强平的损失计入之后的窗口
+    curves, offset = [], 0.0
+    for widx, row in enumerate(rows):
+        if widx not in test_results:  # 没有交易，权益不变
+            continue
+        summary, equity = test_results[widx]
+        if "error" in summary:
+            row["status"] = "margin_call"
+        row.update({f"test_{key}": value for key, value in summary.items()})
+        curves.append(equity - base.init_cash + offset)
+        if len(equity) > 0:
+            offset += equity.iloc[-1] - base.init_cash
+    equity = pd.concat(curves) + base.init_cash if curves else pd.Series(dtype=np.float64)
+
+    return WalkForwardResult(windows=pd.DataFrame(rows), equity=equity)
+
+
+def main(
+    config_file: Path,
+    grid_file: Path,
+    train_days: float,
+    test_days: float,
+    objective: str = "total_pnl",
+    output: Path = Path("walk_forward.csv"),
+    workers: int = None,
+):
+    """
+    - config_file: json，Config的所有字段，作为基准参数
+    - grid_file: json，字段名->候选值列表，在每个训练窗口上网格搜索
+    - output: 每个窗口的结果，样本外的权益曲线保存在同名的_equity.csv中
+    """
+    base = Config(**json.loads(config_file.read_text()))
+    grid = json.loads(grid_file.read_text())
+    result = walk_forward(base, grid, train_days, test_days, objective=objective, max_workers=workers)
+
+    result.windows.to_csv(output, index=False)
+    result.equity.rename("total_value").to_csv(output.with_name(f"{output.stem}_equity.csv"))
+    print(result.windows[["test_start", "test_end", *grid, f"train_{objective}", f"test_{objective}"]])
+    print(f"{len(result.windows)} windows done, results saved to {output}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,75 @@
+"""各个测试共用的Config和合成数据上的strategy"""
+
+import numpy as np
+import pytest
+from dataclasses import replace
+from prepare.synthetic import synthetic_block
+from simulator.data_feeds import DataFeeds, FIELDS
+from simulator.event_engine import EventSkippingStrategy
+from simulator.strategy import FundingArbStrategy
+from simulator.utils import Config, afr2h
+
+EXCHANGES = ["dydx", "rabbitx", "hyper"]
+MARKETS = ["BTC-USD", "ETH-USD", "SOL-USD"]
+
+
+def make_config(data_dir=None, **overrides) -> Config:
+    """测试用的Config，默认3个exchange x 2个market，overrides覆盖任意字段"""
+    config = Config(
+        init_cash=100000,
+        margin_rate=0.5,
+        commission=1 / 1000,
+        slippage=0,
+        ordersize_usd=1000,
+        fundrate_diff_open=afr2h(0.1),
+        fundrate_diff_close=afr2h(0.01),
+        fundrate_diff_change_pct=0.1,
+        data_dir=data_dir,
+        exchanges=EXCHANGES,
+        markets=MARKETS[:2],
+    )
+    return replace(config, **overrides)
+
+
+def make_strategy(
+    n_exchanges: int,
+    n_markets: int,
+    hours: int,
+    seed: int,
+    quantize: bool,
+    cls=FundingArbStrategy,
+    **overrides,
+):
+    """内存中合成数据上的strategy，exchange是ex0, ex1, ...，market是M0-USD, M1-USD, ..."""
+    exchanges = [f"ex{i}" for i in range(n_exchanges)]
+    markets = [f"M{i}-USD" for i in range(n_markets)]
+
+    timestamps, values = synthetic_block(n_exchanges, n_markets, hours=hours, seed=seed)
+    if quantize:
+        # 量化到2^-20的整数倍，制造大量并列的fundrate，而且相减没有舍入误差
+        fidx = FIELDS.index("fund_rate")
+        values[..., fidx] = np.round(values[..., fidx] * 2**20) / 2**20
+
+    config = make_config(exchanges=exchanges, markets=markets, **overrides)
+    feeds = DataFeeds.from_arrays(timestamps, values, exchanges=exchanges, markets=markets)
+    return cls(config, data_feeds=feeds)
+
+
+def assert_same(bar_by_bar: FundingArbStrategy, event_skipping: EventSkippingStrategy):
+    """逐bar回测与批量结算的引擎，交易相同，账户和metrics在浮点误差之内一致"""
+    assert [(t.name, t.open_tm, t.close_tm) for t in bar_by_bar.closed_trades] == [
+        (t.name, t.open_tm, t.close_tm) for t in event_skipping.closed_trades
+    ]
+    for expected, actual in zip(bar_by_bar.closed_trades, event_skipping.closed_trades):
+        assert actual.trade_pnl == pytest.approx(expected.trade_pnl, rel=1e-12, abs=1e-9)
+        assert actual.fund_pnl == pytest.approx(expected.fund_pnl, rel=1e-12, abs=1e-9)
+
+    for expected, actual in zip(bar_by_bar.iter_exchanges(), event_skipping.iter_exchanges()):
+        assert actual.cash == pytest.approx(expected.cash, rel=1e-12, abs=1e-9)
+        assert list(actual.metric_history.index) == list(expected.metric_history.index)
+        np.testing.assert_allclose(actual.metric_history, expected.metric_history, rtol=1e-12, atol=1e-9)
+
+
+def trade_key(trade):
+    """比较两次回测的closed_trades用的key"""
+    return (trade.market, trade.name, trade.open_tm, trade.close_tm, trade.trade_pnl, trade.fund_pnl)
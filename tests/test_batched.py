@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+from prepare.synthetic import make_synthetic_inputs
+from simulator.batched import BatchedStrategy
+from simulator.data_feeds import DataFeeds
+from simulator.exchange import MarginCall
+from simulator.strategy import FundingArbStrategy
+from simulator.sweep import random_configs, summarize
+from simulator.utils import afr2h
+from helpers import MARKETS, make_config
+
+SPACE = {
+    "init_cash": (600, 6000),  # 资金少的config开仓时会margin call，甚至结算时margin call
+    "margin_rate": (0.1, 0.6),
+    "commission": (0, 2 / 1000),
+    "slippage": (0, 1 / 1000),
+    "ordersize_usd": (200, 2000),
+    "fundrate_diff_open": (afr2h(0.02), afr2h(0.3)),
+    "fundrate_diff_close": (afr2h(0), afr2h(0.05)),
+    "fundrate_diff_change_pct": (0, 0.5),
+}
+
+
+def run_scalar(config, feeds) -> tuple[dict, pd.DataFrame]:
+    feeds.seek(0)
+    strategy = FundingArbStrategy(config, data_feeds=feeds)
+    try:
+        strategy.run()
+    except MarginCall:
+        return dict(error="MarginCall"), None
+    trades = pd.DataFrame(
+        [
+            (
+                trade.market,
+                trade.orders["long"].ex_name,
+                trade.orders["short"].ex_name,
+                np.datetime64(trade.open_tm, "ns"),
+                np.datetime64(trade.close_tm, "ns"),
+                trade.trade_pnl,
+                trade.fund_pnl,
+            )
+            for trade in strategy.closed_trades
+        ],
+        columns=["market", "long_ex", "short_ex", "open_tm", "close_tm", "trade_pnl", "fund_pnl"],
+    )
+    return summarize(strategy), trades
+
+
+def test_same_as_scalar(tmp_path):
+    base = make_config(
+        tmp_path, init_cash=3e6, markets=MARKETS, silent=True, funding_intervals={"dydx": "8h"}
+    )
+    make_synthetic_inputs(tmp_path, base.exchanges, base.markets, hours=24 * 20, seed=5, regimes=True)
+    feeds = DataFeeds(tmp_path, exchanges=base.exchanges, markets=base.markets)
+
+    configs = random_configs(base, SPACE, n=40, seed=1)
+    batched = BatchedStrategy(configs, data_feeds=feeds)
+    batched.run()
+    results = batched.results()
+    closed_trades = batched.closed_trades
+    assert len(results) == len(configs) and 0 < batched.failed.sum() < len(configs)
+
+    for k in range(0, len(configs), 4):
+        expected, trades = run_scalar(configs[k], feeds)
+        # 逐位相同，不是近似相等
+        assert batched.summary(k) == expected
+        if trades is None:
+            continue
+        actual = closed_trades.loc[closed_trades["config"] == k].drop(columns="config")
+        pd.testing.assert_frame_equal(
+            actual.reset_index(drop=True), trades, check_exact=True, check_dtype=False
+        )
+    assert results["n_trades"].max() > 0
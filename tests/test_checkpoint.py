@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from simulator.data_feeds import DataFeeds
+from simulator.event_engine import EventSkippingStrategy
+from simulator.strategy import FundingArbStrategy
+from helpers import make_strategy
+
+
+def summary(strategy: FundingArbStrategy):
+    return (
+        [(t.name, t.open_tm, t.close_tm, t.trade_pnl, t.fund_pnl) for t in strategy.closed_trades],
+        [exchange.metric_history for exchange in strategy.iter_exchanges()],
+        [strategy.journal.fills.records, strategy.journal.settlements.records],
+    )
+
+
+def assert_identical(actual, expected):
+    assert actual[0] == expected[0]
+    for a, e in zip(actual[1], expected[1]):
+        assert a.equals(e)
+    for a, e in zip(actual[2], expected[2]):
+        assert np.array_equal(a, e)
+
+
+@pytest.mark.parametrize("cls", [FundingArbStrategy, EventSkippingStrategy])
+def test_resume(tmp_path, cls):
+    full = make_strategy(3, n_markets=2, hours=24 * 40, seed=2, quantize=False, cls=cls, silent=True)
+    feeds = full._data_feeds
+    config = full._config
+    full.run()
+    assert len(full.closed_trades) > 0
+
+    # 每次只多了几天的数据，每次都从上一个checkpoint接着跑
+    checkpoint = tmp_path / "state.pkl"
+    for n_days in [20, 27, 27, 33, 40]:
+        partial = DataFeeds.from_arrays(
+            feeds.timestamps[: 24 * n_days], feeds.values[: 24 * n_days], config.exchanges, config.markets
+        )
+        if n_days == 20:
+            strategy = cls(config, data_feeds=partial)
+        else:
+            strategy = cls.resume(checkpoint, data_feeds=partial)
+        strategy.run(checkpoint=checkpoint)
+
+    assert_identical(summary(strategy), summary(full))
+
+
+def test_changed_history(tmp_path):
+    strategy = make_strategy(2, n_markets=1, hours=24 * 10, seed=2, quantize=False, silent=True)
+    feeds = strategy._data_feeds
+    config = strategy._config
+    strategy.run(checkpoint=tmp_path / "state.pkl")
+
+    values = np.array(feeds.values)
+    values[5, 0, 0, 0] += 1
+    changed = DataFeeds.from_arrays(feeds.timestamps, values, config.exchanges, config.markets)
+    with pytest.raises(ValueError):
+        FundingArbStrategy.resume(tmp_path / "state.pkl", data_feeds=changed)
@@ -1,5 +1,9 @@
-from simulator.data_feeds import DataFeeds, FeedOnce
+from pathlib import Path
+from simulator.data_feeds import DataFeeds, FeedCache, FeedOnce
 from simulator.utils import hfr2a
+from prepare.synthetic import make_synthetic_inputs
+import numpy as np
+import pandas as pd
 from pprint import pprint
 from prettytable import PrettyTable
 
@@ -61,5 +65,86 @@ def test():
     tester.run()
 
 
+def test_block_matches_csv(tmp_path):
+    exchanges = ["dydx", "rabbitx"]
+    markets = ["BTC-USD", "ETH-USD"]
+    make_synthetic_inputs(tmp_path, exchanges=exchanges, markets=markets, hours=48)
+
+    # 挖掉一个值，整行都应该被跳过
+    fname = tmp_path / "rabbitx_ETH-USD.csv"
+    df = pd.read_csv(fname, index_col="timestamp", parse_dates=True)
+    df.iloc[5, 0] = float("nan")
+    df.to_csv(fname, index_label="timestamp")
+
+    datas = {
+        (ex, m): pd.read_csv(tmp_path / f"{ex}_{m}.csv", index_col="timestamp", parse_dates=True)
+        for ex in exchanges
+        for m in markets
+    }
+
+    feeds = list(DataFeeds(data_dir=tmp_path, exchanges=exchanges, markets=markets))
+    assert len(feeds) == 47
+    assert 5 not in [feed.index for feed in feeds]
+
+    for feed in feeds:
+        for (ex, m), df in datas.items():
+            row = df.iloc[feed.index, :]
+            assert feed.timestamp == row.name.to_pydatetime()
+            for col in ["open_price", "close_price", "mark_price", "fund_rate"]:
+                assert feed.get(col)[m][ex] == row[col]
+
+
+def test_cache(tmp_path):
+    exchanges = ["dydx", "rabbitx"]
+    markets = ["BTC-USD", "ETH-USD"]
+    data_dir = tmp_path / "input"
+    cache_dir = tmp_path / "cache"
+    make_synthetic_inputs(data_dir, exchanges=exchanges, markets=markets, hours=48)
+
+    plain = DataFeeds(data_dir=data_dir, exchanges=exchanges, markets=markets)
+    first = DataFeeds(data_dir=data_dir, exchanges=exchanges, markets=markets, cache_dir=cache_dir)
+    n_cached_files = len(list(cache_dir.iterdir()))
+    second = DataFeeds(data_dir=data_dir, exchanges=exchanges, markets=markets, cache_dir=cache_dir)
+
+    assert len(list(cache_dir.iterdir())) == n_cached_files  # 第二次加载直接命中缓存
+    assert isinstance(second.values, np.memmap)
+    assert np.array_equal(plain.values, second.values)
+    assert np.array_equal(plain.timestamps, second.timestamps)
+    assert [f.timestamp for f in first] == [f.timestamp for f in plain]
+
+    # 源文件变化后，缓存失效，重新转换
+    fname = data_dir / "dydx_BTC-USD.csv"
+    df = pd.read_csv(fname, index_col="timestamp", parse_dates=True)
+    df.iloc[0, 0] = 0.5
+    df.to_csv(fname, index_label="timestamp")
+    third = DataFeeds(data_dir=data_dir, exchanges=exchanges, markets=markets, cache_dir=cache_dir)
+    assert third.field("fund_rate")[0, 0, 0] == 0.5
+
+
+def test_cache_hashes_and_evict(tmp_path, monkeypatch):
+    exchanges = ["dydx", "rabbitx"]
+    data_dir = tmp_path / "input"
+    make_synthetic_inputs(data_dir, exchanges=exchanges, markets=["BTC-USD"], hours=48)
+    cache = FeedCache(tmp_path / "cache")
+    for end in ["2024-01-01 12:00", "2024-01-02 00:00", None]:
+        cache.load_block(data_dir, exchanges, ["BTC-USD"], end=end)
+
+    # 源文件没有变化时，不再读取源文件计算hash
+    read_bytes = []
+    monkeypatch.setattr(Path, "read_bytes", lambda self: read_bytes.append(self) or b"")
+    cache = FeedCache(tmp_path / "cache")
+    cache.load_block(data_dir, exchanges, ["BTC-USD"])
+    assert read_bytes == []
+    monkeypatch.undo()
+
+    # 每个(start, end)一个数据块，再加上每个csv一份；最久没用的先删除
+    sizes = {path.name: path.stat().st_size for path in (tmp_path / "cache").glob("*.npy")}
+    assert len(sizes) == 2 * (3 + len(exchanges))
+    freed = cache.evict(max_bytes=sum(sizes.values()) - 1)
+    assert 0 < freed < sum(sizes.values())
+    assert cache.evict() > 0
+    assert list((tmp_path / "cache").iterdir()) == []
+
+
 if __name__ == "__main__":
     test()
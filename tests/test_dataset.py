@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+from prepare.synthetic import make_synthetic_inputs
+from simulator import dataset as dataset_module
+from simulator.data_feeds import DataFeeds, StreamingDataFeeds
+from simulator.dataset import PartitionedDataset
+
+EXCHANGES = ["dydx", "rabbitx"]
+MARKETS = ["BTC-USD", "ETH-USD", "SOL-USD"]
+HOURS = 24 * 80  # 2024-01-01 ~ 2024-03-20，跨3个月
+
+
+def make_inputs(tmp_path):
+    make_synthetic_inputs(tmp_path / "csv", exchanges=EXCHANGES, markets=MARKETS, hours=HOURS)
+    make_synthetic_inputs(
+        tmp_path / "dataset", exchanges=EXCHANGES, markets=MARKETS, hours=HOURS, dataset=True
+    )
+    return tmp_path / "csv", tmp_path / "dataset"
+
+
+def assert_same_feeds(actual, expected, rtol=0.0):
+    assert np.array_equal(actual.timestamps, expected.timestamps)
+    # csv中的浮点数经过了文本转换，只在最后一位上有误差
+    np.testing.assert_allclose(actual.values, expected.values, rtol=rtol, atol=0)
+
+
+def test_same_as_csv(tmp_path):
+    csv_dir, dataset_dir = make_inputs(tmp_path)
+    dataset = PartitionedDataset(dataset_dir)
+    assert [str(m) for m in dataset.months("dydx", "BTC-USD")] == ["2024-01", "2024-02", "2024-03"]
+
+    assert_same_feeds(
+        DataFeeds(dataset_dir, exchanges=EXCHANGES, markets=MARKETS),
+        DataFeeds(csv_dir, exchanges=EXCHANGES, markets=MARKETS),
+        rtol=1e-15,
+    )
+
+    # 时间范围和market的过滤，与csv截取的结果相同
+    start, end = "2024-02-10", "2024-03-05 12:00"
+    filtered = DataFeeds(dataset_dir, exchanges=EXCHANGES, markets=MARKETS[1:], start=start, end=end)
+    expected = DataFeeds(csv_dir, exchanges=EXCHANGES, markets=MARKETS[1:], start=start, end=end)
+    assert_same_feeds(filtered, expected, rtol=1e-15)
+    assert filtered.timestamps[0] == np.datetime64(start) and filtered.timestamps[-1] == np.datetime64(end)
+
+
+def test_reads_only_matching_partitions(tmp_path, monkeypatch):
+    _, dataset_dir = make_inputs(tmp_path)
+    loaded = []
+    np_load = np.load
+    monkeypatch.setattr(
+        dataset_module.np, "load", lambda path, *args, **kwargs: loaded.append(path) or np_load(path)
+    )
+
+    DataFeeds(dataset_dir, exchanges=EXCHANGES, markets=["ETH-USD"], start="2024-02-03", end="2024-02-20")
+    assert len(loaded) == len(EXCHANGES) * 5  # 每个exchange只读一个分区的timestamp和4个字段
+    assert {p.parent.name for p in loaded} == {"2024-02"}
+    assert {p.parent.parent.name for p in loaded} == {"ETH-USD"}
+
+
+def test_streaming_and_cache(tmp_path):
+    _, dataset_dir = make_inputs(tmp_path)
+    start, end = "2024-01-20", "2024-03-02"
+    expected = DataFeeds(dataset_dir, exchanges=EXCHANGES, markets=MARKETS, start=start, end=end)
+
+    cached = DataFeeds(
+        dataset_dir,
+        exchanges=EXCHANGES,
+        markets=MARKETS,
+        start=start,
+        end=end,
+        cache_dir=tmp_path / "cache",
+    )
+    assert isinstance(cached.values, np.memmap)
+    assert_same_feeds(cached, expected)
+
+    streaming = list(
+        StreamingDataFeeds(dataset_dir, exchanges=EXCHANGES, markets=MARKETS, start=start, end=end)
+    )
+    assert [f.timestamp for f in streaming] == pd.DatetimeIndex(
+        expected.timestamps
+    ).to_pydatetime().tolist()
+    for feed in streaming[::97]:
+        for fidx, col in enumerate(["open_price", "close_price", "mark_price", "fund_rate"]):
+            row = expected.values[feed.index, :, :, fidx]
+            assert [list(feed.get(col)[m].values()) for m in MARKETS] == row.tolist()
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from simulator.event_engine import EventSkippingStrategy
+from simulator.exchange import MarginCall
+from dataclasses import replace
+from simulator.data_feeds import DataFeeds
+from simulator.strategy import FundingArbStrategy
+from simulator.sweep import summarize
+from helpers import assert_same, make_strategy
+
+
+def run_both(**kwargs):
+    results = []
+    for cls in [FundingArbStrategy, EventSkippingStrategy]:
+        # 平仓门槛为0，持仓时间长一些，才有足够多可以跳过的bar
+        strategy = make_strategy(**kwargs, quantize=False, cls=cls, fundrate_diff_close=0)
+        try:
+            strategy.run()
+        except MarginCall:
+            strategy = None
+        results.append(strategy)
+    return results
+
+
+@pytest.mark.parametrize("n_exchanges", [2, 3, 5])
+def test_same_as_bar_by_bar(n_exchanges):
+    bar_by_bar, event_skipping = run_both(n_exchanges=n_exchanges, n_markets=3, hours=24 * 30, seed=3)
+    assert len(bar_by_bar.closed_trades) > 0
+    assert event_skipping.n_stepped_bars < len(event_skipping._rows)
+    assert_same(bar_by_bar, event_skipping)
+
+
+def test_journal():
+    # 批量结算的bar也有fundrate差和结算记录，与逐bar回测的journal相同
+    bar_by_bar, event_skipping = run_both(n_exchanges=3, n_markets=3, hours=24 * 30, seed=3)
+    assert event_skipping.n_stepped_bars < len(event_skipping._rows)
+    for name in ["fills", "settlements", "fundrate_diffs"]:
+        expected = getattr(bar_by_bar.journal, name).records
+        actual = getattr(event_skipping.journal, name).records
+        assert len(actual) == len(expected) > 0
+        for field in expected.dtype.names:
+            if expected.dtype[field] == np.float64:
+                np.testing.assert_allclose(actual[field], expected[field], rtol=1e-12, atol=1e-9)
+            else:
+                assert np.array_equal(actual[field], expected[field]), field
+
+
+def test_margin_call():
+    # 资金很少，可能发生margin call的bar要退回逐bar处理，结果仍与逐bar回测一致（包括抛出MarginCall）
+    for init_cash in [2200, 3000, 5000, 10000]:
+        bar_by_bar, event_skipping = run_both(
+            n_exchanges=2, n_markets=3, hours=24 * 30, seed=3, init_cash=init_cash, margin_rate=1
+        )
+        assert (bar_by_bar is None) == (event_skipping is None)
+        if bar_by_bar is not None:
+            assert_same(bar_by_bar, event_skipping)
+
+
+@pytest.mark.parametrize("cls", [FundingArbStrategy, EventSkippingStrategy])
+@pytest.mark.parametrize("instrument", [False, True])
+def test_no_valid_rows(cls, instrument):
+    # 数据中间的空档比窗口还长时，切出来的窗口没有行，或者全是NaN，得到空的结果
+    template = make_strategy(n_exchanges=2, n_markets=2, hours=24, seed=0, quantize=False)
+    feeds, config = template._data_feeds, replace(template._config, instrument=instrument)
+    values = feeds.values.copy()
+    values[:, 0, 1] = np.nan
+    for rows, block in [(slice(0), feeds.values), (slice(None), values)]:
+        sliced = DataFeeds.from_arrays(feeds.timestamps[rows], block[rows], feeds.exchanges, feeds.markets)
+        strategy = cls(config, data_feeds=sliced)
+        strategy.run()
+        assert summarize(strategy)["n_trades"] == 0
+        assert all(len(exchange.metric_history) == 0 for exchange in strategy.iter_exchanges())
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from copy import copy
+from simulator.exchange import Exchange, Ledger, MarginCall, transaction
+from helpers import make_strategy
+
+
+def test_ledger_totals():
+    strategy = make_strategy(3, n_markets=4, hours=24 * 20, seed=1, quantize=False, silent=True)
+    strategy.run()
+    ledger = strategy.ledger
+    assert len(strategy.closed_trades) > 0
+
+    # 增量维护的合计与逐个账户重新求和一致
+    for name, exchange in zip(ledger.exchanges, strategy.iter_exchanges()):
+        idx = ledger.exchange_idx(name)
+        assert exchange.cash == ledger.cash[idx]
+        for field in Ledger.TOTAL_FIELDS:
+            resum = sum(getattr(exchange.get_account(m), field) for m in ledger.markets)
+            assert ledger.totals[field][idx] == pytest.approx(resum, abs=1e-9)
+
+
+def test_ledger_batch():
+    ledger = Ledger(exchanges=["a", "b"], markets=["X", "Y", "Z"])
+    slots = np.array([ledger.slot("a", "X"), ledger.slot("b", "Z"), ledger.slot("a", "X")])
+    ledger.batch_add("trade_pnl", slots, np.array([1.0, 2.0, 4.0]))
+    assert ledger.columns["trade_pnl"][slots[0]] == 5.0
+    assert list(ledger.totals["trade_pnl"]) == [5.0, 2.0]
+
+    ledger.batch_set("trade_pnl", slots[:2], np.array([-1.0, 3.0]))
+    assert list(ledger.totals["trade_pnl"]) == [-1.0, 3.0]
+    assert np.array_equal(ledger.view("trade_pnl"), [-1, 0, 0, 0, 0, 3])
+
+    ledger.add("used_margin", ledger.slot("b", "Y"), 7.0)
+    ledger.set("used_margin", ledger.slot("b", "Y"), 2.0)
+    assert list(ledger.totals["used_margin"]) == [0.0, 2.0]
+
+
+def test_snapshot_restore():
+    exchange = Exchange("a", init_cash=10000, markets={"X": 0.5, "Y": 0.5}, commission=0.001)
+    exchange.buy("X", price=100, shares=10)
+    account = exchange.get_account("X")
+    snapshots = {market: copy(exchange.get_account(market)) for market in ["X", "Y"]}
+    cash = exchange.cash
+    metric = exchange.record_metrics(None)
+
+    exchange.sell("X", price=110, shares=4)
+    exchange.buy("Y", price=50, shares=2)
+    assert account.long_short_shares == 6
+    assert snapshots["X"].long_short_shares == 10  # 快照与ledger脱离
+
+    for market, snapshot in snapshots.items():
+        exchange.set_account(market, snapshot)
+    exchange.cash = cash
+    assert exchange.get_account("X") is account
+    assert account.long_short_shares == 10 and account.hold_price == 100
+    assert exchange.record_metrics(None) == pytest.approx(metric)
+
+
+def ledger_state(ledger: Ledger) -> list:
+    arrays = list(ledger.columns.values()) + list(ledger.totals.values()) + [ledger.cash]
+    return [list(a) for a in arrays]
+
+
+def test_transaction():
+    ledger = Ledger(exchanges=["a", "b"], markets=["X"])
+    a = Exchange("a", init_cash=10000, markets={"X": 0.5}, commission=0.001, ledger=ledger)
+    b = Exchange("b", init_cash=10000, markets={"X": 0.5}, commission=0.001, ledger=ledger)
+    a.buy("X", price=100, shares=10)
+    account = a.get_account("X")
+    before = ledger_state(ledger)
+
+    # 嵌套事务：内层回滚只撤销内层的写入
+    a.begin()
+    a.settle_trading("X", price=101)
+    after_settle = ledger_state(ledger)
+    b.begin()
+    b.sell("X", price=100, shares=5)
+    a.sell("X", price=101, shares=3)
+    b.rollback()
+    assert ledger_state(ledger) == after_settle
+    a.rollback()
+    assert ledger_state(ledger) == before
+    assert ledger.undo is None
+
+    # 没有异常时提交，undo log被丢弃
+    with transaction(a, b):
+        a.sell("X", price=101, shares=3)
+    assert account.long_short_shares == 7 and ledger.undo is None
+
+    # 任何一条腿margin call，两条腿都回滚，账户对象不变
+    before = ledger_state(ledger)
+    with pytest.raises(MarginCall):
+        with transaction(a, b):
+            a.buy("X", price=100, shares=10)
+            b.sell("X", price=100, shares=1000)
+    assert ledger_state(ledger) == before
+    assert a.get_account("X") is account
+
+
+def test_transaction_separate_ledgers():
+    a = Exchange("a", init_cash=10000, markets={"X": 0.5}, commission=0.001)
+    b = Exchange("b", init_cash=100, markets={"X": 0.5}, commission=0.001)
+    before = [ledger_state(a.ledger), ledger_state(b.ledger)]
+    with pytest.raises(MarginCall):
+        with transaction(a, b):
+            a.buy("X", price=100, shares=10)
+            b.sell("X", price=100, shares=10)
+    assert [ledger_state(a.ledger), ledger_state(b.ledger)] == before
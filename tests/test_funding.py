@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+import pytest
+from dataclasses import replace
+from simulator.arbitrage_trade import FundingArbTrade
+from simulator.data_feeds import DataFeeds
+from simulator.event_engine import EventSkippingStrategy
+from simulator.exchange import Exchange
+from simulator.funding import FundingCalendar
+from simulator.strategy import FundingArbStrategy
+from helpers import assert_same, make_config, make_strategy
+
+
+def minute_strategy(n_sub_bars: int, cls=FundingArbStrategy, **config_overrides):
+    """每个小时bar拆成n_sub_bars个相同的子bar，返回(小时bar的strategy, 子bar的strategy)"""
+    hourly = make_strategy(3, n_markets=2, hours=24 * 20, seed=5, quantize=False, silent=True)
+    feeds = hourly._data_feeds
+    step = np.timedelta64(60 // n_sub_bars, "m")
+    timestamps = (feeds.timestamps[:, None] + np.arange(n_sub_bars) * step).ravel()
+    values = np.repeat(feeds.values, n_sub_bars, axis=0)
+
+    config = replace(hourly._config, **config_overrides)
+    sub_feeds = DataFeeds.from_arrays(timestamps, values, exchanges=config.exchanges, markets=config.markets)
+    return hourly, cls(config, data_feeds=sub_feeds)
+
+
+def test_calendar():
+    timestamps = pd.date_range("2024-01-01", periods=24 * 12, freq="5min").to_numpy()
+    valid = np.ones(len(timestamps), dtype=bool)
+    valid[12 * 8] = False  # 08:00这个bar无效，顺延到下一个有效bar
+
+    calendar = FundingCalendar(["a", "b"], intervals={"b": "8h"})
+    calendar.index(timestamps, valid)
+    assert len(calendar.rows["a"]) == 24
+    assert list(calendar.rows["b"]) == [0, 12 * 8 + 1, 12 * 16]
+    assert calendar.at(0, None) == {"a": 1.0, "b": 8.0}
+    assert calendar.at(1, None) == {}
+
+    # 流式数据逐bar判断，与预先计算的结果相同
+    online = FundingCalendar(["a", "b"], intervals={"b": "8h"})
+    for row in np.flatnonzero(valid):
+        assert online.at(None, pd.Timestamp(timestamps[row])) == calendar.at(row, None)
+
+
+def test_sub_bars_same_as_hourly():
+    # 子bar上价格和funding rate不变，开平仓只发生在每小时的第一个子bar，funding每小时结算一次，结果与小时bar相同
+    hourly, sub_bars = minute_strategy(n_sub_bars=12)
+    hourly.run()
+    sub_bars.run()
+
+    # 回测结束时按最后一个bar平仓，子bar的最后一个bar是23:55，不是23:00
+    def summary(strategy):
+        return [
+            (t.name, t.open_tm, pd.Timestamp(t.close_tm).floor("h"), t.trade_pnl, t.fund_pnl)
+            for t in strategy.closed_trades
+        ]
+
+    assert len(hourly.closed_trades) > 0
+    assert summary(sub_bars) == summary(hourly)
+    for actual, expected in zip(sub_bars.iter_exchanges(), hourly.iter_exchanges()):
+        assert list(actual.metric_history.index.floor("h")) == list(expected.metric_history.index)
+        assert np.array_equal(actual.metric_history.to_numpy(), expected.metric_history.to_numpy())
+
+    settlements = sub_bars.journal.settlements.records
+    paid = settlements["fund_pnl"] != 0
+    assert 0 < paid.sum() < len(settlements) / 10
+    assert (pd.DatetimeIndex(settlements["timestamp"][paid]).minute == 0).all()
+
+
+def test_8h_funding():
+    hourly, strategy = minute_strategy(n_sub_bars=4, funding_intervals={"ex1": "8h"})
+    strategy.run()
+
+    settlements = pd.DataFrame(strategy.journal.settlements.records)
+    settlements["exchange"] = [strategy.journal.exchanges[idx] for idx in settlements["exchange"]]
+    paid = settlements.loc[settlements["fund_pnl"] != 0]
+    times = pd.DatetimeIndex(paid["timestamp"])
+    assert set(paid["exchange"]) == {"ex0", "ex1", "ex2"}
+    assert ((times.minute == 0) & (times.hour % 8 == 0))[paid["exchange"] == "ex1"].all()
+    assert (times.minute == 0).all()
+
+
+@pytest.mark.parametrize("intervals", [None, {"ex0": "8h", "ex2": "4h"}])
+def test_event_engine(intervals):
+    results = []
+    for cls in [FundingArbStrategy, EventSkippingStrategy]:
+        _, strategy = minute_strategy(n_sub_bars=4, cls=cls, funding_intervals=intervals, fundrate_diff_close=0)
+        strategy.run()
+        results.append(strategy)
+    assert_same(*results)
+
+
+@pytest.mark.parametrize("funding_hours, paid_hours", [(None, 1.0), ({"dydx": 8.0, "rabbitx": 8.0}, 8.0), ({}, 0.0)])
+def test_trade_settle(funding_hours, paid_hours):
+    """不传funding_hours时每条腿都按小时结算（原来的三参数调用），空dict只mark to market"""
+    config = make_config(exchanges=["dydx", "rabbitx"], markets=["BTC-USD"])
+    long_ex, short_ex = [
+        Exchange(ex, init_cash=config.init_cash, markets={"BTC-USD": 0.5}, commission=0.001)
+        for ex in config.exchanges
+    ]
+    trade = FundingArbTrade("BTC-USD", long_ex, short_ex, config)
+    prices = {"dydx": 100.0, "rabbitx": 100.0}
+    assert trade.safe_open(pd.Timestamp("2024-01-01"), config.ordersize_usd, prices, fundrate_diff=1e-4)
+    trade.latest_fundrate_diff = 1e-4
+
+    fundrates = {"dydx": 1e-5, "rabbitx": 1e-4}
+    if funding_hours is None:
+        trade.settle(prices, prices, fundrates)
+    else:
+        trade.settle(prices, prices, fundrates, funding_hours=funding_hours)
+
+    shares = config.ordersize_usd / 100.0
+    assert trade.orders["long"].fund_pnl == pytest.approx(-shares * 100.0 * 1e-5 * paid_hours)
+    assert trade.orders["short"].fund_pnl == pytest.approx(shares * 100.0 * 1e-4 * paid_hours)
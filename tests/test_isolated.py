@@ -0,0 +1,69 @@
+import pytest
+from dataclasses import replace
+from prepare.synthetic import make_synthetic_inputs
+from simulator.isolated import IsolatedMarginStrategy, market_config
+from simulator.strategy import FundingArbStrategy
+from simulator.sweep import RISK_KEYS, run_sweep
+from helpers import MARKETS, make_config, trade_key
+
+
+def test_isolated(tmp_path):
+    # 资金足够，不会margin call，逐仓与全仓的交易完全相同
+    config = make_config(tmp_path, init_cash=3e6, markets=MARKETS, silent=True, isolated_margin=True)
+    make_synthetic_inputs(tmp_path, config.exchanges, config.markets, hours=24 * 30, seed=5, regimes=True)
+
+    parallel = IsolatedMarginStrategy(config, max_workers=3)
+    parallel.run()
+    inline = IsolatedMarginStrategy(config, max_workers=1)
+    inline.run()
+    assert [trade_key(t) for t in parallel.closed_trades] == [trade_key(t) for t in inline.closed_trades]
+    for merged, expected in zip(parallel.iter_exchanges(), inline.iter_exchanges()):
+        assert merged.metric_history.equals(expected.metric_history)
+
+    # 每个market单独回测的结果
+    singles = []
+    for market in config.markets:
+        single = FundingArbStrategy(market_config(config, market))
+        single.run()
+        singles.append(single)
+    assert sorted(map(trade_key, parallel.closed_trades)) == sorted(
+        trade_key(t) for s in singles for t in s.closed_trades
+    )
+    close_times = [t.close_tm for t in parallel.closed_trades]
+    assert close_times == sorted(close_times)
+
+    # 资金足够时，与全仓回测的交易相同，最终的总资产也相同
+    shared = FundingArbStrategy(replace(config, isolated_margin=False))
+    shared.run()
+    assert sorted(map(trade_key, parallel.closed_trades)) == sorted(map(trade_key, shared.closed_trades))
+    for merged in parallel.iter_exchanges():
+        final = merged.metric_history.iloc[-1]
+        expected = shared._exchanges[merged.name].record_metrics(None)  # 回测结束时的状态
+        assert final["total_value"] == pytest.approx(expected["total_value"], rel=1e-12)
+        assert final["used_margin"] == pytest.approx(0, abs=1e-9)
+        assert final["trade_pnl"] + final["fund_pnl"] == pytest.approx(
+            final["total_value"] - config.init_cash / len(config.exchanges)
+        )
+
+    # 逐bar的权益按时刻加总之后，风险统计也与全仓回测相同
+    expected = shared.risk.summary()
+    for name, stats in parallel.risk.summary().items():
+        assert parallel.risk.stats[name].n_bars == shared.risk.stats[name].n_bars
+        for key, value in stats.items():
+            assert value == pytest.approx(expected[name][key], rel=1e-9, abs=1e-12), (name, key)
+
+
+def test_isolated_sweep(tmp_path):
+    config = make_config(tmp_path, init_cash=3e6, markets=MARKETS, silent=True, isolated_margin=True)
+    make_synthetic_inputs(tmp_path, config.exchanges, config.markets, hours=24 * 10, seed=5)
+
+    results = run_sweep([config, replace(config, ordersize_usd=2000)], max_workers=2)
+    strategy = IsolatedMarginStrategy(config)
+    strategy.run()
+    assert results["n_trades"].iloc[0] == len(strategy.closed_trades)
+    assert results["total_pnl"].iloc[0] == pytest.approx(
+        sum(t.trade_pnl + t.fund_pnl for t in strategy.closed_trades)
+    )
+    for name, stats in strategy.risk.summary().items():
+        for key in RISK_KEYS:
+            assert results[f"{name}_{key}"].iloc[0] == pytest.approx(stats[key])
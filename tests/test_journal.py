@@ -0,0 +1,32 @@
+import logging
+import numpy as np
+import pandas as pd
+from helpers import make_strategy
+
+
+def test_journal(caplog, tmp_path):
+    journals = {}
+    for silent in [False, True]:
+        caplog.clear()
+        with caplog.at_level(logging.INFO):
+            strategy = make_strategy(3, n_markets=2, hours=24 * 5, seed=0, quantize=False, silent=silent)
+            strategy.run()
+        journals[silent] = (strategy.journal, [r.getMessage() for r in caplog.records])
+
+    verbose, verbose_logs = journals[False]
+    silent, silent_logs = journals[True]
+    assert len(verbose.fills) > 0 and len(verbose.settlements) > 0 and len(verbose.fundrate_diffs) > 0
+
+    # 两种模式下journal的内容完全相同，silent模式下没有任何日志
+    for name in ["fills", "settlements", "fundrate_diffs"]:
+        assert np.array_equal(getattr(verbose, name).records, getattr(silent, name).records)
+    assert not any(msg.startswith(("Settle", "Trade[", "[")) for msg in silent_logs)
+
+    # 事后重新生成的日志与运行时输出的日志一致
+    journal_logs = [msg for msg in verbose_logs if msg.startswith(("Settle", "Trade[", "["))]
+    assert list(verbose.lines()) == journal_logs
+
+    verbose.to_csv(tmp_path)
+    fills = pd.read_csv(tmp_path / "fills.csv")
+    assert len(fills) == len(verbose.fills)
+    assert set(fills["exchange"]) <= {"ex0", "ex1", "ex2"}
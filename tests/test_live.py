@@ -0,0 +1,153 @@
+import asyncio
+import pandas as pd
+import pytest
+from datetime import datetime
+from prepare.synthetic import make_synthetic_inputs
+from simulator.data_feeds import DataFeeds, LiveFeeds
+from simulator.live import ReplayServer, replay_and_trade
+from simulator.strategy import FundingArbStrategy
+from helpers import make_config, trade_key
+
+EXCHANGES = ["dydx", "rabbitx"]
+MARKETS = ["BTC-USD", "ETH-USD"]
+
+
+def update(ex: str, market: str, hour: int, price: float = 100.0) -> dict:
+    timestamp = datetime(2024, 1, 1, hour).isoformat()
+    return dict(
+        exchange=ex,
+        market=market,
+        timestamp=timestamp,
+        open_price=price,
+        close_price=price,
+        mark_price=price,
+        fund_rate=1e-5,
+    )
+
+
+def test_watermark():
+    feeds = LiveFeeds("127.0.0.1", 0, exchanges=EXCHANGES, markets=MARKETS)
+    # 第0个bar的update陆续到达，到齐之前不能发出
+    assert feeds.on_update(update("dydx", "BTC-USD", 0)) == []
+    assert feeds.on_update(update("dydx", "BTC-USD", 1)) == []
+    assert feeds.on_update(update("rabbitx", "ETH-USD", 0)) == []
+    assert feeds.on_update(update("dydx", "ETH-USD", 0)) == []
+    [feed] = feeds.on_update(update("rabbitx", "BTC-USD", 0, price=101.0))
+    assert (feed.timestamp, feed.index) == (datetime(2024, 1, 1, 0), 0)
+    assert feed.close_prices["BTC-USD"] == {"dydx": 100.0, "rabbitx": 101.0}
+
+    # rabbitx ETH-USD缺少第1个bar，跳到第2个bar时，第1个bar不完整，被放弃
+    for key in [("rabbitx", "BTC-USD"), ("dydx", "ETH-USD")]:
+        assert feeds.on_update(update(*key, 1)) == []
+    assert feeds.on_update(update("rabbitx", "ETH-USD", 2)) == []
+    assert feeds.n_dropped_bars == 1 and feeds.current_index == 1
+    # 已经放弃的bar，迟到的update没有用
+    assert feeds.on_update(update("rabbitx", "ETH-USD", 1)) == []
+    assert feeds.n_late_updates == 1
+
+
+def test_max_lag():
+    # rabbitx ETH-USD在第1个bar之后停止推送
+    waiting, lagged = [
+        LiveFeeds("127.0.0.1", 0, exchanges=EXCHANGES, markets=MARKETS, max_lag=max_lag)
+        for max_lag in [None, "2h"]
+    ]
+    released = {None: [], "2h": []}
+    for hour in range(6):
+        for ex in EXCHANGES:
+            for market in MARKETS:
+                if (ex, market) == ("rabbitx", "ETH-USD") and hour > 1:
+                    continue
+                for feeds, max_lag in [(waiting, None), (lagged, "2h")]:
+                    released[max_lag] += feeds.on_update(update(ex, market, hour))
+
+    # 没有max_lag时watermark卡在第1个bar；max_lag=2h时，落后最新update 2小时的bar缺数据也放弃
+    assert [feed.index for feed in released[None]] == [0, 1]
+    assert [feed.index for feed in released["2h"]] == [0, 1]
+    assert (waiting.n_dropped_bars, waiting.current_index) == (0, 1)
+    assert (lagged.n_dropped_bars, lagged.current_index) == (2, 3)
+    # 已经放弃的bar，停止推送的(exchange, market)恢复之后的update是迟到的
+    assert lagged.on_update(update("rabbitx", "ETH-USD", 3)) == []
+    assert lagged.n_late_updates == 1
+
+
+def test_paper_trade(tmp_path):
+    config = make_config(
+        tmp_path,
+        init_cash=3e6,
+        markets=["BTC-USD", "ETH-USD", "SOL-USD"],
+        silent=True,
+        funding_intervals={"dydx": "8h"},
+    )
+    make_synthetic_inputs(tmp_path, config.exchanges, config.markets, hours=24 * 10, seed=5, regimes=True)
+    # 缺一个bar的行情
+    fname = tmp_path / "rabbitx_ETH-USD.csv"
+    df = pd.read_csv(fname, index_col="timestamp", parse_dates=True)
+    df.drop(index=df.index[50]).to_csv(fname, index_label="timestamp")
+
+    live = asyncio.run(replay_and_trade(config, jitter=1e-4))
+    backtest = FundingArbStrategy(config)
+    backtest.run()
+
+    # 纸面交易与回测走的是同一条代码路径，结果完全相同
+    assert len(backtest.closed_trades) > 0
+    assert [trade_key(t) for t in live.closed_trades] == [trade_key(t) for t in backtest.closed_trades]
+    for name, exchange in live._exchanges.items():
+        pd.testing.assert_frame_equal(exchange.metric_history, backtest._exchanges[name].metric_history)
+
+    n_bars = int(DataFeeds(tmp_path, config.exchanges, config.markets).valid.sum())
+    assert n_bars == 24 * 10 - 1
+    decision = live.stats.phase_summary("decision")
+    assert decision["calls"] == live.stats.counters["bars"] == n_bars
+    assert 0 < decision["p50"] <= decision["max"]
+    assert live._data_feeds.n_dropped_bars == 1
+
+
+class RecordingFeeds(LiveFeeds):
+    """记录每条update处理之后，已经放弃的bar数"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.dropped_history = []
+
+    def on_update(self, update: dict):
+        feeds = super().on_update(update)
+        self.dropped_history.append(self.n_dropped_bars)
+        return feeds
+
+
+async def paper_trade_recorded(config, max_lag: str):
+    server = ReplayServer(config.data_dir, exchanges=config.exchanges, markets=config.markets, jitter=1e-5)
+    host, port = await server.start()
+    try:
+        feeds = RecordingFeeds(
+            host, port, exchanges=config.exchanges, markets=config.markets, max_lag=max_lag
+        )
+        strategy = FundingArbStrategy(config, data_feeds=feeds)
+        await strategy.run_live()
+        return strategy
+    finally:
+        await server.close()
+
+
+@pytest.mark.parametrize("max_lag", [None, "3h"])
+def test_stopped_slot(tmp_path, max_lag):
+    """回放的行情中rabbitx ETH-USD在第120个bar之后停止推送"""
+    config = make_config(tmp_path, init_cash=3e6, markets=["BTC-USD", "ETH-USD"], silent=True)
+    make_synthetic_inputs(tmp_path, config.exchanges, config.markets, hours=24 * 10, seed=5, regimes=True)
+    fname = tmp_path / "rabbitx_ETH-USD.csv"
+    df = pd.read_csv(fname, index_col="timestamp", parse_dates=True)
+    df.iloc[:120].to_csv(fname, index_label="timestamp")
+
+    live = asyncio.run(paper_trade_recorded(config, max_lag))
+    backtest = FundingArbStrategy(config)
+    backtest.run()
+    assert [trade_key(t) for t in live.closed_trades] == [trade_key(t) for t in backtest.closed_trades]
+    assert live.stats.counters["bars"] == 120
+
+    feeds = live._data_feeds
+    assert feeds.n_dropped_bars == 24 * 10 - 120
+    if max_lag is None:  # 一直等到连接关闭，才一起放弃
+        assert max(feeds.dropped_history) == 0
+    else:  # 行情进行中就逐个放弃，最后只剩落后最新bar不超过3小时的
+        assert max(feeds.dropped_history) == 24 * 10 - 120 - 3
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+from dataclasses import replace
+from datetime import datetime
+from prepare.synthetic import make_synthetic_inputs
+from simulator.event_engine import EventSkippingStrategy
+from simulator.exchange import Exchange
+from simulator.metrics import MetricsRecorder, metrics_period
+from simulator.strategy import FundingArbStrategy
+from helpers import MARKETS, make_config
+
+DAYS = 20
+
+
+def run(config, engine=FundingArbStrategy):
+    strategy = engine(config)
+    strategy.run()
+    return {exchange.name: exchange.metric_history for exchange in strategy.iter_exchanges()}
+
+
+def test_cadence(tmp_path):
+    config = make_config(tmp_path, init_cash=3e6, markets=MARKETS, silent=True, metrics_freq="bar")
+    make_synthetic_inputs(tmp_path, config.exchanges, config.markets, hours=24 * DAYS, seed=5, regimes=True)
+
+    every_bar = run(config)
+    for freq, hours in [("4h", 4), ("1D", 24)]:
+        for engine in [FundingArbStrategy, EventSkippingStrategy]:
+            sampled = run(replace(config, metrics_freq=freq), engine)
+            for name, history in sampled.items():
+                # 每个exchange都在每个周期的最后一个小时记录，不论有没有持仓，回测结束时再记录一次
+                assert len(history) == 24 // hours * DAYS + 1
+                bars = every_bar[name].iloc[:-1]
+                expected = bars.loc[(bars.index.hour + 1) % hours == 0]
+                assert history.index[:-1].equals(expected.index)
+                np.testing.assert_allclose(history.iloc[:-1], expected, rtol=1e-12, atol=1e-9)
+                np.testing.assert_allclose(
+                    history.iloc[-1], every_bar[name].iloc[-1], rtol=1e-12, atol=1e-9
+                )
+
+    with pytest.raises(ValueError):
+        metrics_period("7h")
+
+
+def test_per_market(tmp_path):
+    config = make_config(tmp_path, init_cash=3e6, markets=MARKETS, silent=True, metrics_per_market=True)
+    make_synthetic_inputs(tmp_path, config.exchanges, config.markets, hours=24 * DAYS, seed=5, regimes=True)
+
+    strategy = FundingArbStrategy(config)
+    strategy.run()
+    for exchange in strategy.iter_exchanges():
+        history = exchange.metric_history
+        # 零拷贝地引用recorder中的数组
+        assert np.shares_memory(history.to_numpy(), exchange.metrics.values)
+        for field in ["used_margin", "trade_pnl", "fund_pnl"]:
+            per_market = history[[f"{market}_{field}" for market in config.markets]].sum(axis=1)
+            np.testing.assert_allclose(per_market, history[field], rtol=1e-9, atol=1e-9)
+
+
+def test_sampled_check():
+    times = pd.date_range("2024-01-01", periods=3, freq="h").to_pydatetime()
+    for check_every, raises in [(2, True), (0, False)]:
+        exchange = Exchange(
+            "a", init_cash=100, markets={"X": 0.5}, commission=0, metrics_check_every=check_every
+        )
+        exchange.record_metrics(times[0])
+        exchange.cash = 50  # 破坏会计恒等式
+        exchange.record_metrics(times[1])  # 第2次记录不检查
+        if raises:
+            with pytest.raises(AssertionError):
+                exchange.record_metrics(times[2])
+        else:
+            exchange.record_metrics(times[2])
+            assert list(exchange.metric_history["cash"]) == [100, 50, 50]
+
+
+def test_recorder_grows():
+    recorder = MetricsRecorder(["a", "b"], capacity=1)
+    for idx in range(5):
+        recorder.append(datetime(2024, 1, 1, idx), [idx, -idx])
+    assert len(recorder) == 5 and recorder.capacity == 8
+    df = recorder.frame()
+    assert list(df["b"]) == [0, -1, -2, -3, -4]
+    assert df.index[-1] == pd.Timestamp("2024-01-01 04:00")
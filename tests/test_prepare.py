@@ -0,0 +1,236 @@
+import asyncio
+import json
+import threading
+import time
+import httpx
+import pandas as pd
+import pytest
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+from prepare import download_dydx, download_rabbitx, prepare
+from prepare.common import TokenBucket
+from prepare.prepare import PrepareJob
+from prepare.raw_store import RawStore, missing_ranges
+from prepare.synthetic import SyntheticExchangeApi
+from prepare.transport import RecordingTransport, ReplayTransport
+from simulator.dataset import PartitionedDataset
+
+
+def run_job(tmp_path, monkeypatch, api: SyntheticExchangeApi, end_dt=datetime(2024, 1, 10)) -> PrepareJob:
+    tmp_path.mkdir(exist_ok=True)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(prepare, "BACKOFF_SECONDS", 0.001)
+    monkeypatch.setattr(prepare, "RATE_LIMITS", {"dydx": 1000, "rabbitx": 1000})
+    job = PrepareJob(
+        "dydx,rabbitx",
+        "btc,eth",
+        start_dt=datetime(2024, 1, 1),
+        end_dt=end_dt,
+        transport=httpx.MockTransport(api),
+    )
+    job.succeeded = job.download()
+    return job
+
+
+def test_download(tmp_path, monkeypatch):
+    api = SyntheticExchangeApi()
+    assert run_job(tmp_path / "clean", monkeypatch, api).succeeded
+
+    store = RawStore(tmp_path / "clean/data/raw")
+    for exchange in ["dydx", "rabbitx"]:
+        for market in ["BTC-USD", "ETH-USD"]:
+            df = store.load(exchange, market, ["FundRate", "Candle"])
+            assert len(df) == 240
+            assert df.notna().all().all()
+    clean_requests = api.requests
+
+    # 失败的请求重试后从上次下载到的页继续，只多出失败的那些请求
+    api = SyntheticExchangeApi(fail_every=4)
+    assert run_job(tmp_path / "retry", monkeypatch, api).succeeded
+    assert api.failures > 0
+    assert api.requests == clean_requests + api.failures
+
+
+def test_incremental(tmp_path, monkeypatch):
+    api = SyntheticExchangeApi(last="2024-01-20")
+    run_job(tmp_path / "incremental", monkeypatch, api, end_dt=datetime(2024, 1, 10))
+
+    # 已经下载过的时间段不再请求
+    api.requests = 0
+    assert run_job(tmp_path / "incremental", monkeypatch, api, end_dt=datetime(2024, 1, 5)).succeeded
+    assert api.requests == 0
+
+    # 多下载一天，每个exchange×market×data type只需要一个请求
+    job = run_job(tmp_path / "incremental", monkeypatch, api, end_dt=datetime(2024, 1, 11))
+    assert job.succeeded and api.requests == 8
+    job.postprocess()
+
+    # 与一次性下载的结果相同
+    job = run_job(
+        tmp_path / "full",
+        monkeypatch,
+        SyntheticExchangeApi(last="2024-01-20"),
+        end_dt=datetime(2024, 1, 11),
+    )
+    job.postprocess()
+    incremental, full = [
+        PartitionedDataset(tmp_path / name / "data/input") for name in ["incremental", "full"]
+    ]
+    for exchange in ["dydx", "rabbitx"]:
+        for market in ["BTC-USD", "ETH-USD"]:
+            df = incremental.read(exchange, market)
+            assert len(df) == 24 * 11 and df.notna().all().all()
+            pd.testing.assert_frame_equal(df, full.read(exchange, market))
+
+    store = RawStore(tmp_path / "incremental/data/raw")
+    start = pd.Timestamp("2024-01-01", tz="UTC")
+    assert store.coverage("dydx", "BTC-USD", "Candle") == [(start, pd.Timestamp("2024-01-12", tz="UTC"))]
+
+
+def test_missing_ranges():
+    t = [pd.Timestamp("2024-01-01", tz="UTC") + pd.Timedelta(hours=h) for h in range(10)]
+    covered = [(t[2], t[4]), (t[3], t[5]), (t[7], t[8])]
+    assert missing_ranges(covered, t[0], t[9]) == [(t[0], t[2]), (t[5], t[7]), (t[8], t[9])]
+    assert missing_ranges(covered, t[3], t[5]) == []
+    assert missing_ranges([], t[1], t[2]) == [(t[1], t[2])]
+
+
+def test_download_fail(tmp_path, monkeypatch):
+    api = SyntheticExchangeApi(fail_every=1)
+    assert not run_job(tmp_path, monkeypatch, api).succeeded
+    assert api.requests == 8 * prepare.MAX_RETRIES
+
+
+def test_token_bucket():
+    async def timed():
+        bucket = TokenBucket(rate=100, capacity=1)
+        start = time.monotonic()
+        await asyncio.gather(*(bucket.acquire() for _ in range(21)))
+        return time.monotonic() - start
+
+    # 第一个请求不用等，其余20个请求按每秒100个补充
+    assert 0.18 < asyncio.run(timed()) < 0.5
+
+
+class LocalServer:
+    """本地HTTP服务器代替真实的exchange，每个请求固定延迟latency秒"""
+
+    def __init__(self, api: SyntheticExchangeApi, latency: float) -> None:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(latency)
+                url = urlsplit(self.path)
+                status, payload = server.api.respond(url.path, dict(parse_qsl(url.query)))
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            # 默认的listen backlog只有5，并发连接多时会触发1秒的SYN重传
+            request_queue_size = 128
+
+        self.api = api
+        self.httpd = Server(("127.0.0.1", 0), Handler)
+        self.port = self.httpd.server_address[1]
+
+    def transport(self) -> httpx.AsyncBaseTransport:
+        """把发往真实exchange的请求转发到本地服务器"""
+        port = self.port
+
+        class Redirect(httpx.AsyncHTTPTransport):
+            async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+                request.url = request.url.copy_with(scheme="http", host="127.0.0.1", port=port)
+                return await super().handle_async_request(request)
+
+        return Redirect()
+
+
+@pytest.fixture
+def local_server():
+    server = LocalServer(SyntheticExchangeApi(first="2024-01-01", last="2024-05-01"), latency=0.02)
+    thread = threading.Thread(target=server.httpd.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.httpd.shutdown()
+    server.httpd.server_close()
+
+
+@pytest.mark.parametrize("module", [download_dydx, download_rabbitx])
+def test_shards_same_as_sequential(module):
+    api = SyntheticExchangeApi(first="2024-01-01", last="2024-02-01")
+    start_time = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    end_time = datetime(2024, 1, 31, 23, 59, 59, tzinfo=timezone.utc)
+
+    async def fetch(downloader_cls, shard_days):
+        async with httpx.AsyncClient(transport=httpx.MockTransport(api)) as client:
+            downloader = downloader_cls("BTC-USD")
+            return await downloader.fetch(client, start_time, end_time, TokenBucket(rate=1000), shard_days)
+
+    for downloader_cls in [module.FundRateDownloader, module.CandleDownloader]:
+        expected = asyncio.run(fetch(downloader_cls, shard_days=31))
+        actual = asyncio.run(fetch(downloader_cls, shard_days=3))
+        assert len(expected) == 24 * 31
+        pd.testing.assert_frame_equal(actual.sort_index(), expected.sort_index())
+
+
+def test_shards_speedup(local_server):
+    start_time = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    end_time = datetime(2024, 4, 30, 23, 59, 59, tzinfo=timezone.utc)
+
+    async def fetch(shard_days):
+        async with httpx.AsyncClient(transport=local_server.transport()) as client:
+            downloader = download_dydx.FundRateDownloader("BTC-USD")
+            return await downloader.fetch(client, start_time, end_time, TokenBucket(rate=1000), shard_days)
+
+    elapsed = []
+    frames = []
+    for shard_days in [121, 15]:
+        start = time.perf_counter()
+        frames.append(asyncio.run(fetch(shard_days)))
+        elapsed.append(time.perf_counter() - start)
+
+    # 30个页顺序请求 vs 9个时间段并发请求
+    assert len(frames[0]) == 24 * 121
+    pd.testing.assert_frame_equal(frames[1].sort_index(), frames[0].sort_index())
+    assert elapsed[0] > 2.5 * elapsed[1]
+
+
+def test_record_replay(tmp_path, monkeypatch):
+    cassette = tmp_path / "cassette"
+    api = SyntheticExchangeApi()
+    transport = RecordingTransport(cassette, inner=httpx.MockTransport(api))
+    monkeypatch.setattr(prepare, "BACKOFF_SECONDS", 0.001)
+    monkeypatch.setattr(prepare, "RATE_LIMITS", {"dydx": 1000, "rabbitx": 1000})
+
+    def run(workdir, transport):
+        workdir.mkdir()
+        monkeypatch.chdir(workdir)
+        job = PrepareJob(
+            "dydx,rabbitx", "btc", datetime(2024, 1, 1), datetime(2024, 1, 10), transport=transport
+        )
+        assert job.download()
+        job.postprocess()
+
+    run(tmp_path / "live", transport)
+    replay = ReplayTransport(cassette, error_rate=0.2, seed=1)
+    assert len(replay) == api.requests
+    run(tmp_path / "replay", replay)
+
+    # 注入的错误重试之后，回放的结果与录制时相同
+    assert replay.errors > 0 and replay.requests == api.requests + replay.errors
+    live, replayed = [PartitionedDataset(tmp_path / name / "data/input") for name in ["live", "replay"]]
+    for exchange in ["dydx", "rabbitx"]:
+        pd.testing.assert_frame_equal(replayed.read(exchange, "BTC-USD"), live.read(exchange, "BTC-USD"))
+
+    with pytest.raises(KeyError):
+        request = httpx.Request("GET", "https://api.dydx.exchange/v3/candles/XXX-USD")
+        asyncio.run(replay.handle_async_request(request))
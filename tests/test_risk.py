@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+from simulator.data_feeds import DataFeeds
+from simulator.event_engine import EventSkippingStrategy
+from simulator.risk import MIN_MARGIN, RiskStats
+from simulator.strategy import FundingArbStrategy
+from helpers import make_strategy
+
+KEYS = [
+    "max_drawdown",
+    "max_drawdown_pct",
+    "return_mean",
+    "return_std",
+    "time_in_market",
+    "peak_margin_ratio",
+]
+
+
+def offline_stats(history: pd.DataFrame, init_value: float) -> dict:
+    """由逐bar记录的metric_history离线计算，与流式统计对照"""
+    values = history["total_value"].to_numpy()
+    used_margin = history["used_margin"].to_numpy()
+    cash = history["cash"].to_numpy()
+    rets = values / np.concatenate([[init_value], values[:-1]]) - 1
+    peaks = np.maximum.accumulate(np.concatenate([[init_value], values]))[1:]
+    in_market = used_margin > MIN_MARGIN
+    return dict(
+        max_drawdown=(peaks - values).max(),
+        max_drawdown_pct=((peaks - values) / peaks).max(),
+        return_mean=rets.mean(),
+        return_std=rets.std(ddof=1),
+        time_in_market=in_market.mean(),
+        peak_margin_ratio=(used_margin[in_market] / cash[in_market]).max(),
+    )
+
+
+def test_same_as_offline():
+    # 平仓门槛为0，持仓时间长，批量结算的引擎才有可以跳过的bar
+    kwargs = dict(n_markets=3, hours=24 * 30, seed=3, quantize=False, silent=True, fundrate_diff_close=0)
+    strategy = make_strategy(2, metrics_freq="bar", **kwargs)
+    strategy.run()
+    risk = strategy.risk.summary()
+    init_value = strategy._config.init_cash / 2
+
+    for exchange in strategy.iter_exchanges():
+        # 每个bar一条记录，加上回测结束平仓之后的一条，与流式统计看到的序列相同
+        history = exchange.metric_history
+        assert strategy.risk.stats[exchange.name].n_bars == len(history)
+        expected = offline_stats(history, init_value)
+        assert 0 < risk[exchange.name]["time_in_market"] <= 1
+        for key in KEYS:
+            assert risk[exchange.name][key] == pytest.approx(expected[key], rel=1e-9, abs=1e-12), key
+        assert risk[exchange.name]["funding_yield"] == pytest.approx(
+            history["fund_pnl"].iloc[-1] / init_value / strategy.risk.years
+        )
+
+    # 批量结算的引擎，批量合并的结果与逐bar更新一致
+    engine = make_strategy(2, cls=EventSkippingStrategy, **kwargs)
+    engine.run()
+    assert engine.n_stepped_bars < 24 * 30
+    for name, stats in engine.risk.summary().items():
+        assert engine.risk.stats[name].n_bars == strategy.risk.stats[name].n_bars
+        for key in KEYS + ["sharpe", "funding_yield"]:
+            assert stats[key] == pytest.approx(risk[name][key], rel=1e-6, abs=1e-12), key
+
+
+def test_batch_update():
+    rng = np.random.default_rng(0)
+    cash = 1000 + rng.normal(0, 10, size=500).cumsum()
+    used_margin = np.where(rng.random(500) < 0.3, 0.0, rng.uniform(10, 100, size=500))
+
+    one_by_one, batched = RiskStats(1000.0), RiskStats(1000.0)
+    for c, m in zip(cash.tolist(), used_margin.tolist()):
+        one_by_one.update(c, m)
+    for chunk in np.array_split(np.arange(500), [1, 7, 200, 201]):
+        batched.update_batch(cash[chunk], used_margin[chunk])
+
+    expected = one_by_one.summary(years=1.0, fund_pnl=5.0)
+    for key, value in batched.summary(years=1.0, fund_pnl=5.0).items():
+        assert value == pytest.approx(expected[key], rel=1e-9, abs=1e-12), key
+
+
+def test_resume(tmp_path):
+    full = make_strategy(2, n_markets=2, hours=24 * 20, seed=2, quantize=False, silent=True)
+    feeds = full._data_feeds
+    full.run()
+
+    partial = DataFeeds.from_arrays(
+        feeds.timestamps[: 24 * 12], feeds.values[: 24 * 12], full._config.exchanges, full._config.markets
+    )
+    FundingArbStrategy(full._config, data_feeds=partial).run(checkpoint=tmp_path / "state.pkl")
+    resumed = FundingArbStrategy.resume(tmp_path / "state.pkl", data_feeds=feeds)
+    resumed.run()
+    # checkpoint在平仓之前保存，接着跑的风险统计与一次跑完相同
+    assert resumed.risk.summary() == full.risk.summary()
@@ -0,0 +1,56 @@
+import asyncio
+import threading
+import pandas as pd
+import pytest
+from dataclasses import replace
+from prepare.synthetic import make_synthetic_inputs
+from simulator.service import BacktestClient, BacktestService, history_frame
+from simulator.strategy import FundingArbStrategy
+from simulator.sweep import summarize
+from simulator.utils import afr2h
+from helpers import make_config
+
+
+def test_service(tmp_path):
+    base = make_config(tmp_path / "input", silent=True)
+    make_synthetic_inputs(base.data_dir, exchanges=base.exchanges, markets=base.markets, hours=24 * 20)
+    path = tmp_path / "backtest.sock"
+
+    with BacktestService(base, max_workers=2) as service:
+        server = threading.Thread(target=asyncio.run, args=(service.serve(path),))
+        server.start()
+        client = BacktestClient(path)
+        jobs = [
+            dict(config=dict(fundrate_diff_open=afr2h(0.2)), history=True),
+            dict(config=dict(ordersize_usd=3000), engine="event"),
+            dict(config=dict(markets=["BTC-USD"])),  # 不能修改数据
+            dict(config=dict(no_such_field=1)),
+        ]
+        responses = {response["id"]: response for response in client.run(jobs)}
+        # 同一个服务可以接着处理新的连接
+        again = list(client.run(jobs[:1]))
+        client.shutdown()
+        server.join(timeout=10)
+        assert not server.is_alive() and not path.exists()
+    assert service.n_jobs == 3
+
+    assert sorted(responses) == [0, 1, 2, 3]
+    assert "markets" in responses[2]["error"] and "no_such_field" in responses[3]["error"]
+
+    for idx in [0, 1]:
+        config = replace(base, **jobs[idx]["config"])
+        strategy = FundingArbStrategy(config)
+        strategy.run()
+        expected = summarize(strategy)
+        assert responses[idx]["result"]["n_trades"] == expected["n_trades"]
+        assert responses[idx]["result"]["total_pnl"] == pytest.approx(expected["total_pnl"])
+        assert responses[idx]["latency"] >= responses[idx]["seconds"] > 0
+
+    assert "metric_history" not in responses[1]
+    for name, columns in responses[0]["metric_history"].items():
+        expected = FundingArbStrategy(replace(base, **jobs[0]["config"]))
+        expected.run()
+        pd.testing.assert_frame_equal(
+            history_frame(columns), expected._exchanges[name].metric_history, check_freq=False
+        )
+    assert again[0]["result"] == responses[0]["result"]
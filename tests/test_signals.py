@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from simulator.signals import compute_arb_signals
+from simulator.strategy import FundingArbStrategy
+from helpers import make_strategy
+
+
+@pytest.mark.parametrize("n_exchanges", range(2, 51))
+def test_signals_match_loop(n_exchanges):
+    for quantize in [False, True]:
+        strategy = make_strategy(n_exchanges, n_markets=3, hours=100, seed=n_exchanges, quantize=quantize)
+        for feed in strategy._data_feeds:
+            for market in strategy._config.markets:
+                expected = strategy._best_arb_pair(market=market, funding_rates=feed.funding_rates)
+                actual = strategy._signal_arb_pair(
+                    row=feed.index, market=market, funding_rates=feed.funding_rates
+                )
+                assert expected == actual
+
+
+class LoopStrategy(FundingArbStrategy):
+    """每个bar都用原来的双重循环寻找套利对"""
+
+    def open(self, tm, prices, funding_rates, row=None):
+        super().open(tm=tm, prices=prices, funding_rates=funding_rates)
+
+
+@pytest.mark.parametrize("n_exchanges", [2, 3, 10])
+def test_run_same_trades(n_exchanges):
+    strategies = []
+    for cls in [FundingArbStrategy, LoopStrategy]:
+        strategy = make_strategy(n_exchanges, n_markets=3, hours=300, seed=1, quantize=False, cls=cls)
+        strategy.run()
+        strategies.append(strategy)
+
+    signal_trades, loop_trades = [
+        [(t.name, t.open_tm, t.close_tm, t.trade_pnl, t.fund_pnl) for t in s.closed_trades] for s in strategies
+    ]
+    assert len(signal_trades) > 0
+    assert signal_trades == loop_trades
+
+
+def test_causality():
+    strategy = make_strategy(5, n_markets=2, hours=50, seed=0, quantize=False)
+    fund_rates = strategy._data_feeds.field("fund_rate")
+
+    # 截断历史之后重新计算，前面的信号不受影响
+    full = compute_arb_signals(fund_rates, strategy._config.fundrate_diff_open)
+    prefix = compute_arb_signals(fund_rates[:20], strategy._config.fundrate_diff_open)
+    for full_array, prefix_array in zip(full, prefix):
+        assert np.array_equal(full_array[:20], prefix_array)
+
+    # 只能查询已经迭代到的行
+    feed = next(strategy._data_feeds)
+    strategy._signals.at(feed.index, 0)
+    with pytest.raises(LookupError):
+        strategy._signals.at(feed.index + 1, 0)
@@ -1,10 +1,14 @@
 from simulator.utils import Config, afr2h
 from simulator.strategy import FundingArbStrategy
+from simulator.event_engine import EventSkippingStrategy
+from prepare.synthetic import make_synthetic_inputs
 from prettytable import PrettyTable
+from dataclasses import replace
 import logging
+import pytest
 
 
-def get_config():
+def get_config(data_dir="data/input"):
     annual_fr_diff_open = 0.1
     annual_fr_diff_close = 0.01
     coins = ["btc", "eth", "sol"]
@@ -18,7 +22,7 @@ def get_config():
         fundrate_diff_open=afr2h(annual_fr_diff_open),
         fundrate_diff_close=afr2h(annual_fr_diff_close),
         fundrate_diff_change_pct=0.1,
-        data_dir="data/input",
+        data_dir=data_dir,
         exchanges=["dydx", "rabbitx"],
         markets=[c.upper() + "-USD" for c in coins],
     )
@@ -57,6 +61,55 @@ def main():
     logging.info(pt)
 
 
+def test_run_synthetic(tmp_path):
+    # 不需要下载的数据，用regime切换的合成数据跑完整的回测
+    config = replace(get_config(data_dir=tmp_path), silent=True)
+    make_synthetic_inputs(
+        tmp_path, config.exchanges, config.markets, hours=24 * 60, seed=3, dataset=True, regimes=True
+    )
+    strategy = FundingArbStrategy(config)
+    strategy.run()
+
+    assert len(strategy.closed_trades) > 0
+    assert all(not trade.is_active for trade in strategy.closed_trades)
+    for exchange in strategy.iter_exchanges():
+        # 每天23:00记录一次，回测结束平仓之后再记录一次
+        assert len(exchange.metric_history) == 61
+        assert exchange.metric_history["used_margin"].iloc[-1] == pytest.approx(0, abs=1e-9)
+
+
+def test_instrument(tmp_path):
+    config = replace(get_config(data_dir=tmp_path), silent=True)
+    make_synthetic_inputs(
+        tmp_path, config.exchanges, config.markets, hours=24 * 60, seed=3, dataset=True, regimes=True
+    )
+    plain = FundingArbStrategy(config)
+    plain.run()
+    assert plain.stats is None
+
+    strategy = FundingArbStrategy(replace(config, instrument=True))
+    strategy.run()
+    # 打开instrument不改变回测结果
+    assert [t.trade_pnl for t in strategy.closed_trades] == [t.trade_pnl for t in plain.closed_trades]
+
+    stats = strategy.stats.to_dict()
+    counters = stats["counters"]
+    assert counters["bars"] == 24 * 60 and counters["skipped_nan_bars"] == 0
+    assert counters["closes"] == len(strategy.closed_trades) == counters["opens"] + counters["switches"]
+    assert counters["exchange.settle_trading"] == 2 * counters["settlements"]
+    assert stats["phases"]["feed"]["calls"] == 24 * 60 + 1  # 最后一次读到迭代结束
+    assert stats["phases"]["metrics"]["calls"] == 60
+    assert set(stats["phases"]["settle"]) >= {"total", "p50", "p90", "p99", "max"}
+    assert "settlements" in strategy.stats.report()
+
+    # 批量结算的引擎，事件的计数与逐bar回测相同
+    engine = EventSkippingStrategy(replace(config, instrument=True))
+    engine.run()
+    engine_counters = engine.stats.to_dict()["counters"]
+    for name in ["bars", "skipped_nan_bars", "opens", "adds", "switches", "closes", "settlements"]:
+        assert engine_counters[name] == counters[name], name
+
+
 if __name__ == "__main__":
     setup_logging(logging.DEBUG)
     main()
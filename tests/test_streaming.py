@@ -0,0 +1,102 @@
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from dataclasses import replace
+from pathlib import Path
+from prepare.synthetic import make_synthetic_inputs
+from simulator.data_feeds import DataFeeds, StreamingDataFeeds
+from simulator.strategy import FundingArbStrategy
+from helpers import make_strategy
+
+EXCHANGES = ["dydx", "rabbitx", "hyper"]
+MARKETS = ["BTC-USD", "ETH-USD"]
+
+
+def test_same_feeds(tmp_path):
+    make_synthetic_inputs(tmp_path, exchanges=EXCHANGES, markets=MARKETS, hours=24 * 10)
+
+    # 各文件的时间轴错开，并挖掉一些值，对齐之后要与DataFeeds完全一致
+    fname = tmp_path / "rabbitx_ETH-USD.csv"
+    df = pd.read_csv(fname, index_col="timestamp", parse_dates=True)
+    df.iloc[30, 1] = float("nan")
+    df.drop(index=df.index[100:130]).iloc[7:].to_csv(fname, index_label="timestamp")
+    fname = tmp_path / "hyper_BTC-USD.csv"
+    df = pd.read_csv(fname, index_col="timestamp", parse_dates=True)
+    df.iloc[:-20].to_csv(fname, index_label="timestamp")
+
+    expected = list(DataFeeds(data_dir=tmp_path, exchanges=EXCHANGES, markets=MARKETS))
+    for chunk_rows in [5, 50, 1000]:
+        feeds = StreamingDataFeeds(data_dir=tmp_path, exchanges=EXCHANGES, markets=MARKETS, chunk_rows=chunk_rows)
+        actual = list(feeds)
+        assert len(actual) == len(expected)
+        for a, e in zip(actual, expected):
+            assert (a.timestamp, a.index) == (e.timestamp, e.index)
+            for col in ["open_price", "close_price", "mark_price", "fund_rate"]:
+                assert a.get(col) == e.get(col)
+
+
+def test_run_same_trades(tmp_path):
+    in_memory = make_strategy(3, n_markets=2, hours=24 * 20, seed=0, quantize=False, silent=True)
+    config = replace(in_memory._config, data_dir=tmp_path, chunk_rows=24)
+    make_synthetic_inputs(tmp_path, exchanges=config.exchanges, markets=config.markets, hours=24 * 20, seed=0)
+    streaming = FundingArbStrategy(config)
+
+    in_memory = FundingArbStrategy(replace(config, chunk_rows=None))
+    for strategy in [in_memory, streaming]:
+        strategy.run()
+
+    assert len(in_memory.closed_trades) > 0
+    assert [(t.name, t.open_tm, t.close_tm) for t in streaming.closed_trades] == [
+        (t.name, t.open_tm, t.close_tm) for t in in_memory.closed_trades
+    ]
+    for a, e in zip(streaming.iter_exchanges(), in_memory.iter_exchanges()):
+        np.testing.assert_allclose(a.metric_history, e.metric_history, rtol=1e-12, atol=1e-9)
+
+
+# 在子进程中遍历StreamingDataFeeds，输出遍历前后的峰值RSS（/proc/self/status中的VmHWM，KB）
+PEAK_RSS_SCRIPT = """
+import re, sys
+from simulator.data_feeds import StreamingDataFeeds
+
+def peak_rss():
+    return int(re.search(r"VmHWM:\\s+(\\d+)", open("/proc/self/status").read()).group(1))
+
+data_dir, exchanges, markets, chunk_rows = sys.argv[1:]
+feeds = StreamingDataFeeds(
+    data_dir, exchanges=exchanges.split(","), markets=markets.split(","), chunk_rows=int(chunk_rows)
+)
+before = peak_rss()
+n_feeds = sum(1 for _ in feeds)
+print(n_feeds, before, peak_rss())
+"""
+
+
+def peak_rss_growth(data_dir, exchanges, markets, chunk_rows) -> int:
+    """遍历过程中峰值RSS的增长（KB），每次用新的子进程，不受之前分配的影响"""
+    args = [str(data_dir), ",".join(exchanges), ",".join(markets), str(chunk_rows)]
+    output = subprocess.run(
+        [sys.executable, "-c", PEAK_RSS_SCRIPT, *args],
+        cwd=Path(__file__).parents[1],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    n_feeds, before, after = map(int, output.split())
+    assert n_feeds > 0
+    return after - before
+
+
+@pytest.mark.skipif(not Path("/proc/self/status").exists(), reason="VmHWM needs Linux /proc")
+def test_bounded_memory(tmp_path):
+    # pandas每个csv reader有固定大小的缓冲区，两段历史都要比缓冲区长
+    # 全部载入的DataFeeds在长的历史上，峰值RSS的增长大约是短的历史的2.5倍
+    peaks = []
+    for hours in [24 * 360, 24 * 1440]:
+        data_dir = tmp_path / str(hours)
+        make_synthetic_inputs(data_dir, exchanges=EXCHANGES[:2], markets=MARKETS, hours=hours)
+        peaks.append(peak_rss_growth(data_dir, EXCHANGES[:2], MARKETS, chunk_rows=24 * 7))
+
+    # 历史长了4倍，峰值RSS基本不变
+    assert peaks[1] < 1.2 * peaks[0], peaks
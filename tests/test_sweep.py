@@ -0,0 +1,32 @@
+import pytest
+from prepare.synthetic import make_synthetic_inputs
+from simulator.event_engine import EventSkippingStrategy
+from simulator.strategy import FundingArbStrategy
+from simulator.sweep import grid_configs, random_configs, run_sweep
+from simulator.utils import afr2h
+from helpers import make_config
+
+
+def test_sweep(tmp_path):
+    base = make_config(tmp_path / "input")
+    make_synthetic_inputs(base.data_dir, exchanges=base.exchanges, markets=base.markets, hours=24 * 20)
+
+    configs = grid_configs(
+        base, {"fundrate_diff_open": [afr2h(0.1), afr2h(0.3)], "fundrate_diff_change_pct": [0.1, 0.5]}
+    )
+    configs += random_configs(base, {"ordersize_usd": (500, 5000)}, n=2)
+    assert len(configs) == 6
+
+    results = run_sweep(configs, max_workers=2)
+    assert (tmp_path / "input" / ".feed_cache").exists()
+    assert len(results) == len(configs)
+
+    for config, (_, row) in zip(configs, results.iterrows()):
+        strategy = FundingArbStrategy(config)
+        strategy.run()
+        assert row["n_trades"] == len(strategy.closed_trades)
+        assert row["total_pnl"] == pytest.approx(sum(t.trade_pnl + t.fund_pnl for t in strategy.closed_trades))
+        assert row["dydx_final_value"] == strategy._exchanges["dydx"].metric_history["total_value"].iloc[-1]
+
+    event_results = run_sweep(configs, max_workers=2, engine=EventSkippingStrategy)
+    assert event_results["total_pnl"].to_list() == pytest.approx(results["total_pnl"].to_list())
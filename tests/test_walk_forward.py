@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+from dataclasses import replace
+from prepare.synthetic import make_synthetic_inputs
+from simulator.data_feeds import DataFeeds
+from simulator.strategy import FundingArbStrategy
+from simulator.utils import afr2h
+from simulator.walk_forward import equity_curve, make_windows, walk_forward
+from helpers import make_config
+
+GRID = {"fundrate_diff_open": [afr2h(0.05), afr2h(0.2)], "fundrate_diff_change_pct": [0.1, 0.5]}
+
+
+def test_make_windows():
+    timestamps = pd.date_range("2024-01-01", periods=24 * 45, freq="h").to_numpy()
+    windows = make_windows(timestamps, train_days=20, test_days=10)
+    assert [(w.start, w.stop, t.start, t.stop) for w, t in windows] == [
+        (0, 480, 480, 720),
+        (240, 720, 720, 960),
+        (480, 960, 960, 1080),  # 最后一个测试窗口只有5天
+    ]
+
+
+def test_walk_forward(tmp_path):
+    base = make_config(tmp_path / "input", silent=True)
+    make_synthetic_inputs(
+        base.data_dir, exchanges=base.exchanges, markets=base.markets, hours=24 * 40, seed=7, regimes=True
+    )
+    result = walk_forward(base, GRID, train_days=15, test_days=10, max_workers=2)
+    windows = result.windows
+    assert len(windows) == 3
+
+    feeds = DataFeeds(base.data_dir, exchanges=base.exchanges, markets=base.markets)
+    train, test = make_windows(feeds.timestamps, train_days=15, test_days=10)[1]
+
+    def run(config, rows):
+        sliced = DataFeeds.from_arrays(
+            feeds.timestamps[rows], feeds.values[rows], base.exchanges, base.markets
+        )
+        strategy = FundingArbStrategy(config, data_feeds=sliced)
+        strategy.run()
+        return strategy
+
+    # 第2个窗口：样本内选出的参数与逐个回测的结果一致，样本外的结果与直接回测测试窗口一致
+    candidates = [
+        replace(base, fundrate_diff_open=o, fundrate_diff_change_pct=c)
+        for o in GRID["fundrate_diff_open"]
+        for c in GRID["fundrate_diff_change_pct"]
+    ]
+    pnls = [
+        sum(t.trade_pnl + t.fund_pnl for t in run(config, train).closed_trades) for config in candidates
+    ]
+    winner = candidates[int(np.argmax(pnls))]
+    row = windows.iloc[1]
+    assert (row["fundrate_diff_open"], row["fundrate_diff_change_pct"]) == (
+        winner.fundrate_diff_open,
+        winner.fundrate_diff_change_pct,
+    )
+    assert row["train_total_pnl"] == pytest.approx(max(pnls))
+    tested = run(winner, test)
+    assert row["test_total_pnl"] == pytest.approx(
+        sum(t.trade_pnl + t.fund_pnl for t in tested.closed_trades)
+    )
+    assert row["test_start"] == feeds.timestamps[test.start]
+
+    # 样本外的权益曲线首尾相接，最终的PnL是各个测试窗口之和
+    equity = result.equity
+    assert equity.index.is_monotonic_increasing and equity.index[0] >= windows["test_start"].iloc[0]
+    assert equity.iloc[-1] - base.init_cash == pytest.approx(windows["test_total_pnl"].sum())
+    second = equity.loc[row["test_start"] : row["test_end"]]
+    offset = equity.loc[: windows["test_end"].iloc[0]].iloc[-1] - base.init_cash
+    np.testing.assert_allclose(second, equity_curve(tested).loc[second.index] + offset, rtol=1e-12)
+
+
+def test_margin_call(tmp_path):
+    base = make_config(tmp_path / "input", silent=True)
+    make_synthetic_inputs(
+        base.data_dir, exchanges=base.exchanges, markets=base.markets, hours=24 * 40, seed=7, regimes=True
+    )
+    # 第2个测试窗口中价格突然涨10倍，空头的那条腿margin call；第3个训练窗口包含暴涨，所有参数都margin call
+    for fname in base.data_dir.glob("*.csv"):
+        df = pd.read_csv(fname, index_col="timestamp", parse_dates=True)
+        df.loc["2024-01-31":, ["mark_price", "open_price", "close_price"]] *= 10
+        df.to_csv(fname)
+
+    result = walk_forward(
+        base, {"ordersize_usd": [1000, 20000]}, train_days=15, test_days=10, max_workers=2
+    )
+    windows = result.windows
+    assert list(windows["status"]) == ["ok", "margin_call", "no_valid_config"]
+    assert np.isnan(windows["train_total_pnl"].iloc[2]) and windows["ordersize_usd"].isna().iloc[2]
+
+    # 权益曲线到强平时刻为止，强平的损失计入最终的权益，没有交易的窗口不改变权益
+    equity = result.equity
+    liquidated = equity.index[-1]
+    assert liquidated == pd.Timestamp("2024-01-31") and liquidated <= windows["test_end"].iloc[1]
+    assert equity.iloc[-1] < equity.iloc[-2]
+    assert equity.iloc[-1] - base.init_cash < windows["test_total_pnl"].iloc[0]